@@ -1,17 +1,27 @@
 import uvicorn
 import asyncio
+import multiprocessing
 from fastapi import FastAPI, Request, Body, Depends
+from fastapi.responses import PlainTextResponse
 from fastapi.security import APIKeyHeader
 from contextlib import asynccontextmanager
 from loguru import logger
+from typing import Optional
 
 from network.neuron import Neuron
 from network import echo
-from network.meta.schemas import QueryChatRequest, StreamChunk
-from network.meta.middlewares import middleware
+from network.meta.schemas import BatchResult, ChatCompletionRequest, QueryBatchRequest, QueryChatRequest, StreamChunk
+from network.meta.middlewares import get_api_key, middleware
+from network.utils.log_utils import configure_logging
+from network.utils.metagraph_snapshot import run_refresher
+from network.utils.metrics import render_metrics
 import settings
 
-instance = Neuron()
+configure_logging()
+
+# Created by each worker when it starts (see `lifespan`), rather than when the module is imported, so the process
+# that only supervises the workers doesn't connect to the network
+instance: Optional[Neuron] = None
 
 
 async def periodic_metagraph_resync():
@@ -20,13 +30,20 @@ async def periodic_metagraph_resync():
         while True:
             await asyncio.sleep(settings.RESYNC_METAGRAPH_INTERVAL)
             logger.info("Resyncing metagraph...")
-            instance.resync_metagraph()
+            try:
+                await instance.resync_metagraph()
+            except Exception as e:
+                # Keep serving requests with the previous metagraph
+                logger.exception(f"Metagraph resync failed: {e}")
     except asyncio.CancelledError:
         logger.info("Periodic metagraph resync task has been shutdown.")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global instance
+    instance = Neuron()
+
     # Startup logic: Start the periodic task
     task = asyncio.create_task(periodic_metagraph_resync())
     logger.info("Started the periodic metagraph resync background task.")
@@ -48,6 +65,7 @@ app = FastAPI(middleware=middleware, lifespan=lifespan)
     responses={
         200: {"model": StreamChunk},
         400: {"description": "Bad request"},
+        502: {"description": "No miner returned a usable completion (aggregated requests)"},
         504: {"description": "Timed out"},
     },
 )
@@ -57,7 +75,41 @@ async def chat(
     authorization: str = Depends(security),
 ):
     """Chat endpoint for the validator"""
-    return await instance.query_network(query)
+    return await instance.query_network(query, api_key=get_api_key(request.scope))
+
+
+@app.post(
+    "/chat/batch/",
+    responses={
+        200: {"model": BatchResult, "description": "One result per line (NDJSON), in the order the requests finish"},
+        400: {"description": "Bad request"},
+    },
+)
+async def chat_batch(
+    request: Request,
+    batch: QueryBatchRequest = Body(...),
+    authorization: str = Depends(security),
+):
+    """Batch endpoint, queries the network with many independent requests at once"""
+    return await instance.query_batch(batch, api_key=get_api_key(request.scope))
+
+
+@app.post(
+    "/v1/chat/completions",
+    responses={
+        200: {"description": "A chat completion, or server-sent chat completion chunks if 'stream' is true"},
+        400: {"description": "Bad request"},
+        502: {"description": "No miner returned a completion"},
+        504: {"description": "Timed out"},
+    },
+)
+async def chat_completions(
+    request: Request,
+    completion_request: ChatCompletionRequest = Body(...),
+    authorization: str = Depends(security),
+):
+    """OpenAI compatible chat completions endpoint, every selected miner's response is a choice"""
+    return await instance.chat_completions(completion_request)
 
 
 @app.post(
@@ -69,5 +121,20 @@ async def echo_stream(request: Request, query: QueryChatRequest, authorization:
     return await echo.echo_stream(request)
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+@app.get("/metrics/", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics(authorization: str = Depends(security)):
+    """Metrics of the API in the Prometheus text format"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
-    uvicorn.run("api:app", host="0.0.0.0", port=8000, loop="asyncio", reload=True)
+    if settings.WORKERS > 1:
+        # A single process syncs the metagraph and shares it with the workers
+        refresher = multiprocessing.get_context("spawn").Process(
+            target=run_refresher, name="metagraph-refresher", daemon=True
+        )
+        refresher.start()
+        uvicorn.run("api:app", host="0.0.0.0", port=8000, loop="asyncio", workers=settings.WORKERS)
+    else:
+        uvicorn.run("api:app", host="0.0.0.0", port=8000, loop="asyncio", reload=True)
@@ -0,0 +1,261 @@
+"""Load test of the `/chat/` endpoint against a simulated network.
+
+Runs the API in a separate process, with the dendrite and metagraph of the `Neuron` replaced by the stand-ins of
+`simulation.py`, and sends `--requests` requests over HTTP at each level of `--concurrency`. For each level, reports:
+
+- the requests per second, and the requests that failed (non 200 responses or connection errors)
+- the time to the first byte (TTFB) and the latency of the whole stream (p50 and p99)
+- the CPU time of the API process per chunk streamed to the clients (including the simulated network)
+- the growth of the resident memory of the API process per concurrent stream
+
+Usage:
+    python benchmarks/bench_load.py --concurrency 1,8,32,128 --requests 256 --chunks 100 --ttfb 0.2
+    python benchmarks/bench_load.py --query-validators --miners-per-validator 2 --error-rate 0.01 --json out.json
+    python benchmarks/bench_load.py --concurrency 8 --requests 64 --capture captures.bin
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import aiohttp
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def serve(args: argparse.Namespace):
+    """Runs the API against the simulated network (in the API process)"""
+    import uvicorn
+    from fastapi import FastAPI
+    from fastapi.middleware import Middleware
+    from loguru import logger
+
+    from network.meta.middlewares import AdmissionControlMiddleware, APIKeyMiddleware
+    from network.meta.schemas import QueryChatRequest
+    from network.neuron import Neuron
+    from network.utils import metrics
+    from network.utils.admission import KeyLimiter
+    from network.utils.stream_capture import StreamRecorder
+    from simulation import NetworkProfile, SimulatedDendrite, SimulatedMetagraph, SimulatedSubtensor, SimulatedWallet
+
+    logger.remove()
+    metagraph = SimulatedMetagraph(miners=args.miners, validators=args.validators, seed=args.seed)
+    profile = NetworkProfile(
+        ttfb=args.ttfb,
+        ttfb_sigma=args.ttfb_sigma,
+        chunk_interval=args.chunk_interval,
+        chunks=args.chunks,
+        chunk_size=args.chunk_size,
+        error_rate=args.error_rate,
+        split_rate=args.split_rate,
+        miners_per_validator=args.miners_per_validator,
+    )
+    neuron = Neuron(
+        wallet=SimulatedWallet(),
+        dendrite=SimulatedDendrite(metagraph, profile, seed=args.seed),
+        subtensor=SimulatedSubtensor(metagraph),
+    )
+    if args.capture:
+        neuron.recorder = StreamRecorder(args.capture, sample_rate=1.0)
+
+    # The load test is a single client, so it isn't limited per API key
+    app = FastAPI(
+        middleware=[
+            Middleware(APIKeyMiddleware, access_keys=[]),
+            Middleware(AdmissionControlMiddleware, limiter=KeyLimiter(max_concurrent=0, rate=0)),
+        ]
+    )
+
+    @app.post("/chat/")
+    async def chat(query: QueryChatRequest):
+        return await neuron.query_network(query)
+
+    @app.get("/bench/stats")
+    async def stats():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            "cpu_time": usage.ru_utime + usage.ru_stime,
+            "rss": current_rss(),
+            "chunks": sum(metrics.CHUNKS_STREAMED.values.values()),
+        }
+
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def current_rss() -> int:
+    """Resident memory of the process in bytes"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak rather than current memory where /proc isn't available (in KiB on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+async def send_request(session: aiohttp.ClientSession, url: str, body: dict) -> tuple[bool, float, float]:
+    """Sends a request and reads the whole stream, returns if it succeeded, the TTFB and the latency"""
+    start = time.perf_counter()
+    ttfb = None
+    try:
+        async with session.post(url, json=body) as response:
+            async for _ in response.content.iter_any():
+                ttfb = ttfb or time.perf_counter() - start
+            ok = response.status == 200
+    except aiohttp.ClientError:
+        ok = False
+    latency = time.perf_counter() - start
+    return ok, ttfb or latency, latency
+
+
+async def get_stats(session: aiohttp.ClientSession, base_url: str) -> dict:
+    async with session.get(f"{base_url}/bench/stats") as response:
+        return await response.json()
+
+
+async def run_level(
+    session: aiohttp.ClientSession, base_url: str, args: argparse.Namespace, concurrency: int, level: int
+) -> dict:
+    """Sends `args.requests` requests with `concurrency` requests in flight"""
+    results = []
+    next_request = 0
+
+    def request_body(i: int) -> dict:
+        # Distinct prompts, unless identical requests are tested, so requests aren't coalesced or cached
+        message = "Simulated prompt" if args.identical else f"Simulated prompt {level}-{i}"
+        return {
+            "k": args.k,
+            "roles": ["user"],
+            "messages": [message],
+            "timeout": args.timeout,
+            "query_validators": args.query_validators,
+            "sampling_mode": "random",
+            "stream_format": args.stream_format,
+        }
+
+    async def worker():
+        nonlocal next_request
+        while next_request < args.requests:
+            i, next_request = next_request, next_request + 1
+            results.append(await send_request(session, f"{base_url}/chat/", request_body(i)))
+
+    async def sample_rss(peak: list[int]):
+        while True:
+            peak[0] = max(peak[0], (await get_stats(session, base_url))["rss"])
+            await asyncio.sleep(0.2)
+
+    before = await get_stats(session, base_url)
+    peak_rss = [before["rss"]]
+    sampler = asyncio.create_task(sample_rss(peak_rss))
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - start
+    sampler.cancel()
+    after = await get_stats(session, base_url)
+
+    ok = np.array([result[0] for result in results])
+    ttfb = np.array([result[1] for result in results])[ok]
+    latency = np.array([result[2] for result in results])[ok]
+    chunks = after["chunks"] - before["chunks"]
+    return {
+        "concurrency": concurrency,
+        "requests_per_second": len(results) / duration,
+        "failed": int((~ok).sum()),
+        "ttfb_p50": float(np.percentile(ttfb, 50)) if ok.any() else None,
+        "ttfb_p99": float(np.percentile(ttfb, 99)) if ok.any() else None,
+        "latency_p50": float(np.percentile(latency, 50)) if ok.any() else None,
+        "latency_p99": float(np.percentile(latency, 99)) if ok.any() else None,
+        "chunks": chunks,
+        "cpu_per_chunk": (after["cpu_time"] - before["cpu_time"]) / chunks if chunks else None,
+        "rss_per_stream": (peak_rss[0] - before["rss"]) / concurrency,
+    }
+
+
+async def wait_until_ready(session: aiohttp.ClientSession, base_url: str, server: multiprocessing.Process):
+    deadline = time.perf_counter() + 60
+    while time.perf_counter() < deadline:
+        if not server.is_alive():
+            raise RuntimeError("The API process exited")
+        try:
+            return await get_stats(session, base_url)
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.1)
+    raise TimeoutError("The API didn't start in time")
+
+
+def format_seconds(value) -> str:
+    return "-" if value is None else f"{value * 1000:.1f}ms"
+
+
+async def main(args: argparse.Namespace, server: multiprocessing.Process) -> list[dict]:
+    base_url = f"http://127.0.0.1:{args.port}"
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+        await wait_until_ready(session, base_url, server)
+        print(
+            f"{'concurrency':>11} {'req/s':>9} {'failed':>7} {'TTFB p50':>10} {'TTFB p99':>10} "
+            f"{'lat. p50':>10} {'lat. p99':>10} {'CPU/chunk':>10} {'RSS/stream':>11}"
+        )
+        reports = []
+        for level, concurrency in enumerate(args.concurrency):
+            report = await run_level(session, base_url, args, concurrency, level)
+            cpu_per_chunk = report["cpu_per_chunk"]
+            print(
+                f"{concurrency:>11} {report['requests_per_second']:>9.1f} {report['failed']:>7} "
+                f"{format_seconds(report['ttfb_p50']):>10} {format_seconds(report['ttfb_p99']):>10} "
+                f"{format_seconds(report['latency_p50']):>10} {format_seconds(report['latency_p99']):>10} "
+                f"{'-' if cpu_per_chunk is None else f'{cpu_per_chunk * 1e6:.1f}us':>10} "
+                f"{report['rss_per_stream'] / 1024:>9.1f}KB"
+            )
+            reports.append(report)
+        return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--concurrency",
+        type=lambda value: [int(level) for level in value.split(",")],
+        default=[1, 8, 32, 128],
+        help="Comma-separated levels of requests in flight",
+    )
+    parser.add_argument("--requests", type=int, default=256, help="Number of requests per concurrency level")
+    parser.add_argument("--port", type=int, default=8123, help="Port of the API process")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the simulated network")
+    parser.add_argument("--json", help="Writes the reports to this JSON file, to compare runs")
+    parser.add_argument("--capture", help="Records the upstream streams of every request to this file")
+    request = parser.add_argument_group("requests")
+    request.add_argument("--k", type=int, default=1, help="Number of miners per request")
+    request.add_argument("--query-validators", action="store_true", help="Query validators rather than miners")
+    request.add_argument("--stream-format", choices=["full", "delta"], default="full")
+    request.add_argument("--timeout", type=int, default=10, help="Timeout of the requests in seconds")
+    request.add_argument("--identical", action="store_true", help="Send the same prompt in every request")
+    network = parser.add_argument_group("simulated network")
+    network.add_argument("--miners", type=int, default=256)
+    network.add_argument("--validators", type=int, default=8)
+    network.add_argument("--ttfb", type=float, default=0.2, help="Median time to the first chunk in seconds")
+    network.add_argument("--ttfb-sigma", type=float, default=0.5, help="Sigma of the log-normal TTFB")
+    network.add_argument("--chunk-interval", type=float, default=0.01, help="Mean time between chunks in seconds")
+    network.add_argument("--chunks", type=int, default=100, help="Number of chunks per response")
+    network.add_argument("--chunk-size", type=int, default=16, help="Number of characters per chunk")
+    network.add_argument("--error-rate", type=float, default=0.0, help="Share of the streams that fail")
+    network.add_argument("--split-rate", type=float, default=0.3, help="Share of the validator reads that are split")
+    network.add_argument("--miners-per-validator", type=int, default=1)
+    args = parser.parse_args()
+
+    server = multiprocessing.get_context("spawn").Process(target=serve, args=(args,), daemon=True)
+    server.start()
+    try:
+        reports = asyncio.run(main(args, server))
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"args": vars(args), "reports": reports}, file, indent=4)
@@ -0,0 +1,125 @@
+"""Benchmark of the forwarding of streamed chunks through the middleware stack.
+
+Streams `--chunks` chunks from a `/chat/` endpoint through the app without middlewares, through the previous
+`BaseHTTPMiddleware` API key middleware, and through the current ASGI middleware stack (API key and admission
+control). The app is called directly as an ASGI app, so only the framework and middlewares are measured.
+
+Usage:
+    python benchmarks/bench_middleware.py --chunks 5000 --repeat 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import FastAPI, Request, Response  # noqa: E402
+from fastapi.middleware import Middleware  # noqa: E402
+from fastapi.responses import StreamingResponse  # noqa: E402
+from loguru import logger  # noqa: E402
+from starlette.middleware.base import BaseHTTPMiddleware  # noqa: E402
+
+from network.meta.middlewares import AdmissionControlMiddleware, APIKeyMiddleware  # noqa: E402
+from network.utils.admission import KeyLimiter  # noqa: E402
+
+ACCESS_KEY = "bench-key"
+
+
+class LegacyAPIKeyMiddleware(BaseHTTPMiddleware):
+    """The API key middleware as it was before, as a `BaseHTTPMiddleware`"""
+
+    async def dispatch(self, request: Request, call_next):
+        logger.info(f"Request: {request.url.path}")
+        access_key = request.headers.get("api_key")
+        if request.url.path.startswith(("/docs", "/openapi.json", "/static/swagger")):
+            return await call_next(request)
+        elif access_key != ACCESS_KEY:
+            return Response(status_code=401, content="Please provide a valid access key")
+        return await call_next(request)
+
+
+def create_app(middleware: list[Middleware], n_chunks: int, chunk: bytes) -> FastAPI:
+    app = FastAPI(middleware=middleware)
+
+    @app.post("/chat/")
+    async def chat():
+        async def stream():
+            for _ in range(n_chunks):
+                yield chunk
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+async def request(app: FastAPI) -> tuple[int, int]:
+    """Sends a request to the app, returns the number of body messages and bytes received"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/chat/",
+        "raw_path": b"/chat/",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"api_key", ACCESS_KEY.encode()), (b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 12345),
+        "server": ("127.0.0.1", 8000),
+    }
+    request_sent = False
+    disconnected = asyncio.Event()
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # The client stays connected until the whole response is received
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    messages, total_bytes = 0, 0
+
+    async def send(message):
+        nonlocal messages, total_bytes
+        if message["type"] == "http.response.body":
+            messages += 1
+            total_bytes += len(message.get("body", b""))
+
+    await app(scope, receive, send)
+    disconnected.set()
+    return messages, total_bytes
+
+
+def run(name: str, app: FastAPI, n_chunks: int, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        messages, total_bytes = asyncio.run(request(app))
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<28} {n_chunks / best:>12,.0f} chunks/s {total_bytes / best / 1e6:>10,.1f} MB/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=5000, help="Number of chunks per stream")
+    parser.add_argument("--chunk-size", type=int, default=256, help="Size of every chunk in bytes")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs, the best one is reported")
+    args = parser.parse_args()
+    logger.remove()
+
+    chunk = b"x" * args.chunk_size
+    stacks = {
+        "no middleware": [],
+        "before (BaseHTTPMiddleware)": [Middleware(LegacyAPIKeyMiddleware)],
+        "after (ASGI)": [
+            Middleware(APIKeyMiddleware, access_keys=[ACCESS_KEY]),
+            Middleware(AdmissionControlMiddleware, limiter=KeyLimiter()),
+        ],
+    }
+    for name, middleware in stacks.items():
+        run(name, create_app(middleware, args.chunks, chunk), args.chunks, args.repeat)
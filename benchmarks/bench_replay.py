@@ -0,0 +1,62 @@
+"""Replays recorded upstream streams through `StreamManager`.
+
+Reads the captures recorded to `CAPTURE_PATH` (see `network/utils/stream_capture.py`) and feeds the upstream
+streams of every request back into `StreamManager.stream_generator`, with the parameters of the original request, at
+`--speed` times real time (0 replays as fast as possible to measure the throughput of `StreamManager`).
+
+Captures of simulated traffic can be recorded with the load test:
+    python benchmarks/bench_load.py --concurrency 8 --requests 64 --capture captures.bin
+
+Usage:
+    python benchmarks/bench_replay.py captures.bin --speed 0 --repeat 5
+    python benchmarks/bench_replay.py captures.bin --speed 1 --print
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger  # noqa: E402
+
+from network.stream_manager import StreamManager  # noqa: E402
+from network.utils.stream_capture import Capture, read_captures, replay_streams  # noqa: E402
+
+
+async def replay(capture: Capture, speed: float, print_chunks: bool) -> tuple[int, int]:
+    """Replays a capture, returns the number of chunks and bytes streamed"""
+    stream_manager = StreamManager(capture.request)
+    chunks = total_bytes = 0
+    async for chunk in stream_manager.stream_generator(replay_streams(capture, speed), capture.stream_uids):
+        chunks += 1
+        total_bytes += len(chunk)
+        if print_chunks:
+            print(chunk.decode("utf-8"))
+    return chunks, total_bytes
+
+
+async def main(captures: list[Capture], speed: float, print_chunks: bool) -> tuple[int, int]:
+    results = [await replay(capture, speed, print_chunks) for capture in captures]
+    return sum(chunks for chunks, _ in results), sum(total_bytes for _, total_bytes in results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="Capture file written by the stream recorder")
+    parser.add_argument("--speed", type=float, default=0, help="Replay speed relative to real time (0 = no waits)")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of runs, the best one is reported")
+    parser.add_argument("--print", action="store_true", help="Prints the streamed chunks")
+    args = parser.parse_args()
+    if not args.print:
+        logger.remove()
+
+    captures = list(read_captures(args.path))
+    print(f"Replaying {len(captures)} captures of {args.path}")
+    best = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        chunks, total_bytes = asyncio.run(main(captures, args.speed, args.print))
+        best = min(best, time.perf_counter() - start)
+    print(f"{chunks} chunks, {total_bytes / 1e6:.1f} MB in {best:.3f}s: {chunks / best:,.0f} chunks/s")
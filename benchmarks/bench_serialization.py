@@ -0,0 +1,92 @@
+"""Microbenchmark of the serialization of streamed chunks.
+
+Compares the previous path (validated `StreamChunk` -> `dict()` -> `json.dumps(indent=4)`) with the template
+encoder used by `StreamManager`, for streams of `--chunks` chunks in both stream formats.
+
+Usage:
+    python benchmarks/bench_serialization.py --chunks 500 --repeat 5
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from network.meta.schemas import StreamChunk  # noqa: E402
+
+
+def legacy_stream(n_chunks: int, delta: str) -> int:
+    """Serializes a stream the way `process_chunk` and `StreamChunk.encode` used to"""
+    accumulated_chunks, accumulated_timings = [], []
+    total_bytes = 0
+    for i in range(n_chunks):
+        accumulated_chunks.append(delta)
+        accumulated_timings.append(i * 0.01)
+        chunk = StreamChunk(
+            delta=delta,
+            finish_reason=None,
+            accumulated_chunks=accumulated_chunks,
+            accumulated_timings=accumulated_timings,
+            timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            sequence_number=i + 1,
+            miner_uid=1,
+            validator_uid=-1,
+        )
+        total_bytes += len(json.dumps(chunk.model_dump(exclude={"timing"}), indent=4).encode("utf-8"))
+    return total_bytes
+
+
+def fast_stream(n_chunks: int, delta: str, compact: bool) -> int:
+    """Serializes a stream the way `process_chunk` and `StreamChunk.encode` do now"""
+    accumulated_chunks, accumulated_timings = [], []
+    total_bytes = 0
+    for i in range(n_chunks):
+        accumulated_chunks.append(delta)
+        accumulated_timings.append(i * 0.01)
+        if compact:
+            chunk = StreamChunk.model_construct(
+                delta=delta,
+                finish_reason=None,
+                timing=i * 0.01,
+                timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                sequence_number=i + 1,
+                miner_uid=1,
+                validator_uid=-1,
+            )
+        else:
+            chunk = StreamChunk.model_construct(
+                delta=delta,
+                finish_reason=None,
+                accumulated_chunks=accumulated_chunks,
+                accumulated_timings=accumulated_timings,
+                timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                sequence_number=i + 1,
+                miner_uid=1,
+                validator_uid=-1,
+            )
+        total_bytes += len(chunk.encode("utf-8", compact=compact))
+    return total_bytes
+
+
+def run(name: str, fn, n_chunks: int, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        total_bytes = fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<28} {n_chunks / best:>12,.0f} chunks/s {total_bytes / n_chunks:>12,.0f} bytes/chunk")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=500, help="Number of chunks per stream")
+    parser.add_argument("--delta", type=str, default="the quick brown fox ", help="Text of every chunk")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs, the best one is reported")
+    args = parser.parse_args()
+
+    run("before (full)", lambda: legacy_stream(args.chunks, args.delta), args.chunks, args.repeat)
+    run("after (full)", lambda: fast_stream(args.chunks, args.delta, compact=False), args.chunks, args.repeat)
+    run("after (delta)", lambda: fast_stream(args.chunks, args.delta, compact=True), args.chunks, args.repeat)
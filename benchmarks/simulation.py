@@ -0,0 +1,179 @@
+"""Local stand-ins for the bittensor network, to run the API without a wallet or live tao.
+
+`SimulatedSubtensor` syncs a `SimulatedMetagraph` of validators and miners, and `SimulatedDendrite` streams
+responses the way `StreamPromptingSynapse` streams arrive from the network: miners stream raw text, validators
+stream the responses of the miners they query as concatenated JSON objects (`{"uid": ..., "chunk": ...}{...}`)
+which may be split at any point across reads, and every stream ends with the synapse. The latencies, chunk sizes and
+error rates are set by a `NetworkProfile`.
+
+Usage:
+    metagraph = SimulatedMetagraph(miners=256, validators=8)
+    neuron = Neuron(
+        wallet=SimulatedWallet(),
+        dendrite=SimulatedDendrite(metagraph, NetworkProfile(ttfb=0.2, chunks=100)),
+        subtensor=SimulatedSubtensor(metagraph),
+    )
+"""
+import asyncio
+import copy
+import json
+import math
+import random
+import time
+from typing import AsyncIterator, NamedTuple
+
+import numpy as np
+
+import settings
+
+TEXT = (
+    "The quick brown fox jumps over the lazy dog while the miners of the subnet stream their completions back to "
+    "the validators, one token at a time. "
+)
+
+
+class NetworkProfile(NamedTuple):
+    """How the simulated miners and validators respond"""
+
+    # Median time to the first chunk in seconds, drawn from a log-normal distribution with this sigma
+    ttfb: float = 0.2
+    ttfb_sigma: float = 0.5
+    # Mean time between chunks in seconds, drawn from an exponential distribution (0 = no wait)
+    chunk_interval: float = 0.01
+    # Number of chunks per response, and characters per chunk
+    chunks: int = 100
+    chunk_size: int = 16
+    # Share of the streams that fail: miners drop the connection and validators stream an error message
+    error_rate: float = 0.0
+    # Share of the reads of validator streams that end at an arbitrary point within a JSON object
+    split_rate: float = 0.3
+    # Number of miners each validator streams the responses of
+    miners_per_validator: int = 1
+
+
+class SimulatedAxon:
+    def __init__(self, uid: int):
+        self.uid = uid
+        self.hotkey = f"simulated-hotkey-{uid}"
+        self.coldkey = f"simulated-coldkey-{uid}"
+        self.ip = f"10.0.{uid // 256}.{uid % 256}"
+        self.port = 8091
+        self.is_serving = True
+
+
+class SimulatedMetagraph:
+    """Metagraph of `validators` validators (the first UIDs) and `miners` miners"""
+
+    def __init__(self, miners: int, validators: int, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.n = validators + miners
+        self.axons = [SimulatedAxon(uid) for uid in range(self.n)]
+        self.hotkeys = [axon.hotkey for axon in self.axons]
+        self.validator_uids = list(range(validators))
+        self.miner_uids = list(range(validators, self.n))
+
+        is_validator = np.arange(self.n) < validators
+        self.S = np.where(is_validator, 10.0 * settings.VALIDATOR_MIN_STAKE, 0.0)
+        self.validator_permit = is_validator
+        self.active = is_validator
+        self.I = np.where(is_validator, 0.0, rng.random(self.n))
+
+
+class SimulatedSubtensor:
+    def __init__(self, metagraph: SimulatedMetagraph):
+        self._metagraph = metagraph
+
+    def metagraph(self, netuid: int) -> SimulatedMetagraph:
+        return self._metagraph
+
+
+class SimulatedHotkey:
+    ss58_address = "simulated-api-hotkey"
+
+
+class SimulatedWallet:
+    """Wallet of the API, which isn't registered in the simulated metagraph"""
+
+    hotkey = SimulatedHotkey()
+
+
+class SimulatedDendrite:
+    """Streams simulated responses from the axons of a `SimulatedMetagraph`, with the interface of `bt.dendrite`"""
+
+    def __init__(self, metagraph: SimulatedMetagraph, profile: NetworkProfile = NetworkProfile(), seed: int = 0):
+        self.metagraph = metagraph
+        self.profile = profile
+        self.rng = random.Random(seed)
+        # The chunks are slices of a long text, so simulating them costs next to nothing compared to the API
+        self.text = TEXT * math.ceil(profile.chunks * profile.chunk_size / len(TEXT) + 2)
+
+    async def __call__(
+        self, axons: list, synapse, timeout: float, deserialize: bool = False, streaming: bool = True
+    ) -> list[AsyncIterator]:
+        return [self.stream(axon, copy.deepcopy(synapse), timeout) for axon in axons]
+
+    async def stream(self, axon: SimulatedAxon, synapse, timeout: float) -> AsyncIterator:
+        """Streams the response of the axon, then its synapse (with a 408 status if it timed out)"""
+        profile = self.profile
+        deadline = time.perf_counter() + timeout
+        is_validator = axon.uid in self.metagraph.validator_uids
+        failed_chunk = self.rng.randrange(profile.chunks) if self.rng.random() < profile.error_rate else None
+        if is_validator:
+            miner_uids = self.rng.sample(self.metagraph.miner_uids, profile.miners_per_validator)
+            pending = ""
+
+        ttfb = self.rng.lognormvariate(math.log(profile.ttfb), profile.ttfb_sigma) if profile.ttfb > 0 else 0
+        if not await self.sleep(ttfb, deadline):
+            yield self.finish(synapse, status_code=408)
+            return
+
+        for i in range(profile.chunks):
+            if i and not await self.sleep(self.chunk_interval(), deadline):
+                yield self.finish(synapse, status_code=408)
+                return
+            if not is_validator:
+                if i == failed_chunk:
+                    raise ConnectionResetError(f"Simulated miner UID {axon.uid} dropped the connection")
+                yield self.chunk(axon.uid, i)
+                continue
+
+            if i == failed_chunk:
+                frames = json.dumps({"uid": miner_uids[0], "message": "Simulated miner error"})
+            else:
+                frames = "".join(f'{{"uid": {uid}, "chunk": {json.dumps(self.chunk(uid, i))}}}' for uid in miner_uids)
+            # Reads end at arbitrary points, so the rest of a split frame is read along with the next ones (`}{`)
+            frames, pending = pending + frames, ""
+            if i < profile.chunks - 1 and i != failed_chunk and self.rng.random() < profile.split_rate:
+                split = self.rng.randrange(1, len(frames))
+                frames, pending = frames[:split], frames[split:]
+            yield frames
+            if i == failed_chunk:
+                break
+
+        yield self.finish(synapse, status_code=200)
+
+    def chunk(self, miner_uid: int, i: int) -> str:
+        """The i-th chunk of the response of a miner, each miner starts at its own offset in the text"""
+        start = miner_uid * 7 % len(TEXT) + i * self.profile.chunk_size
+        return self.text[start : start + self.profile.chunk_size]
+
+    def chunk_interval(self) -> float:
+        if self.profile.chunk_interval <= 0:
+            return 0
+        return self.rng.expovariate(1 / self.profile.chunk_interval)
+
+    @staticmethod
+    async def sleep(delay: float, deadline: float) -> bool:
+        """Sleeps for `delay` seconds, returns False if the deadline is reached first"""
+        if (remaining := deadline - time.perf_counter()) < delay:
+            await asyncio.sleep(max(remaining, 0))
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+    @staticmethod
+    def finish(synapse, status_code: int):
+        # The dendrite reports the status of the request through the terminal info of the synapse
+        if (terminal := getattr(synapse, "dendrite", None)) is not None:
+            terminal.status_code = status_code
+        return synapse
@@ -1,34 +1,104 @@
-from fastapi import Request, Response
+import hmac
+from fastapi import Response
 from fastapi.middleware import Middleware
-from starlette.middleware.base import BaseHTTPMiddleware
+from http import HTTPStatus
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Receive, Scope, Send
+from typing import Optional
 import settings
 from loguru import logger
 
+from network.utils.admission import AdmissionRejected, KeyLimiter, retry_after_header
 
-class APIKeyMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        logger.info(f"Request: {request.url.path}")
-        access_key = request.headers.get("api_key")
-        if (
-            request.url.path.startswith("/docs")
-            or request.url.path.startswith("/openapi.json")
-            or request.url.path.startswith("/static/swagger")
-        ):
-            # Skip checks when accessing OpenAPI documentation.
-            logger.info("user is from swagger!")
-            return await call_next(request)
-        # Check access key
-        elif (
-            settings.EXPECTED_ACCESS_KEY is not None
-            and settings.EXPECTED_ACCESS_KEY != ""
-            and access_key != settings.EXPECTED_ACCESS_KEY
-        ):
-            logger.error(f"Invalid access key: {access_key}")
-            return Response(status_code=401, content="Please provide a valid access key")
+# Endpoints of the OpenAPI documentation, which are accessible without an API key
+DOCS_PATHS = ("/docs", "/openapi.json", "/static/swagger")
+
+# Endpoints that query the network, and so are subject to admission control
+ADMITTED_PATHS = ("/chat", "/v1/chat")
+
+# The middlewares are plain ASGI apps rather than `BaseHTTPMiddleware`s, which run the rest of the stack in a
+# separate task and forward every chunk of streamed responses through a memory stream. Here `send` is passed
+# through untouched.
+
+
+def get_api_key(scope: Scope) -> Optional[str]:
+    """The API key of the request, from the `api_key` header or (as sent by OpenAI clients) a bearer token"""
+    headers = Headers(scope=scope)
+    if (api_key := headers.get("api_key")) is not None:
+        return api_key
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token.strip():
+        return token.strip()
+    return None
+
+
+class APIKeyMiddleware:
+    """Rejects the requests without a valid API key with a 401, unless no API key is expected"""
+
+    def __init__(self, app: ASGIApp, access_keys: Optional[list[str]] = None):
+        self.app = app
+        access_keys = settings.EXPECTED_ACCESS_KEYS if access_keys is None else access_keys
+        self.access_keys = [access_key.encode("utf-8") for access_key in access_keys]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        logger.debug("Request: {}", scope["path"])
+        if not self.access_keys or scope["path"].startswith(DOCS_PATHS):
+            # Skip checks when no API key is expected or when accessing OpenAPI documentation.
+            return await self.app(scope, receive, send)
+
+        if not self.is_valid(get_api_key(scope)):
+            logger.error("Invalid access key")
+            response = Response(status_code=HTTPStatus.UNAUTHORIZED, content="Please provide a valid access key")
+            return await response(scope, receive, send)
 
         # Continue to the next handler if the API key is valid
-        response = await call_next(request)
-        return response
+        await self.app(scope, receive, send)
+
+    def is_valid(self, access_key: Optional[str]) -> bool:
+        """Whether the key is one of the expected keys, compared in constant time so it can't be guessed by timing"""
+        if access_key is None:
+            return False
+        access_key = access_key.encode("utf-8")
+        valid = False
+        for expected_key in self.access_keys:
+            # Every key is compared, so the time doesn't tell which key matched either
+            valid |= hmac.compare_digest(access_key, expected_key)
+        return valid
+
+
+class AdmissionControlMiddleware:
+    """Limits the concurrent requests and the request rate of each API key on the endpoints that query the network.
+    The number of upstream streams opened across all keys is limited by `Neuron.stream_limiter`.
+    """
+
+    def __init__(self, app: ASGIApp, limiter: Optional[KeyLimiter] = None):
+        self.app = app
+        self.limiter = limiter or KeyLimiter()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not scope["path"].startswith(ADMITTED_PATHS):
+            return await self.app(scope, receive, send)
+
+        # Requests without an API key (when none is expected) are limited by client
+        key = get_api_key(scope) or (scope["client"][0] if scope.get("client") else "")
+        try:
+            self.limiter.acquire(key)
+        except AdmissionRejected as e:
+            response = Response(
+                status_code=HTTPStatus.TOO_MANY_REQUESTS,
+                content=f"Too many requests ({e.reason}), please retry later",
+                headers=retry_after_header(e.retry_after),
+            )
+            return await response(scope, receive, send)
+
+        try:
+            # The app returns once the whole response, including streamed responses, has been sent
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.release(key)
 
 
-middleware = [Middleware(APIKeyMiddleware)]
+middleware = [Middleware(APIKeyMiddleware), Middleware(AdmissionControlMiddleware)]
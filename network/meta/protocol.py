@@ -1,4 +1,5 @@
 
+import codecs
 import pydantic
 import bittensor as bt
 from typing import List, AsyncIterator
@@ -68,15 +69,32 @@ class StreamPromptingSynapse(bt.StreamingSynapse):
         description="Completion status of the current PromptingSynapse object. This attribute is mutable and can be updated.",
     )
 
+    # Streamed tokens that have not been joined into `completion` yet
+    _completion_chunks: List[str] = pydantic.PrivateAttr(default_factory=list)
+    _keep_completion: bool = pydantic.PrivateAttr(True)
+
+    def stream_only(self) -> "StreamPromptingSynapse":
+        """
+        Stops accumulating the streamed tokens into the `completion` attribute, for when the tokens are only forwarded
+        as they are received (as the API does). The `completion` attribute then stays empty.
+
+        Returns:
+            StreamPromptingSynapse: this synapse.
+        """
+        self._keep_completion = False
+        return self
+
     async def process_streaming_response(self, response: StreamingResponse) -> AsyncIterator[str]:
         """
         `process_streaming_response` is an asynchronous method designed to process the incoming streaming response from the
         Bittensor network. It's the heart of the StreamPromptingSynapse class, ensuring that streaming tokens, which represent
         prompts or messages, are decoded and appropriately managed.
 
-        As the streaming response is consumed, the tokens are decoded from their 'utf-8' encoded format, split based on
-        newline characters, and concatenated into the `completion` attribute. This accumulation of decoded tokens in the
-        `completion` attribute allows for a continuous and coherent accumulation of the streaming content.
+        As the streaming response is consumed, the tokens are incrementally decoded from their 'utf-8' encoded format
+        (a multibyte character may be split across chunks), and accumulated into the `completion` attribute. This
+        accumulation of decoded tokens in the `completion` attribute allows for a continuous and coherent accumulation
+        of the streaming content. The tokens are only joined into `completion` when it is read through `deserialize`
+        or `extract_response_json`, rather than copying the whole completion for every token.
 
         Args:
             response: The streaming response object containing the content chunks to be processed. Each chunk in this
@@ -86,12 +104,33 @@ class StreamPromptingSynapse(bt.StreamingSynapse):
         if self.completion is None:
             self.completion = ""
 
+        # Copies of the synapse (one per axon) share their private attributes, so each stream gets its own list
+        self._completion_chunks = completion_chunks = []
+        keep_completion = self._keep_completion
+
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
         async for chunk in response.content.iter_any():
-            tokens = chunk.decode("utf-8")
+            tokens = decoder.decode(chunk)
+            if not tokens:
+                # Only received the start of a multibyte character
+                continue
+
+            if keep_completion:
+                completion_chunks.append(tokens)
+            yield tokens
 
-            self.completion = self.completion + tokens
+        if tokens := decoder.decode(b"", final=True):
+            if keep_completion:
+                completion_chunks.append(tokens)
             yield tokens
 
+    def _join_completion(self) -> str:
+        """Joins the tokens streamed so far into the `completion` attribute"""
+        if self._completion_chunks:
+            self.completion = self.completion + "".join(self._completion_chunks)
+            self._completion_chunks.clear()
+        return self.completion
+
     def deserialize(self) -> str:
         """
         Deserializes the response by returning the completion attribute.
@@ -99,7 +138,7 @@ class StreamPromptingSynapse(bt.StreamingSynapse):
         Returns:
             str: The completion result.
         """
-        return self.completion
+        return self._join_completion()
 
     def extract_response_json(self, response: StreamingResponse) -> dict:
         """
@@ -137,5 +176,5 @@ class StreamPromptingSynapse(bt.StreamingSynapse):
             "axon": extract_info("bt_header_axon"),
             "roles": self.roles,
             "messages": self.messages,
-            "completion": self.completion,
+            "completion": self._join_completion(),
         }
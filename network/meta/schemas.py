@@ -1,6 +1,8 @@
-from pydantic import BaseModel, Field
-from typing import Optional, Literal
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Optional, Literal, Union
+import hashlib
 import json
+from json.encoder import encode_basestring_ascii
 
 
 class QueryChatRequest(BaseModel):
@@ -13,10 +15,67 @@ class QueryChatRequest(BaseModel):
     messages: list[str] = Field(..., description="The messages to be sent to the network.")
     timeout: Optional[int] = Field(5, description="The time in seconds to wait for a response.")
     query_validators: Optional[bool] = Field(True, description="Whether to query validators.")
-    sampling_mode: Literal["random", "list", "top_incentive"] = Field(
+    sampling_mode: Literal["random", "list", "top_incentive", "fastest"] = Field(
         "list", description="The mode of sampling the miners."
     )
     uid_list: Optional[list[int]] = Field([5], description="List of uids to sample from, if sampling_mode is 'list'.")
+    stream_format: Literal["full", "delta"] = Field(
+        "full",
+        description="The format of the streamed chunks. 'delta' only sends the new chunk and its timing, "
+        "the accumulated response is sent once in the 'completed' chunk of each miner.",
+    )
+    hedge: Optional[bool] = Field(
+        False,
+        description="Whether to send the prompt to a backup validator if the queried validator hasn't responded "
+        "after 'hedge_delay' seconds. The first validator to respond is streamed and the other one is cancelled.",
+    )
+    hedge_delay: Optional[float] = Field(
+        None,
+        description="The time in seconds to wait for the first chunk before hedging, defaults to a percentile of "
+        "the recent times to first chunk.",
+    )
+    cache: Optional[bool] = Field(
+        False,
+        description="Whether to answer from (and store the completion in) the completion cache.",
+    )
+    cache_replay: Literal["stream", "json"] = Field(
+        "stream",
+        description="How a cached completion is returned, either replayed as a stream or as a single JSON list of "
+        "the 'completed' chunks of each miner.",
+    )
+    aggregate: Optional[bool] = Field(
+        False,
+        description="Whether to return a single JSON completion instead of streaming the responses: the completion of "
+        "the k miners that the other completions agree with the most, leaving out empty or degenerate completions.",
+    )
+    quorum: Optional[int] = Field(
+        None,
+        description="The number of similar completions after which an aggregated request returns, without waiting "
+        "for the other miners. Defaults to a majority of k.",
+    )
+    first_chunk_timeout: Optional[float] = Field(
+        None, description="The time in seconds each upstream stream has to send its first chunk before it is dropped."
+    )
+    idle_timeout: Optional[float] = Field(
+        None, description="The time in seconds an upstream stream can go without sending a chunk before it is dropped."
+    )
+    total_timeout: Optional[float] = Field(
+        None,
+        description="The maximum duration in seconds of each upstream stream, longer streams are dropped. When it is "
+        "longer than timeout, it bounds the whole request instead of timeout.",
+    )
+
+    def stream_timeout(self) -> float:
+        """The time in seconds the upstream streams (and so the whole request) can last"""
+        return max(self.timeout, self.total_timeout or 0)
+
+    def canonical_key(self) -> str:
+        """Hash of the request, identical requests (e.g. retries) have the same key whatever their JSON formatting"""
+        # How the completion is cached doesn't change the completion
+        canonical = json.dumps(
+            self.model_dump(exclude={"cache", "cache_replay"}), sort_keys=True, separators=(",", ":")
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
 
 
 class StreamChunk(BaseModel):
@@ -24,14 +83,102 @@ class StreamChunk(BaseModel):
     finish_reason: Optional[str] = Field(None, description="The reason for the response completion, if applicable.")
     accumulated_chunks: list[str] = Field(None, description="All accumulated chunks of responses.")
     accumulated_timings: list[float] = Field(None, description="Timing for each chunk received.")
+    timing: Optional[float] = Field(None, description="Timing of this chunk (only sent in the 'delta' stream format).")
     timestamp: str = Field(..., description="The timestamp at which the chunk was processed.")
     sequence_number: int = Field(..., description="A sequential identifier for the response part.")
     miner_uid: int = Field(..., description="The miner identifier for the selected response source.")
     validator_uid: int = Field(..., description="The validator identifier for the selected response source.")
 
-    def encode(self, encoding: str) -> bytes:
-        data = json.dumps(self.dict(), indent=4)
-        return data.encode(encoding)
+    def encode(self, encoding: str, compact: bool = False) -> bytes:
+        return encode_stream_chunk(self, compact).encode(encoding)
+
+
+class AggregatedCompletion(BaseModel):
+    completion: str = Field(..., description="The completion chosen by consensus of the miners.")
+    miner_uid: int = Field(..., description="The miner identifier of the chosen completion.")
+    validator_uid: int = Field(..., description="The validator identifier of the chosen completion.")
+    agreement: int = Field(..., description="The number of completions similar to the chosen one (including itself).")
+    similarity: float = Field(..., description="The mean similarity of the chosen completion to the other ones.")
+    completions: int = Field(..., description="The number of completions that were compared.")
+    dropped: int = Field(..., description="The number of empty, degenerate or failed completions left out.")
+
+
+class QueryBatchRequest(BaseModel):
+    requests: list[QueryChatRequest] = Field(..., description="The independent requests to send to the network.")
+    parallelism: Optional[int] = Field(
+        None,
+        description="The maximum number of requests of the batch that query the network at the same time. Defaults to "
+        "(and is capped by) BATCH_MAX_PARALLELISM.",
+    )
+
+
+class BatchResult(BaseModel):
+    index: int = Field(..., description="The position of the request in the batch.")
+    status_code: int = Field(..., description="The HTTP status of the request (200 if it succeeded).")
+    responses: Optional[list[StreamChunk]] = Field(
+        None, description="The 'completed' chunk of each selected miner, with its accumulated chunks and timings."
+    )
+    aggregated_completion: Optional[AggregatedCompletion] = Field(
+        None, description="The completion chosen by consensus (aggregated requests)."
+    )
+    error: Optional[str] = Field(None, description="Why the request failed, if it did.")
+
+
+class ChatMessage(BaseModel):
+    role: str = Field(..., description="The role of the author of the message (system, user or assistant).")
+    content: Union[str, list[dict]] = Field(
+        ..., description="The text of the message, or a list of content parts of which the text parts are sent."
+    )
+
+    @property
+    def text(self) -> str:
+        if isinstance(self.content, str):
+            return self.content
+        return "".join(part.get("text", "") for part in self.content if part.get("type") == "text")
+
+
+# The fields of `QueryChatRequest` that are set from the fields of the OpenAI chat completions request rather than
+# passed through
+CHAT_COMPLETION_MAPPED_FIELDS = {
+    "k",
+    "roles",
+    "messages",
+    "stream_format",
+    "aggregate",
+    "quorum",
+    "cache",
+    "cache_replay",
+}
+
+
+class ChatCompletionRequest(BaseModel):
+    """A request of the OpenAI chat completions API. The other fields of `QueryChatRequest` (e.g. `sampling_mode` or
+    `timeout`) can be added to it, the fields of the OpenAI API that the network doesn't support are ignored.
+    """
+
+    model_config = ConfigDict(extra="allow")
+
+    model: str = Field("sn1", description="Echoed back in the completions, the miners pick the model.")
+    messages: list[ChatMessage] = Field(..., description="The messages of the conversation.")
+    stream: Optional[bool] = Field(
+        False, description="Whether to stream the completions as server-sent events, ended by 'data: [DONE]'."
+    )
+    n: Optional[int] = Field(1, description="The number of miners to stream completions from, one choice each.")
+
+    def to_query_request(self) -> QueryChatRequest:
+        """The equivalent `/chat` request, streamed in the "delta" format"""
+        extra = {
+            name: value
+            for name, value in (self.model_extra or {}).items()
+            if name in QueryChatRequest.model_fields and name not in CHAT_COMPLETION_MAPPED_FIELDS
+        }
+        return QueryChatRequest(
+            k=self.n,
+            roles=[message.role for message in self.messages],
+            messages=[message.text for message in self.messages],
+            stream_format="delta",
+            **extra,
+        )
 
 
 class StreamError(BaseModel):
@@ -39,9 +186,101 @@ class StreamError(BaseModel):
     timestamp: str = Field(..., description="The timestamp of the error.")
     sequence_number: int = Field(..., description="A sequential identifier for the error.")
     finish_reason: Optional[str] = Field("error", description="Indicates an error completion.")
+    reason: Optional[str] = Field(
+        None,
+        description="Which timeout expired, if any: 'first_chunk_timeout', 'idle_timeout' or 'total_timeout' for an "
+        "upstream stream, 'timeout' for the whole request.",
+    )
     miner_uid: int = Field(..., description="The miner identifier for the selected response source.")
     validator_uid: int = Field(..., description="The validator identifier for the selected response source.")
 
-    def encode(self, encoding: str) -> bytes:
-        data = json.dumps(self.dict(), indent=4)
-        return data.encode(encoding)
+    def encode(self, encoding: str, compact: bool = False) -> bytes:
+        return encode_stream_error(self, compact).encode(encoding)
+
+
+# Streamed chunks are serialized by filling in templates rather than through `json.dumps(model.dict())`, which
+# copies the whole model (and its accumulated chunks) into a dict before encoding it. The output is the same
+# as `json.dumps` with `indent=4` (full) or `separators=(",", ":")` (compact).
+_FULL_CHUNK_TEMPLATE = (
+    '{\n    "delta": %s,\n    "finish_reason": %s,\n    "accumulated_chunks": %s,\n    "accumulated_timings": %s,\n'
+    '    "timestamp": %s,\n    "sequence_number": %d,\n    "miner_uid": %d,\n    "validator_uid": %d\n}'
+)
+_FULL_ERROR_TEMPLATE = (
+    '{\n    "error": %s,\n    "timestamp": %s,\n    "sequence_number": %d,\n    "finish_reason": %s,\n'
+    '    "reason": %s,\n    "miner_uid": %d,\n    "validator_uid": %d\n}'
+)
+# The reason is left out of compact errors when unset
+_COMPACT_ERROR_TEMPLATE = (
+    '{"error":%s,"timestamp":%s,"sequence_number":%d,"finish_reason":%s%s,"miner_uid":%d,"validator_uid":%d}'
+)
+
+
+def _encode_optional_str(value: Optional[str]) -> str:
+    return "null" if value is None else encode_basestring_ascii(value)
+
+
+def _encode_list(encoded_items: list[str], compact: bool) -> str:
+    if compact:
+        return "[" + ",".join(encoded_items) + "]"
+    if not encoded_items:
+        return "[]"
+    return "[\n        " + ",\n        ".join(encoded_items) + "\n    ]"
+
+
+def encode_stream_chunk(chunk: StreamChunk, compact: bool = False) -> str:
+    """Serializes a `StreamChunk` for the hot streaming path.
+
+    Args:
+        chunk (StreamChunk): chunk to serialize, it may have been built with `StreamChunk.model_construct`
+        compact (bool): whether to leave out unset fields and all whitespace (the "delta" stream format)
+
+    Returns:
+        str: the JSON encoded chunk
+    """
+    # Timings are always finite, so `float.__repr__` gives the same output as `json.dumps`
+    chunks = None if chunk.accumulated_chunks is None else list(map(encode_basestring_ascii, chunk.accumulated_chunks))
+    timings = None if chunk.accumulated_timings is None else list(map(float.__repr__, chunk.accumulated_timings))
+
+    if not compact:
+        return _FULL_CHUNK_TEMPLATE % (
+            encode_basestring_ascii(chunk.delta),
+            _encode_optional_str(chunk.finish_reason),
+            "null" if chunks is None else _encode_list(chunks, compact),
+            "null" if timings is None else _encode_list(timings, compact),
+            encode_basestring_ascii(chunk.timestamp),
+            chunk.sequence_number,
+            chunk.miner_uid,
+            chunk.validator_uid,
+        )
+
+    parts = ['{"delta":', encode_basestring_ascii(chunk.delta)]
+    if chunk.finish_reason is not None:
+        parts += [',"finish_reason":', encode_basestring_ascii(chunk.finish_reason)]
+    if chunks is not None:
+        parts += [',"accumulated_chunks":', _encode_list(chunks, compact)]
+    if timings is not None:
+        parts += [',"accumulated_timings":', _encode_list(timings, compact)]
+    if chunk.timing is not None:
+        parts += [',"timing":', float.__repr__(chunk.timing)]
+    parts.append(
+        ',"timestamp":%s,"sequence_number":%d,"miner_uid":%d,"validator_uid":%d}'
+        % (encode_basestring_ascii(chunk.timestamp), chunk.sequence_number, chunk.miner_uid, chunk.validator_uid)
+    )
+    return "".join(parts)
+
+
+def encode_stream_error(error: StreamError, compact: bool = False) -> str:
+    """Serializes a `StreamError` for the hot streaming path, see `encode_stream_chunk`"""
+    if compact:
+        reason = "" if error.reason is None else ',"reason":' + encode_basestring_ascii(error.reason)
+    else:
+        reason = _encode_optional_str(error.reason)
+    return (_COMPACT_ERROR_TEMPLATE if compact else _FULL_ERROR_TEMPLATE) % (
+        encode_basestring_ascii(error.error),
+        encode_basestring_ascii(error.timestamp),
+        error.sequence_number,
+        _encode_optional_str(error.finish_reason),
+        reason,
+        error.miner_uid,
+        error.validator_uid,
+    )
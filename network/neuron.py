@@ -1,81 +1,469 @@
+import asyncio
 import bittensor as bt
-from fastapi.responses import StreamingResponse
-from typing import Optional
+import copy
+import time
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from http import HTTPStatus
+from typing import AsyncIterator, NamedTuple, Optional
 from loguru import logger
+from pydantic import ValidationError
 
 from network.utils.stream_utils import validate_request
 from network.meta.protocol import StreamPromptingSynapse
 from network.stream_manager import StreamManager
-from network.utils.uid_utils import is_uid_validator, sample_uids
-from network.meta.schemas import QueryChatRequest
+from network.utils.admission import AdmissionRejected, StreamLimiter, StreamReservation, retry_after_header
+from network.utils.chat_completions import SSE_HEADERS, ChatCompletionEncoder, chat_completion_events, with_heartbeats
+from network.utils.circuit_breaker import AllQuarantined, CircuitBreaker
+from network.utils.completion_cache import CachedCompletion, CompletionCache
+from network.utils.log_utils import format_prompt
+from network.utils.metagraph_snapshot import SnapshotReader
+from network.utils.scoreboard import LatencyScoreboard
+from network.utils.single_flight import SingleFlight
+from network.utils.stream_capture import StreamRecorder
+from network.utils.uid_utils import EligibilityIndex, get_hedge_uid, sample_uids
+from network.meta.schemas import (
+    BatchResult,
+    ChatCompletionRequest,
+    QueryBatchRequest,
+    QueryChatRequest,
+    StreamError,
+)
+from network.utils import metrics
 import settings
 
 
+def client_key(params: QueryChatRequest, api_key: Optional[str]) -> str:
+    """The key of identical requests of the same client (API key), so that one client's responses (coalesced or
+    cached) are never served to another
+    """
+    return f"{api_key or ''}:{params.canonical_key()}"
+
+
+class Query(NamedTuple):
+    """A request whose upstream streams were opened by `Neuron.start_query`"""
+
+    stream_manager: StreamManager
+    streams_responses: list[AsyncIterator]
+    uids: list[int]
+    # The upstream streams reserved for the request
+    reservation: StreamReservation
+
+
 class Neuron:
-    def __init__(self):
-        self.wallet = bt.wallet(
+    def __init__(
+        self,
+        wallet: Optional["bt.wallet"] = None,
+        dendrite: Optional["bt.dendrite"] = None,
+        subtensor: Optional["bt.subtensor"] = None,
+    ):
+        """The wallet, dendrite and subtensor default to the ones configured in the settings (the benchmarks pass a
+        simulated network instead). With several workers, the metagraph is mapped from the snapshots of the
+        refresher process rather than synced from a subtensor.
+        """
+        self.wallet = wallet or bt.wallet(
             name=settings.COLDKEY_WALLET_NAME,
             hotkey=settings.HOTKEY_WALLET_NAME,
             path=settings.WALLET_PATH,
         )
-        self.dendrite = bt.dendrite(wallet=self.wallet)
-        self.subtensor = bt.subtensor(network=settings.SUBTENSOR_NETWORK)
-        self.metagraph = self.subtensor.metagraph(settings.NETUID)
+        self.dendrite = dendrite or bt.dendrite(wallet=self.wallet)
+        if subtensor is None and settings.WORKERS > 1:
+            self.subtensor = None
+            self.snapshot: Optional[SnapshotReader] = SnapshotReader()
+        else:
+            self.subtensor = subtensor or bt.subtensor(network=settings.SUBTENSOR_NETWORK)
+            self.snapshot = None
+        self.eligibility = self.sync_eligibility()
+        self.scoreboard = LatencyScoreboard()
+        self.breaker = CircuitBreaker()
+        self.single_flight = SingleFlight()
+        self.completion_cache = CompletionCache()
+        self.stream_limiter = StreamLimiter()
+        self.recorder = StreamRecorder() if settings.CAPTURE_PATH else None
+
+    @property
+    def metagraph(self) -> "bt.metagraph.Metagraph":
+        """The most recently synced metagraph"""
+        return self.eligibility.metagraph
+
+    async def query_network(self, params: QueryChatRequest, api_key: Optional[str] = None) -> Optional[Response]:
+        # Only the identical requests of the same client are answered from the cache or coalesced
+        key = client_key(params, api_key)
+        if params.cache and (completion := self.completion_cache.get(key)) is not None:
+            logger.info("Replaying a cached completion")
+            return self.replay_completion(params, completion)
+
+        if settings.SINGLE_FLIGHT_ENABLED and (shared_stream := self.single_flight.join(key)) is not None:
+            logger.info("Joining the stream of an identical request in flight")
+            return StreamingResponse(shared_stream, media_type="text/event-stream")
+
+        # Use the same metagraph for the whole request, even if a resync finishes in the meantime
+        eligibility = self.eligibility
+        query = await self.start_query(params, eligibility)
+        stream_manager = query.stream_manager
+
+        if params.aggregate:
+            try:
+                aggregated_completion = await stream_manager.aggregate(query.streams_responses, query.uids)
+            finally:
+                query.reservation.release()
+            if aggregated_completion is None:
+                raise HTTPException(
+                    status_code=HTTPStatus.BAD_GATEWAY,
+                    detail="No miner returned a usable completion",
+                )
+            return JSONResponse(aggregated_completion.model_dump())
+
+        stream = stream_manager.stream_generator(query.streams_responses, query.uids)
+        stream = self.release_streams(stream, query.reservation)
+        if params.cache:
+            stream = self.cache_completion(stream, stream_manager, key, eligibility.metagraph)
+        # The streams are also released when the response is closed, in case the stream is never iterated
+        background = BackgroundTask(query.reservation.release)
+        if settings.SINGLE_FLIGHT_ENABLED:
+            # Identical requests arriving while this one is streaming subscribe to its stream. The shared stream is
+            # iterated by its own task, which releases the streams once every subscriber is done
+            background = None
+            stream = self.single_flight.start(
+                key,
+                stream,
+                overflow_chunk=lambda: stream_manager.generate_error_chunk(
+                    "fell too far behind the coalesced stream"
+                ).encode("utf-8", compact=params.stream_format == "delta"),
+            )
+
+        selected_stream = StreamingResponse(stream, media_type="text/event-stream", background=background)
+
+        logger.debug("Returning the stream")
+        if selected_stream is None:
+            return None
+
+        return selected_stream
+
+    async def start_query(self, params: QueryChatRequest, eligibility: EligibilityIndex) -> Query:
+        """Validates a request, samples the UIDs to query, reserves their upstream streams and opens them.
+        The caller releases the reserved streams once the request is done.
+        """
+        metagraph = eligibility.metagraph
 
-    async def query_network(self, params: QueryChatRequest) -> Optional[StreamingResponse]:
         # Validate the request parameters
-        validate_request(params, self.metagraph)
+        validate_request(params, eligibility)
 
         # Get the UIDs (and axons) to query
-        uids = sample_uids(self.metagraph, self.wallet, params)
-        logger.debug(f"Querying uids: {uids}")
-        axons = [self.metagraph.axons[uid] for uid in uids]
+        try:
+            uids = sample_uids(eligibility, params, self.scoreboard, self.breaker)
+        except AllQuarantined as e:
+            raise HTTPException(
+                status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+                detail=f"{e}, please retry later",
+                headers=retry_after_header(e.retry_after),
+            )
+        logger.debug("Querying uids: {}", uids)
+        axons = self.get_axons(metagraph, uids, params.query_validators)
 
         if params.query_validators:
             logger.debug("Querying validators...")
             logger.debug(
-                f"Validator: {uids[0]} has stake {self.metagraph.S[uids[0]]} and our min is {settings.VALIDATOR_MIN_STAKE}"
-            )
-            logger.debug(
-                f" Querying valdiators? {params.query_validators} - Is valid?  {is_uid_validator(self.metagraph, uids[0])}"
+                "Validator: {} has stake {} and our min is {}",
+                uids[0],
+                metagraph.S[uids[0]],
+                settings.VALIDATOR_MIN_STAKE,
             )
-
-            # Currently, two OTF validators are running (one is not setting weights),
-            # and we may need to specify which validator to consider by setting to our desired port.
-            if (val_port := settings.QUERY_VALIDATOR_PORT) is not None:
-                for axon in axons:
-                    axon.port = int(val_port)
         else:
             logger.debug("Querying miners...")
 
         # Make calls to the network with the prompt.
-        logger.debug(
-            f"Sampling dendrite by {params.sampling_mode} with roles {params.roles} and messages {params.messages}"
+        # The prompt is only formatted (truncated or redacted) if debug logs are enabled
+        logger.opt(lazy=True).debug(
+            "Sampling dendrite by {} with roles {} and messages {}",
+            lambda: params.sampling_mode,
+            lambda: params.roles,
+            lambda: format_prompt(params.messages),
         )
 
-        streams_responses = await self.dendrite(
-            axons=axons,
-            synapse=StreamPromptingSynapse(roles=params.roles, messages=params.messages),
-            timeout=params.timeout,
-            deserialize=False,
-            streaming=True,
+        # Reserve the upstream streams (including the backup validator of hedged requests) before opening them
+        try:
+            reserved_streams = await self.stream_limiter.acquire(len(uids) + int(bool(params.hedge)), params.timeout)
+        except AdmissionRejected as e:
+            raise HTTPException(
+                status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+                detail=f"Too many requests in flight ({e.reason}), please retry later",
+                headers=retry_after_header(e.retry_after),
+            )
+        reservation = StreamReservation(self.stream_limiter, reserved_streams)
+
+        try:
+            streams_responses = await self.dendrite(
+                axons=axons,
+                # The streams are only forwarded to the client, so the synapse doesn't need to keep the completion
+                synapse=StreamPromptingSynapse(roles=params.roles, messages=params.messages).stream_only(),
+                # The upstream timeouts are enforced by the StreamManager, the dendrite only bounds their duration
+                timeout=params.stream_timeout(),
+                deserialize=False,
+                streaming=True,
+            )
+        except BaseException:
+            self.stream_limiter.release(reserved_streams)
+            raise
+
+        logger.info("Completed sampling dendrite with uids: {} ({} streams)", uids, len(streams_responses))
+
+        capture = self.recorder.start(params, uids) if self.recorder is not None else None
+        if params.aggregate:
+            # Every miner gets its own completed chunk in the "delta" stream format
+            params = params.model_copy(update={"stream_format": "delta"})
+        stream_manager = StreamManager(params, scoreboard=self.scoreboard, breaker=self.breaker, capture=capture)
+        if params.hedge:
+            self.hedge_request(stream_manager, eligibility, params, primary_uid=uids[0])
+        return Query(stream_manager, streams_responses, uids, reservation)
+
+    async def query_batch(self, batch: QueryBatchRequest, api_key: Optional[str] = None) -> StreamingResponse:
+        """Queries the network with every request of a batch, at most `parallelism` at a time, and streams their
+        results back as NDJSON (one `BatchResult` per line) in the order they finish. Failed requests get a result
+        with their error rather than failing the batch.
+        """
+        if not 0 < len(batch.requests) <= settings.BATCH_MAX_REQUESTS:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail=f"A batch must have between 1 and {settings.BATCH_MAX_REQUESTS} requests",
+            )
+        if batch.parallelism is not None and batch.parallelism <= 0:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail="parallelism must be greater than 0",
+            )
+        parallelism = min(batch.parallelism or settings.BATCH_MAX_PARALLELISM, settings.BATCH_MAX_PARALLELISM)
+        logger.info("Querying a batch of {} requests, {} at a time", len(batch.requests), parallelism)
+
+        # Every request of the batch is sampled from the same metagraph
+        eligibility = self.eligibility
+        return StreamingResponse(
+            self.batch_results(batch.requests, eligibility, parallelism, api_key), media_type="application/x-ndjson"
         )
 
-        logger.info(f"Completed sampling dendrite with uids: {uids}. Streams_responses: {streams_responses}")
+    async def batch_results(
+        self,
+        requests: list[QueryChatRequest],
+        eligibility: EligibilityIndex,
+        parallelism: int,
+        api_key: Optional[str] = None,
+    ) -> AsyncIterator[bytes]:
+        """Runs the requests of a batch with `parallelism` workers and yields their results as they finish"""
+        pending = iter(enumerate(requests))
+        results: asyncio.Queue[BatchResult] = asyncio.Queue()
+
+        async def worker():
+            for index, params in pending:
+                results.put_nowait(await self.query_batch_item(index, params, eligibility, api_key))
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(parallelism, len(requests)))]
+        try:
+            for _ in requests:
+                result = await results.get()
+                yield result.model_dump_json(exclude_none=True).encode("utf-8") + b"\n"
+        finally:
+            # The client disconnected, or every request is done
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def query_batch_item(
+        self, index: int, params: QueryChatRequest, eligibility: EligibilityIndex, api_key: Optional[str] = None
+    ) -> BatchResult:
+        """Queries the network with a request of a batch and collects its responses"""
+        key = client_key(params, api_key)
+        if params.cache and (completion := self.completion_cache.get(key)) is not None:
+            chunks = StreamManager(params).completed_chunks(completion.responses)
+            return BatchResult(index=index, status_code=HTTPStatus.OK, responses=chunks)
+
+        try:
+            query = await self.start_query(params, eligibility)
+        except HTTPException as e:
+            return BatchResult(index=index, status_code=e.status_code, error=e.detail)
+        except Exception as e:
+            logger.exception(f"Request {index} of the batch failed: {e}")
+            return BatchResult(index=index, status_code=HTTPStatus.INTERNAL_SERVER_ERROR, error=str(e))
+
+        stream_manager = query.stream_manager
+        errors = []
+        try:
+            if params.aggregate:
+                aggregated_completion = await stream_manager.aggregate(query.streams_responses, query.uids)
+                if aggregated_completion is None:
+                    return BatchResult(
+                        index=index,
+                        status_code=HTTPStatus.BAD_GATEWAY,
+                        error="No miner returned a usable completion",
+                    )
+                return BatchResult(index=index, status_code=HTTPStatus.OK, aggregated_completion=aggregated_completion)
+
+            async for chunk in stream_manager.chunk_generator(query.streams_responses, query.uids):
+                if isinstance(chunk, StreamError):
+                    errors.append(chunk)
+        finally:
+            query.reservation.release()
+
+        if params.cache and (responses := stream_manager.completed_responses()) is not None:
+            self.completion_cache.put(key, responses, eligibility.metagraph)
+        # The responses of the miners are returned even if one of them failed
+        chunks = stream_manager.completed_chunks(stream_manager.selected_responses())
+        if not errors:
+            return BatchResult(index=index, status_code=HTTPStatus.OK, responses=chunks)
+        # Errors with a reason are timeouts
+        status_code = HTTPStatus.GATEWAY_TIMEOUT if any(error.reason for error in errors) else HTTPStatus.BAD_GATEWAY
+        error = "; ".join(error.error for error in errors)
+        return BatchResult(index=index, status_code=status_code, responses=chunks, error=error)
+
+    async def chat_completions(self, request: ChatCompletionRequest) -> Response:
+        """Queries the network with an OpenAI chat completions request, the response of every selected miner is a
+        choice. Streamed requests get server-sent events, ended by "data: [DONE]" and kept alive by heartbeat comments,
+        the other requests get a single chat completion.
+        """
+        try:
+            params = request.to_query_request()
+        except ValidationError as e:
+            raise HTTPException(
+                status_code=HTTPStatus.UNPROCESSABLE_ENTITY, detail=e.errors(include_url=False, include_context=False)
+            )
+
+        eligibility = self.eligibility
+        query = await self.start_query(params, eligibility)
+        stream_manager = query.stream_manager
+        encoder = ChatCompletionEncoder(request.model)
+        chunks = stream_manager.chunk_generator(query.streams_responses, query.uids)
+
+        if request.stream:
+            stream = with_heartbeats(chat_completion_events(chunks, encoder), settings.SSE_HEARTBEAT_INTERVAL)
+            stream = self.release_streams(stream, query.reservation)
+            return StreamingResponse(
+                stream,
+                media_type="text/event-stream",
+                headers=SSE_HEADERS,
+                background=BackgroundTask(query.reservation.release),
+            )
+
+        errors = []
+        try:
+            async for chunk in chunks:
+                if isinstance(chunk, StreamError):
+                    errors.append(chunk)
+        finally:
+            await chunks.aclose()
+            query.reservation.release()
+
+        responses = stream_manager.selected_responses()
+        if errors and not any(response.chunks for response in responses):
+            # Errors with a reason are timeouts
+            timed_out = any(error.reason for error in errors)
+            raise HTTPException(
+                status_code=HTTPStatus.GATEWAY_TIMEOUT if timed_out else HTTPStatus.BAD_GATEWAY,
+                detail="; ".join(error.error for error in errors),
+            )
+        return JSONResponse(encoder.completion(responses, errors))
 
+    def replay_completion(self, params: QueryChatRequest, completion: CachedCompletion) -> Response:
+        """Returns a cached completion, either replayed as a stream or as the list of its "completed" chunks"""
         stream_manager = StreamManager(params)
-        selected_stream = StreamingResponse(
-            stream_manager.stream_generator(streams_responses, uids),
-            media_type="text/event-stream",
-        )
+        if params.cache_replay == "json":
+            chunks = stream_manager.completed_chunks(completion.responses)
+            return JSONResponse([chunk.model_dump(exclude={"timing"}) for chunk in chunks])
 
-        logger.info(f"Selected stream: {selected_stream}, returning...")
-        if selected_stream is None:
-            return None
+        return StreamingResponse(stream_manager.replay_generator(completion.responses), media_type="text/event-stream")
 
-        return selected_stream
+    async def release_streams(
+        self, stream: AsyncIterator[bytes], reservation: StreamReservation
+    ) -> AsyncIterator[bytes]:
+        """Forwards the stream, then releases the upstream streams it reserved"""
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+            reservation.release()
+
+    async def cache_completion(
+        self, stream: AsyncIterator[bytes], stream_manager: StreamManager, key: str, metagraph: "bt.metagraph.Metagraph"
+    ) -> AsyncIterator[bytes]:
+        """Forwards the stream, then caches its completion if the stream finished successfully"""
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+        if (responses := stream_manager.completed_responses()) is not None:
+            self.completion_cache.put(key, responses, metagraph)
+
+    def get_axons(self, metagraph: "bt.metagraph.Metagraph", uids: list[int], query_validators: bool) -> list:
+        """Returns the axons to query for the UIDs"""
+        axons = [metagraph.axons[uid] for uid in uids]
+
+        # Currently, two OTF validators are running (one is not setting weights),
+        # and we may need to specify which validator to consider by setting to our desired port.
+        if query_validators and (val_port := settings.QUERY_VALIDATOR_PORT) is not None:
+            # Copy the axons so the port isn't changed in the metagraph that other requests use
+            axons = [copy.copy(axon) for axon in axons]
+            for axon in axons:
+                axon.port = int(val_port)
+        return axons
 
-    def resync_metagraph(self):
-        """Resyncs the metagraph and updates the hotkeys and moving averages based on the new metagraph."""
-        self.metagraph.sync(subtensor=self.subtensor)
+    def hedge_request(
+        self, stream_manager: StreamManager, eligibility: EligibilityIndex, params: QueryChatRequest, primary_uid: int
+    ):
+        """Adds a backup validator to the request, which is only queried if the primary validator is slow to respond.
+        Unless the request sets `hedge_delay`, the backup validator is queried once the primary validator is slower
+        than `HEDGE_PERCENTILE` of recent streams.
+        """
+        hedge_uid = get_hedge_uid(eligibility, params, primary_uid, self.breaker)
+        if hedge_uid is None:
+            logger.warning(f"No backup validator to hedge the request to validator UID {primary_uid} with")
+            return
+
+        delay = params.hedge_delay
+        if delay is None:
+            delay = self.scoreboard.percentile_time_to_first_chunk(settings.HEDGE_PERCENTILE) or settings.HEDGE_DELAY
+        start_time = time.perf_counter()
+
+        async def open_stream():
+            self.breaker.start([hedge_uid], eligibility.metagraph)
+            streams_responses = await self.dendrite(
+                axons=self.get_axons(eligibility.metagraph, [hedge_uid], query_validators=True),
+                synapse=StreamPromptingSynapse(roles=params.roles, messages=params.messages).stream_only(),
+                # The backup validator has to respond within the timeout of the whole request
+                timeout=max(params.stream_timeout() - (time.perf_counter() - start_time), 0),
+                deserialize=False,
+                streaming=True,
+            )
+            return streams_responses[0]
+
+        logger.debug("Hedging the request to validator UID {} with UID {} after {:.3f}s", primary_uid, hedge_uid, delay)
+        stream_manager.add_hedge(hedge_uid, open_stream, delay)
+
+    async def resync_metagraph(self):
+        """Resyncs the metagraph and updates the hotkeys and moving averages based on the new metagraph.
+        The sync is a blocking call to the subtensor, so it runs in a thread and syncs a new metagraph which then
+        replaces the current one. Requests that are in flight keep using the metagraph they started with.
+        """
+        if self.snapshot is not None and not self.snapshot.changed():
+            # The refresher process hasn't published a new snapshot since the last one
+            return
+        self.eligibility = await asyncio.to_thread(self.sync_eligibility)
+        self.completion_cache.invalidate_changed_hotkeys(self.metagraph)
         logger.info("Metagraph sync finished")
+
+    def sync_eligibility(self) -> EligibilityIndex:
+        """Syncs a new metagraph from the subtensor (or maps the latest snapshot) and builds its eligibility index"""
+        if self.snapshot is not None:
+            eligibility = self.snapshot.load()
+            sync_duration, synced_at = self.snapshot.sync_duration, self.snapshot.synced_at
+        else:
+            start_time = time.perf_counter()
+            metagraph = self.subtensor.metagraph(settings.NETUID)
+            eligibility = EligibilityIndex(metagraph, self.wallet)
+            sync_duration, synced_at = time.perf_counter() - start_time, time.time()
+
+        metrics.METAGRAPH_SYNC_DURATION.set(sync_duration)
+        metrics.METAGRAPH_SYNCS.observe(sync_duration)
+        metrics.METAGRAPH_LAST_SYNC.set(synced_at)
+        return eligibility
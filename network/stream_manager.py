@@ -2,21 +2,120 @@ import asyncio
 import async_timeout
 import datetime
 import json
-from collections import defaultdict
+from collections import Counter, defaultdict
 import time
-from typing import AsyncIterator, Optional
+from typing import AsyncIterator, Awaitable, Callable, Iterator, Optional
 from loguru import logger
 
-from network.meta.schemas import QueryChatRequest, StreamChunk, StreamError
+from network.meta.schemas import AggregatedCompletion, QueryChatRequest, StreamChunk, StreamError
 from network.meta.protocol import StreamPromptingSynapse
+from network.utils.circuit_breaker import CircuitBreaker
+from network.utils.completion_cache import CachedResponse
+from network.utils.ensemble import Ensemble
+from network.utils.scoreboard import LatencyScoreboard
+from network.utils.stream_capture import StreamCapture
+from network.utils.stream_quality import PrefixHash
+from network.utils import metrics
+from network.utils.log_utils import sample_chunk_log, truncate
+from network.utils.stream_utils import JSONFrameDecoder
+import settings
+
+# Queued by `StreamManager.pump_stream` once an upstream stream is exhausted
+_STREAM_END = object()
+# Queued by `StreamManager.hedge_stream` once the backup validator is queried, so its timeouts start being enforced
+_STREAM_OPEN = object()
+
+# The error of an upstream stream dropped by each of the per-upstream timeouts of the request
+UPSTREAM_TIMEOUT_ERRORS = {
+    "first_chunk_timeout": "no chunk within {:g} seconds",
+    "idle_timeout": "no chunk for {:g} seconds",
+    "total_timeout": "stream lasted more than {:g} seconds",
+}
+
+
+def has_text(delta: Optional[str]) -> bool:
+    """Whether a delta has anything but whitespace"""
+    return bool(delta) and not delta.isspace()
+
+
+class UpstreamStats:
+    """Telemetry of a single upstream stream, recorded in the latency scoreboard once the stream is done"""
+
+    __slots__ = ("start_time", "first_chunk_time", "last_chunk_time", "last_read_time", "chunks", "error", "timed_out")
+
+    def __init__(self):
+        # None until the upstream is opened, e.g. the backup validator of a hedged request may never be
+        self.start_time: Optional[float] = None
+        self.first_chunk_time: Optional[float] = None
+        self.last_chunk_time: Optional[float] = None
+        # When the upstream last sent anything, as read by its pump (its chunks may still be queued)
+        self.last_read_time: Optional[float] = None
+        self.chunks = 0
+        self.error = False
+        self.timed_out = False
 
 
 class StreamManager:
-    def __init__(self, request: QueryChatRequest):
+    def __init__(
+        self,
+        request: QueryChatRequest,
+        scoreboard: Optional[LatencyScoreboard] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        capture: Optional[StreamCapture] = None,
+    ):
         super().__init__()
         self.selected_miners: set[int] = set()
         self.request = request
         self.client_response_chunks: list[StreamChunk] = []
+        # The validator each selected miner was streamed through (-1 when streaming from miners)
+        self.miner_validator_uids: dict[int, int] = {}
+        self.failed = False
+        # Per-chunk metrics are counted here and recorded once the stream is done
+        self.first_chunk_at: Optional[float] = None
+        self.chunks_received = 0
+        self.skipped_chunks: Counter[int] = Counter()
+        self.upstreams: dict[int, asyncio.Task] = {}
+        self.upstream_stats: dict[int, UpstreamStats] = {}
+        self.scoreboard = scoreboard
+        self.breaker = breaker
+        # Records the upstream streams if the request was sampled by the stream recorder
+        self.capture = capture
+
+        # Miners are only selected once they stream some text, then stay on probation until they streamed
+        # `STREAM_PROBATION_CHARS` characters or finished. Until every slot is filled by a miner past its probation,
+        # the chunks of the other miners are kept aside (with the validator they were streamed through), so a miner
+        # that stalls or duplicates another one can be dropped and replaced without losing the start of a response.
+        self.probation: dict[int, PrefixHash] = {}
+        self.last_progress: dict[int, float] = {}
+        self.standby_chunks: dict[int, tuple[int, list[tuple[str, float]]]] = {}
+        # Miners kept aside whose stream is already finished
+        self.finished_standby: set[int] = set()
+        self.dropped_miners: set[int] = set()
+        # The miner that streamed each prefix first
+        self.prefix_owners: dict[int, int] = {}
+        self.probation_chars = settings.STREAM_PROBATION_CHARS
+        self.stall_timeout = settings.STREAM_STALL_TIMEOUT
+        # Identical completions are what aggregated requests look for, so they are never dropped as duplicates
+        self.dedup = settings.STREAM_DEDUP and not request.aggregate
+        self.upstream_timeouts = bool(request.first_chunk_timeout or request.idle_timeout or request.total_timeout)
+
+        # The backup validator of a hedged request (see `add_hedge`), and the validators racing for the request
+        self.hedge: Optional[tuple[int, Callable[[], Awaitable[AsyncIterator]], float]] = None
+        self.hedge_uids: set[int] = set()
+        self.hedge_winner: Optional[int] = None
+        self.hedge_trigger = asyncio.Event()
+
+    def add_hedge(self, uid: int, open_stream: Callable[[], Awaitable[AsyncIterator]], delay: float):
+        """Hedges the request with a backup validator: if no validator has streamed anything after `delay`
+        seconds (or they all failed), the stream of the backup validator is opened. The first validator that
+        streams a chunk is selected and the other ones are cancelled.
+
+        Args:
+            uid (int): the backup validator UID
+            open_stream (Callable[[], Awaitable[AsyncIterator]]): queries the backup validator and returns its stream
+            delay (float): the time in seconds to wait for the first chunk before querying the backup validator
+        """
+        self.hedge = (uid, open_stream, delay)
 
     async def stream_generator(
         self,
@@ -32,45 +131,443 @@ class StreamManager:
         Returns:
             AsyncIterator[bytes]: processed byte stream of responses
         """
+        compact = self.request.stream_format == "delta"
+        chunks = total_bytes = 0
+        try:
+            async for chunk in self.chunk_generator(streams_responses, stream_uids):
+                data = chunk.encode("utf-8", compact=compact)
+                chunks += 1
+                total_bytes += len(data)
+                yield data
+        finally:
+            metrics.CHUNKS_STREAMED.inc(chunks, stream_format=self.request.stream_format)
+            metrics.BYTES_STREAMED.inc(total_bytes, stream_format=self.request.stream_format)
+
+    async def aggregate(
+        self, streams_responses: list[AsyncIterator], stream_uids: Optional[list[int]]
+    ) -> Optional[AggregatedCompletion]:
+        """Collects the completions of the miners and picks one by consensus (see `Ensemble`). Returns as soon as
+        `quorum` completions agree, closing the streams that are still open, or once every stream is done.
+        The request must use the "delta" stream format, so every miner gets its own completed chunk.
 
+        Args:
+            streams_responses (list[AsyncIterator]): responses from miners (or miners through validators)
+            stream_uids (Optional[list[int]]): the validator or miner UID that produced the stream
+
+        Returns:
+            Optional[AggregatedCompletion]: the chosen completion, None if no miner returned a usable completion
+        """
+        ensemble = Ensemble(quorum=self.request.quorum or self.request.k // 2 + 1)
+        # Miners that failed, their partial completions are left out
+        failed_miners: set[int] = set()
+        completed_miners: set[int] = set()
+        chunks = self.chunk_generator(streams_responses, stream_uids)
+        try:
+            async for chunk in chunks:
+                if isinstance(chunk, StreamError):
+                    failed_miners.add(chunk.miner_uid)
+                    ensemble.dropped += chunk.miner_uid != -1
+                    continue
+                if chunk.finish_reason != "completed" or chunk.miner_uid in completed_miners | failed_miners:
+                    continue
+                completed_miners.add(chunk.miner_uid)
+                if ensemble.add("".join(chunk.accumulated_chunks), chunk.miner_uid, chunk.validator_uid):
+                    break
+        finally:
+            await chunks.aclose()
+        return ensemble.result()
+
+    async def replay_generator(self, responses: list[CachedResponse]) -> AsyncIterator[bytes]:
+        """Streams cached responses back through the API, in the same framing as `stream_generator`"""
+        compact = self.request.stream_format == "delta"
+        for chunk in self.replay_chunks(responses):
+            yield chunk.encode("utf-8", compact=compact)
+
+    def replay_chunks(self, responses: list[CachedResponse]) -> Iterator[StreamChunk]:
+        """Generates the chunks of cached responses, with the timings they were originally received with
+
+        Args:
+            responses (list[CachedResponse]): responses returned by `completed_responses`
+
+        Returns:
+            Iterator[StreamChunk]: the chunks of every response followed by the "completed" chunks of its stream
+        """
         self.accumulated_chunks = defaultdict(list)
         self.accumulated_timings = defaultdict(list)
         self.start_time = time.perf_counter()
+        delta_format = self.request.stream_format == "delta"
+
+        # Chunks are replayed in the order they were received, and each stream is completed after its last chunk
+        received = sorted(
+            (timing, index, position)
+            for index, response in enumerate(responses)
+            for position, timing in enumerate(response.timings)
+        )
+        stream_uids = [
+            response.validator_uid if self.request.query_validators else response.miner_uid for response in responses
+        ]
+        remaining_chunks = Counter()
+        for stream_uid, response in zip(stream_uids, responses):
+            remaining_chunks[stream_uid] += len(response.timings)
+
+        for timing, index, position in received:
+            response = responses[index]
+            miner_uid, validator_uid = response.miner_uid, response.validator_uid
+            self.selected_miners.add(miner_uid)
+            self.accumulated_chunks[miner_uid].append(response.chunks[position])
+            self.accumulated_timings[miner_uid].append(timing)
+            yield StreamChunk.model_construct(
+                delta=response.chunks[position],
+                finish_reason=None,
+                accumulated_chunks=None if delta_format else self.accumulated_chunks[miner_uid],
+                accumulated_timings=None if delta_format else self.accumulated_timings[miner_uid],
+                timing=timing if delta_format else None,
+                timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                sequence_number=position + 1,
+                miner_uid=miner_uid,
+                validator_uid=validator_uid,
+            )
+
+            remaining_chunks[stream_uids[index]] -= 1
+            if remaining_chunks[stream_uids[index]] == 0:
+                yield from self.generate_last_chunks(-1 if self.request.query_validators else miner_uid, validator_uid)
 
+    def completed_chunks(self, responses: list[CachedResponse]) -> list[StreamChunk]:
+        """Generates a single "completed" chunk, carrying the whole response, for each cached response"""
+        return [
+            StreamChunk(
+                delta="",
+                finish_reason="completed",
+                accumulated_chunks=response.chunks,
+                accumulated_timings=response.timings,
+                timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                sequence_number=-1,
+                miner_uid=response.miner_uid,
+                validator_uid=response.validator_uid,
+            )
+            for response in responses
+        ]
+
+    def completed_responses(self) -> Optional[list[CachedResponse]]:
+        """Returns the responses of the selected miners once the stream is finished, to be cached.
+        None if the stream failed (or was incomplete) as its response shouldn't be replayed.
+        """
+        if self.failed or not self.accumulated_chunks:
+            return None
+        # The upstreams the selected miners were streamed from
+        upstream_uids = self.selected_miners
+        if self.request.query_validators:
+            upstream_uids = set(self.miner_validator_uids.values())
+        if any(self.upstream_stats[uid].error or self.upstream_stats[uid].timed_out for uid in upstream_uids):
+            return None
+        return self.selected_responses()
+
+    def selected_responses(self) -> list[CachedResponse]:
+        """Returns the responses of the selected miners so far, whether or not the stream failed"""
+        return [
+            CachedResponse(
+                miner_uid, validator_uid, self.accumulated_chunks[miner_uid], self.accumulated_timings[miner_uid]
+            )
+            for miner_uid, validator_uid in self.miner_validator_uids.items()
+        ]
+
+    async def chunk_generator(
+        self,
+        streams_responses: list[AsyncIterator],
+        stream_uids: Optional[list[int]],
+    ) -> AsyncIterator[StreamChunk | StreamError]:
+        """Merges the streams of miners or validators into the chunks that are sent back through the API
+
+        Args:
+            streams_responses (list[AsyncIterator]): responses from miners (or miners through validators)
+            stream_uids (Optional[list[int]]): the validator or miner UID that produced the stream
+
+        Returns:
+            AsyncIterator[StreamChunk | StreamError]: processed chunks, in the order they were received
+        """
+
+        self.accumulated_chunks = defaultdict(list)
+        self.accumulated_timings = defaultdict(list)
+        self.start_time = time.perf_counter()
+
+        # Every upstream is pumped concurrently into a shared queue so chunks are forwarded in the order they
+        # arrive, e.g. the fastest miner is streamed first rather than the first miner in the list
+        queue: asyncio.Queue = asyncio.Queue()
+        for stream_response, uid in zip(streams_responses, stream_uids):
+            if uid in self.upstreams:
+                logger.warning(f"UID {uid} was sampled more than once, only streaming from it once")
+                continue
+            self.upstreams[uid] = asyncio.create_task(self.pump_stream(stream_response, uid, queue))
+            self.upstream_stats[uid] = UpstreamStats()
+            self.upstream_stats[uid].start_time = time.perf_counter()
+
+        if self.hedge is not None and self.hedge[0] not in self.upstreams:
+            hedge_uid, open_stream, delay = self.hedge
+            self.hedge_uids = set(self.upstreams) | {hedge_uid}
+            self.upstreams[hedge_uid] = asyncio.create_task(self.hedge_stream(open_stream, hedge_uid, delay, queue))
+            self.upstream_stats[hedge_uid] = UpstreamStats()
+
+        metrics.STREAMS_IN_FLIGHT.inc()
         try:
-            async with async_timeout.timeout(self.request.timeout):
-                for stream_response, uid in zip(streams_responses, stream_uids):
+            async with async_timeout.timeout(self.request.stream_timeout()):
+                while self.upstreams:
+                    for error_chunk in self.expire_upstreams():
+                        yield error_chunk
+                    if not self.upstreams:
+                        break
+                    if queue.empty() and (deadline := self.next_deadline()) is not None:
+                        try:
+                            uid, item = await asyncio.wait_for(queue.get(), max(deadline - time.perf_counter(), 0))
+                        except asyncio.TimeoutError:
+                            for chunk in self.drop_stalled_miners():
+                                yield chunk
+                            self.cancel_unselected_upstreams()
+                            continue
+                    else:
+                        uid, item = await queue.get()
+                    if uid not in self.upstreams or item is _STREAM_OPEN:
+                        # Chunk was already queued when its upstream got cancelled (or the loop was only woken up to
+                        # take the timeouts of a newly opened upstream into account)
+                        continue
+
                     # Determine which UID was passed in
                     validator_uid = uid if self.request.query_validators else -1
                     miner_uid = uid if not self.request.query_validators else -1
-                    logger.info(f"Miner UID: {miner_uid}, Validator UID: {validator_uid}")
-
-                    async for raw_chunk in stream_response:
-                        if isinstance(raw_chunk, str):
-                            for chunk in self.split_chunks(raw_chunk):
-                                processed_chunk = self.process_chunk(chunk, miner_uid, validator_uid)
-                                if processed_chunk is None:
-                                    continue
+
+                    stats = self.upstream_stats[uid]
+                    if item is _STREAM_END:
+                        del self.upstreams[uid]
+                        self.record_upstream(uid)
+                        if uid in self.hedge_uids and self.hedge_winner is None:
+                            # The validator finished without streaming anything, so don't wait to hedge
+                            self.hedge_trigger.set()
+                    elif isinstance(item, list):
+                        if uid in self.hedge_uids and self.hedge_winner is None:
+                            self.select_hedge_winner(uid)
+                        stats.last_chunk_time = time.perf_counter()
+                        stats.first_chunk_time = stats.first_chunk_time or stats.last_chunk_time
+                        stats.chunks += len(item)
+                        for chunk, json_object in item:
+                            for processed_chunk in self.process_chunk(chunk, miner_uid, validator_uid, json_object):
+                                if isinstance(processed_chunk, StreamError):
+                                    # Errors of miners streamed through validators aren't the validator's fault
+                                    stats.error = stats.error or miner_uid != -1
+                                elif self.first_chunk_at is None:
+                                    self.first_chunk_at = time.perf_counter()
                                 yield processed_chunk
-                        elif isinstance(raw_chunk, StreamPromptingSynapse):
-                            # This is the last chunk of the stream
-                            yield self.generate_last_chunk(miner_uid, validator_uid)
+                        self.cancel_unselected_upstreams()
+                    elif isinstance(item, StreamPromptingSynapse):
+                        # The dendrite reports failed requests (e.g. timeouts) through the status of the synapse. The
+                        # dendrite cuts streams at the request timeout, which is only the upstream's fault if it hadn't
+                        # sent anything by then
+                        is_timeout = getattr(item, "is_timeout", False)
+                        stats.timed_out = is_timeout and stats.last_read_time is None
+                        stats.error = stats.error or not (getattr(item, "is_success", True) or is_timeout)
+                        if self.is_hedge_pending(uid):
+                            continue
+
+                        # This is the last chunk of the stream
+                        for last_chunk in self.finish_stream(miner_uid, validator_uid):
+                            yield last_chunk
+                        self.cancel_unselected_upstreams()
+                    elif isinstance(item, Exception):
+                        stats.error = True
+                        if self.is_hedge_pending(uid):
+                            continue
+                        self.discard_stream(miner_uid, validator_uid)
+                        yield self.generate_error_chunk(str(item), miner_uid, validator_uid)
+        except asyncio.TimeoutError:
+            logger.error(f"Stream timed out after {self.request.stream_timeout()} seconds")
+            for uid in self.upstreams:
+                # Upstreams that were streaming when the request timed out were cut off, rather than timing out
+                self.upstream_stats[uid].timed_out = self.upstream_stats[uid].last_read_time is None
+                self.record_upstream(uid)
+            yield self.generate_error_chunk("timed out", reason="timeout")
+        finally:
+            # Runs on completion, timeout, and when the client disconnects (starlette cancels the generator)
+            self.close()
+            self.record_metrics()
+            if self.capture is not None:
+                self.capture.close()
+
+    async def pump_stream(self, stream_response: AsyncIterator, uid: int, queue: asyncio.Queue):
+        """Decodes a single upstream stream into frames and forwards them into the shared queue, tagged with its UID.
+        A `_STREAM_END` marker is always queued last, so the consumer knows when every upstream is drained.
+
+        Args:
+            stream_response (AsyncIterator): response from a miner (or miners through a validator)
+            uid (int): the validator or miner UID that produced the stream
+            queue (asyncio.Queue): queue shared by all upstreams of the request
+        """
+        logger.info("Streaming from UID: {} ({})", uid, "validator" if self.request.query_validators else "miner")
+        stats = self.upstream_stats[uid]
+        stats.start_time = stats.start_time or time.perf_counter()
+        # Only validators frame their chunks as JSON objects, the text of miners (which may be JSON) is kept as it is
+        decoder = JSONFrameDecoder(framed=None if self.request.query_validators else False)
+        capture = self.capture
+        metrics.UPSTREAM_STREAMS_OPEN.inc()
+        try:
+            async for raw_chunk in stream_response:
+                if isinstance(raw_chunk, str):
+                    stats.last_read_time = time.perf_counter()
+                    if capture is not None:
+                        capture.chunk(uid, raw_chunk)
+                    if frames := decoder.feed(raw_chunk):
+                        queue.put_nowait((uid, frames))
+                    continue
+                if capture is not None:
+                    capture.end(uid, raw_chunk)
+                if frames := decoder.flush():
+                    queue.put_nowait((uid, frames))
+                queue.put_nowait((uid, raw_chunk))
+            if frames := decoder.flush():
+                queue.put_nowait((uid, frames))
+        except Exception as e:
+            logger.error(f"Stream from UID {uid} failed: {e}")
+            if capture is not None:
+                capture.error(uid, e)
+            queue.put_nowait((uid, e))
+        finally:
+            metrics.UPSTREAM_STREAMS_OPEN.dec()
+            queue.put_nowait((uid, _STREAM_END))
+            await self.close_stream(stream_response)
+
+    async def hedge_stream(
+        self,
+        open_stream: Callable[[], Awaitable[AsyncIterator]],
+        uid: int,
+        delay: float,
+        queue: asyncio.Queue,
+    ):
+        """Opens the stream of the backup validator of a hedged request once the other validators haven't
+        streamed anything for `delay` seconds (or have failed), then pumps it like any other upstream.
+        The task is cancelled before the stream is opened if another validator responds in time.
+
+        Args:
+            open_stream (Callable[[], Awaitable[AsyncIterator]]): queries the backup validator and returns its stream
+            uid (int): the backup validator UID
+            delay (float): the time in seconds to wait for the first chunk
+            queue (asyncio.Queue): queue shared by all upstreams of the request
+        """
+        try:
+            await asyncio.wait_for(self.hedge_trigger.wait(), timeout=delay)
         except asyncio.TimeoutError:
-            logger.error(f"Stream timed out after {self.request.timeout} seconds")
-            yield self.generate_error_chunk("timed out")
+            pass
+
+        logger.info(
+            "Hedging the request with validator UID {} after {:.3f}s", uid, time.perf_counter() - self.start_time
+        )
+        self.upstream_stats[uid].start_time = time.perf_counter()
+        queue.put_nowait((uid, _STREAM_OPEN))
+        try:
+            stream_response = await open_stream()
+        except Exception as e:
+            logger.error(f"Querying validator UID {uid} failed: {e}")
+            queue.put_nowait((uid, e))
+            queue.put_nowait((uid, _STREAM_END))
+            return
+        await self.pump_stream(stream_response, uid, queue)
 
-    def split_chunks(self, raw_chunk: str) -> list[str]:
-        """This splits received chunks into a list of chunks
-        Input: "{chunk1}{chunk2}..."
-        Output: ["{chunk1}", "{chunk2}", ...]
+    def select_hedge_winner(self, uid: int):
+        """Selects the first validator of a hedged request to stream a chunk, the other validators are cancelled"""
+        self.hedge_winner = uid
+        for other_uid in self.hedge_uids - {uid}:
+            if other_uid in self.upstreams:
+                self.record_upstream(other_uid)
+                self.cancel_upstream(other_uid, f"validator UID {uid} responded first")
 
-        Notes:
-         - Requires the `delm` to not already exist in the `raw_chunk`
+    def is_hedge_pending(self, uid: int) -> bool:
+        """Whether the upstream failed while another validator of the hedged request may still respond, in which
+        case its last chunk (or error) isn't sent to the client
         """
-        delm = ">>|break|<<"
-        return raw_chunk.replace("}{", "}" + delm + "{").split(delm)
+        if uid not in self.hedge_uids or self.hedge_winner is not None:
+            return False
+        self.hedge_trigger.set()
+        return any(other_uid in self.upstreams for other_uid in self.hedge_uids - {uid})
+
+    @staticmethod
+    async def close_stream(stream_response: AsyncIterator):
+        """Closes an upstream stream so that its connection is released right away instead of at `timeout`"""
+        if (aclose := getattr(stream_response, "aclose", None)) is None:
+            return
+        try:
+            await aclose()
+        except Exception as e:
+            # The dendrite's stream yields its synapse from a `finally` block, so closing a stream that is
+            # suspended mid-response raises "async generator ignored GeneratorExit" after the connection is closed
+            logger.trace("Upstream stream closed with: {}", e)
+
+    def cancel_upstream(self, uid: int, reason: str):
+        """Stops streaming from an upstream, the pump task closes the underlying stream when cancelled"""
+        if (pump := self.upstreams.pop(uid, None)) is not None:
+            logger.debug("Cancelling stream from UID {}: {}", uid, reason)
+            pump.cancel()
+
+    def cancel_unselected_upstreams(self):
+        """Cancels every miner stream that can no longer be selected because `k` miners have already responded
+        and are past their probation. Validator streams are never cancelled here as they multiplex several miners
+        into the same stream.
+        """
+        if len(self.selected_miners) < self.request.k or self.probation:
+            return
+        self.standby_chunks.clear()
+        if self.request.query_validators:
+            return
+        for uid in list(self.upstreams):
+            if uid not in self.selected_miners:
+                # Miners that responded too late still tell us how fast they are
+                self.record_upstream(uid)
+                self.cancel_upstream(uid, "not selected")
+
+    def record_upstream(self, uid: int):
+        """Records the telemetry of an upstream stream that is done in the latency scoreboard and circuit breaker"""
+        stats = self.upstream_stats[uid]
+        if stats.start_time is None:
+            # The upstream was never opened (e.g. hedging wasn't needed)
+            return
+        if stats.timed_out:
+            metrics.UID_TIMEOUTS.inc(uid=uid)
+
+        if self.breaker is not None and (stats.error or stats.timed_out or stats.first_chunk_time is not None):
+            # Streams that got cancelled before sending anything don't tell us if the UID is healthy
+            self.breaker.record(uid, failed=stats.error or stats.timed_out)
+
+        if self.scoreboard is None:
+            return
 
-    def process_chunk(self, chunk: str, miner_uid: int = -1, validator_uid: int = -1) -> Optional[StreamChunk]:
+        time_to_first_chunk = chunks_per_second = None
+        if stats.first_chunk_time is not None:
+            time_to_first_chunk = stats.first_chunk_time - stats.start_time
+            if stats.chunks > 1 and stats.last_chunk_time > stats.first_chunk_time:
+                chunks_per_second = (stats.chunks - 1) / (stats.last_chunk_time - stats.first_chunk_time)
+
+        self.scoreboard.record(
+            uid,
+            time_to_first_chunk=time_to_first_chunk,
+            chunks_per_second=chunks_per_second,
+            error=stats.error,
+            timed_out=stats.timed_out,
+        )
+
+    def close(self):
+        """Cancels all upstreams that are still open"""
+        for uid in list(self.upstreams):
+            self.cancel_upstream(uid, "stream closed")
+
+    def record_metrics(self):
+        """Records the metrics of the stream once it is done"""
+        metrics.STREAMS_IN_FLIGHT.dec()
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - self.start_time, sampling_mode=self.request.sampling_mode)
+        if self.first_chunk_at is not None:
+            metrics.TIME_TO_FIRST_CHUNK.observe(
+                self.first_chunk_at - self.start_time, sampling_mode=self.request.sampling_mode
+            )
+        for uid, skipped_chunks in self.skipped_chunks.items():
+            metrics.UID_SKIPPED_CHUNKS.inc(skipped_chunks, uid=uid)
+
+    def process_chunk(
+        self, chunk: str, miner_uid: int = -1, validator_uid: int = -1, json_object: Optional[dict] = None
+    ) -> list[StreamChunk | StreamError]:
         """Processes a chunk of data from a miner (or miner through a validator) and streams it back
            through the API
 
@@ -78,49 +575,294 @@ class StreamManager:
             chunk (str): miner response
             miner_uid (int): miner UID (-1 if from a validator - we'll get the miner UID from the chunk)
             validator_uid (int): validator UID (-1 if direct from a miner)
+            json_object (Optional[dict]): the chunk decoded by `JSONFrameDecoder` (empty if it is raw text),
+                when not given the chunk is decoded here
 
         Returns:
-            Optional[StreamChunk]: If it's a valid chunk, returns a StreamChunk object, otherwise None
+            list[StreamChunk | StreamError]: the chunks to stream back, empty if the miner isn't selected. Selecting
+                a miner streams the chunks it was kept aside with, and a miner dropped at this chunk is followed
+                by the miners that take its place.
         """
-        logger.debug(f"Processing chunk: {chunk}")
+        # Chunks are only logged once in a while, so logs don't grow with the length of responses
+        self.chunks_received += 1
+        if sample_chunk_log(self.chunks_received):
+            logger.debug("Processing chunk {}: {}", self.chunks_received, truncate(chunk))
 
         # Validators usually return JSON but miners don't unless its an error (has a message)
-        try:
-            json_object = json.loads(chunk)
-        except json.decoder.JSONDecodeError:
-            # If we didn't get a JSON response, it could due to a validator who hasn't upgraded or due to a normal miner response
-            json_object = {}
+        if json_object is None:
+            try:
+                json_object = json.loads(chunk)
+            except json.decoder.JSONDecodeError:
+                # If we didn't get a JSON response, it could due to a validator who hasn't upgraded or due to a normal miner response
+                json_object = {}
 
         chunk_delta = json_object.get("chunk", chunk)
-        miner_uid = json_object.get("uid", miner_uid)
+        # The chunks are built without validation, so the UID sent by the validator is coerced here
+        try:
+            miner_uid = int(json_object.get("uid", miner_uid))
+        except (TypeError, ValueError):
+            return [self.generate_error_chunk(f"invalid miner uid {json_object['uid']!r}", -1, validator_uid)]
 
         if message := json_object.get("message"):
-            return self.generate_error_chunk(message, miner_uid, validator_uid)
+            return [self.generate_error_chunk(message, miner_uid, validator_uid)]
+
+        timing = time.perf_counter() - self.start_time
+        if miner_uid in self.selected_miners:
+            return self.stream_chunk(chunk_delta, miner_uid, validator_uid, timing)
 
         # Check if we should stream this response
-        if self.request.k > len(self.selected_miners):
-            # We will choose the first miners that responds
-            self.selected_miners.add(miner_uid)
-        elif miner_uid not in self.accumulated_chunks:
+        if miner_uid in self.dropped_miners or (len(self.selected_miners) >= self.request.k and not self.probation):
             # Skip this miner since we have enough
-            logger.debug(f"Skipping miner {miner_uid}")
-            return
+            self.skipped_chunks[miner_uid] += 1
+            if sample_chunk_log(self.skipped_chunks[miner_uid]):
+                logger.debug("Skipping miner {} ({} chunks skipped)", miner_uid, self.skipped_chunks[miner_uid])
+            return []
+
+        # We will choose the first miners that stream some text, their chunks are kept aside until then
+        _, buffered = self.standby_chunks.setdefault(miner_uid, (validator_uid, []))
+        buffered.append((chunk_delta, timing))
+        if len(self.selected_miners) >= self.request.k or not has_text(chunk_delta):
+            return []
+        return self.select_miner(miner_uid)
 
+    def stream_chunk(
+        self, chunk_delta: str, miner_uid: int, validator_uid: int, timing: float
+    ) -> list[StreamChunk | StreamError]:
+        """Streams a chunk of a selected miner, and checks it while the miner is on probation"""
         self.accumulated_chunks[miner_uid].append(chunk_delta)
-        self.accumulated_timings[miner_uid].append(time.perf_counter() - self.start_time)
+        self.accumulated_timings[miner_uid].append(timing)
         sequence_number = len(self.accumulated_chunks[miner_uid])
 
-        return StreamChunk(
-            delta=chunk_delta,
-            finish_reason=None,
-            accumulated_chunks=self.accumulated_chunks[miner_uid],
-            accumulated_timings=self.accumulated_timings[miner_uid],
-            timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
-            sequence_number=sequence_number,
-            miner_uid=miner_uid,
-            validator_uid=validator_uid,
+        # Chunks are constructed without validation since this runs for every chunk of every stream
+        if self.request.stream_format == "delta":
+            # Only send what is new, the accumulated response is sent once with the completed chunk
+            stream_chunk = StreamChunk.model_construct(
+                delta=chunk_delta,
+                finish_reason=None,
+                timing=timing,
+                timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                sequence_number=sequence_number,
+                miner_uid=miner_uid,
+                validator_uid=validator_uid,
+            )
+        else:
+            stream_chunk = StreamChunk.model_construct(
+                delta=chunk_delta,
+                finish_reason=None,
+                accumulated_chunks=self.accumulated_chunks[miner_uid],
+                accumulated_timings=self.accumulated_timings[miner_uid],
+                timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                sequence_number=sequence_number,
+                miner_uid=miner_uid,
+                validator_uid=validator_uid,
+            )
+
+        if miner_uid not in self.probation:
+            return [stream_chunk]
+        if has_text(chunk_delta):
+            self.last_progress[miner_uid] = time.perf_counter()
+        if self.probation[miner_uid].update(chunk_delta):
+            return [stream_chunk, *self.end_probation(miner_uid, validator_uid)]
+        return [stream_chunk]
+
+    def select_miner(self, miner_uid: int) -> list[StreamChunk | StreamError]:
+        """Selects a miner that was kept aside, and streams the chunks it sent so far"""
+        validator_uid, buffered = self.standby_chunks.pop(miner_uid)
+        self.selected_miners.add(miner_uid)
+        self.miner_validator_uids.setdefault(miner_uid, validator_uid)
+        if self.probation_chars > 0:
+            self.probation[miner_uid] = PrefixHash(self.probation_chars)
+            self.last_progress[miner_uid] = time.perf_counter()
+
+        chunks = []
+        for chunk_delta, timing in buffered:
+            chunks.extend(self.stream_chunk(chunk_delta, miner_uid, validator_uid, timing))
+            if miner_uid in self.dropped_miners:
+                return chunks
+
+        if miner_uid in self.finished_standby:
+            # The stream of the miner finished while it was kept aside
+            if miner_uid in self.probation:
+                chunks.extend(self.end_probation(miner_uid, validator_uid, finished=True))
+            if miner_uid in self.selected_miners:
+                chunks.extend(self.generate_last_chunks(miner_uid, validator_uid))
+        return chunks
+
+    def end_probation(
+        self, miner_uid: int, validator_uid: int, finished: bool = False
+    ) -> list[StreamChunk | StreamError]:
+        """Ends the probation of a miner that streamed `STREAM_PROBATION_CHARS` characters (or finished). It is
+        dropped if another selected miner already streamed the same prefix, unless it finished (responses shorter
+        than the prefix, e.g. short factual answers, are expected to agree) or no miner kept aside can take its slot.
+        """
+        prefix = self.probation.pop(miner_uid)
+        self.last_progress.pop(miner_uid, None)
+        if not self.dedup or prefix.key is None:
+            return []
+        original_uid = self.prefix_owners.setdefault(prefix.key, miner_uid)
+        if original_uid == miner_uid or finished or not self.has_standby():
+            return []
+        return self.drop_miner(miner_uid, validator_uid, "duplicate", f"same response as miner {original_uid}")
+
+    def drop_miner(
+        self, miner_uid: int, validator_uid: int, reason: str, details: str = ""
+    ) -> list[StreamChunk | StreamError]:
+        """Drops a selected miner and cancels its upstream (when streaming from miners), then selects the miners
+        kept aside to take its place
+        """
+        logger.info("Dropping miner {}: {} {}", miner_uid, reason, details)
+        metrics.MINERS_DROPPED.inc(reason=reason)
+        self.selected_miners.discard(miner_uid)
+        self.dropped_miners.add(miner_uid)
+        self.miner_validator_uids.pop(miner_uid, None)
+        self.probation.pop(miner_uid, None)
+        self.last_progress.pop(miner_uid, None)
+        self.accumulated_chunks.pop(miner_uid, None)
+        self.accumulated_timings.pop(miner_uid, None)
+        self.prefix_owners = {key: uid for key, uid in self.prefix_owners.items() if uid != miner_uid}
+        if not self.request.query_validators and miner_uid in self.upstreams:
+            # Stalling counts as timing out in the latency scoreboard and circuit breaker
+            self.upstream_stats[miner_uid].timed_out = reason == "stalled"
+            self.record_upstream(miner_uid)
+            self.cancel_upstream(miner_uid, reason)
+        return [self.generate_dropped_chunk(miner_uid, validator_uid), *self.promote_standby()]
+
+    def has_standby(self) -> bool:
+        """Whether a miner kept aside streamed some text, and so can take the slot of a dropped miner"""
+        return any(
+            any(has_text(chunk_delta) for chunk_delta, _ in buffered) for _, buffered in self.standby_chunks.values()
         )
 
+    def promote_standby(self) -> list[StreamChunk | StreamError]:
+        """Selects the miners kept aside that streamed some text for the free slots, in the order they responded"""
+        chunks = []
+        while len(self.selected_miners) < self.request.k:
+            miner_uid = next(
+                (
+                    uid
+                    for uid, (_, buffered) in self.standby_chunks.items()
+                    if any(has_text(chunk_delta) for chunk_delta, _ in buffered)
+                ),
+                None,
+            )
+            if miner_uid is None:
+                break
+            chunks.extend(self.select_miner(miner_uid))
+        return chunks
+
+    def stall_deadline(self) -> Optional[float]:
+        """The time at which the first miner on probation stalls, None if stalled miners can't be replaced"""
+        if not self.stall_timeout or not self.last_progress:
+            return None
+        if not self.standby_chunks and (
+            self.request.query_validators or all(uid in self.selected_miners for uid in self.upstreams)
+        ):
+            return None
+        return min(self.last_progress.values()) + self.stall_timeout
+
+    def upstream_deadline(self, uid: int) -> Optional[tuple[float, str]]:
+        """When an upstream times out (see the `first_chunk_timeout`, `idle_timeout` and `total_timeout` of the
+        request) and which timeout it is, None if it can't time out
+        """
+        stats = self.upstream_stats[uid]
+        if stats.start_time is None:
+            return None
+        deadlines = []
+        if self.request.total_timeout:
+            deadlines.append((stats.start_time + self.request.total_timeout, "total_timeout"))
+        if stats.last_read_time is None:
+            if self.request.first_chunk_timeout:
+                deadlines.append((stats.start_time + self.request.first_chunk_timeout, "first_chunk_timeout"))
+        elif self.request.idle_timeout:
+            deadlines.append((stats.last_read_time + self.request.idle_timeout, "idle_timeout"))
+        return min(deadlines, default=None)
+
+    def next_deadline(self) -> Optional[float]:
+        """The next time an upstream times out or a miner on probation stalls, None if none can"""
+        deadlines = []
+        if self.upstream_timeouts:
+            deadlines = [deadline for uid in self.upstreams if (deadline := self.upstream_deadline(uid)) is not None]
+        if (stall_deadline := self.stall_deadline()) is not None:
+            deadlines.append((stall_deadline, "stalled"))
+        return min(deadlines, default=(None,))[0]
+
+    def expire_upstreams(self) -> list[StreamError]:
+        """Cancels the upstreams that timed out, the other upstreams carry on"""
+        if not self.upstream_timeouts:
+            return []
+        now = time.perf_counter()
+        error_chunks = []
+        for uid in list(self.upstreams):
+            deadline = self.upstream_deadline(uid)
+            if deadline is None or deadline[0] > now:
+                continue
+            reason = deadline[1]
+            # Like the request timeout, the total timeout cuts off upstreams that were still streaming
+            stats = self.upstream_stats[uid]
+            stats.timed_out = reason != "total_timeout" or stats.last_read_time is None
+            self.record_upstream(uid)
+            self.cancel_upstream(uid, reason)
+            if self.is_hedge_pending(uid):
+                continue
+
+            validator_uid = uid if self.request.query_validators else -1
+            miner_uid = uid if not self.request.query_validators else -1
+            self.discard_stream(miner_uid, validator_uid)
+            error = UPSTREAM_TIMEOUT_ERRORS[reason].format(getattr(self.request, reason))
+            error_chunks.append(self.generate_error_chunk(error, miner_uid, validator_uid, reason=reason))
+        return error_chunks
+
+    def drop_stalled_miners(self) -> list[StreamChunk | StreamError]:
+        """Drops the miners on probation that streamed no text for `STREAM_STALL_TIMEOUT` seconds"""
+        stalled_before = time.perf_counter() - self.stall_timeout
+        chunks = []
+        for miner_uid, last_progress in list(self.last_progress.items()):
+            if miner_uid in self.last_progress and last_progress <= stalled_before:
+                chunks.extend(self.drop_miner(miner_uid, self.miner_validator_uids[miner_uid], "stalled"))
+        return chunks
+
+    def stream_miners(self, miner_uid: int, validator_uid: int) -> list[int]:
+        """The selected miners and the miners kept aside of a stream"""
+        if miner_uid != -1:
+            return [miner_uid]
+        return [uid for uid, uid_validator in self.miner_validator_uids.items() if uid_validator == validator_uid] + [
+            uid for uid, (uid_validator, _) in self.standby_chunks.items() if uid_validator == validator_uid
+        ]
+
+    def finish_stream(self, miner_uid: int = -1, validator_uid: int = -1) -> list[StreamChunk | StreamError]:
+        """Generates the chunks sent when a stream finishes: its miners on probation end it, then the "completed"
+        chunks are sent. Miners kept aside only get theirs if they are selected later on.
+        """
+        chunks = []
+        for uid in self.stream_miners(miner_uid, validator_uid):
+            if uid in self.probation:
+                chunks.extend(self.end_probation(uid, validator_uid, finished=True))
+        if miner_uid == -1 or (miner_uid not in self.standby_chunks and miner_uid not in self.dropped_miners):
+            chunks.extend(self.generate_last_chunks(miner_uid, validator_uid))
+        for uid in self.stream_miners(miner_uid, validator_uid):
+            if uid in self.standby_chunks:
+                self.finished_standby.add(uid)
+        return chunks
+
+    def discard_stream(self, miner_uid: int = -1, validator_uid: int = -1):
+        """Forgets the miners kept aside and ends the probation of the miners of a stream that failed"""
+        for uid in self.stream_miners(miner_uid, validator_uid):
+            self.standby_chunks.pop(uid, None)
+            self.probation.pop(uid, None)
+            self.last_progress.pop(uid, None)
+
+    def generate_last_chunks(self, miner_uid: int = -1, validator_uid: int = -1) -> list[StreamChunk]:
+        """Generates the "completed" chunks sent when a stream finishes.
+        In the "delta" stream format, every miner of the stream gets its own completed chunk which carries
+        its accumulated response, otherwise a single completed chunk is sent for the stream.
+        """
+        if self.request.stream_format != "delta":
+            return [self.generate_last_chunk(miner_uid, validator_uid)]
+
+        # Validator streams contain every miner that was selected through them
+        miner_uids = [miner_uid] if miner_uid != -1 else list(self.accumulated_chunks) or [-1]
+        return [self.generate_last_chunk(uid, validator_uid) for uid in miner_uids]
+
     def generate_last_chunk(self, miner_uid: int = -1, validator_uid: int = -1) -> StreamChunk:
         """Generates the last chunk of the stream with a finish reason.
         If we're streaming multiple miners, we'll still only send one last "completed"
@@ -136,6 +878,19 @@ class StreamManager:
             )
 
         logger.info("Processing of stream finished")
+        if self.request.stream_format == "delta":
+            return StreamChunk(
+                delta="",
+                finish_reason="completed",
+                accumulated_chunks=self.accumulated_chunks.get(miner_uid, []),
+                accumulated_timings=self.accumulated_timings.get(miner_uid, []),
+                timing=time.perf_counter() - self.start_time,
+                timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                sequence_number=-1,
+                miner_uid=miner_uid,
+                validator_uid=validator_uid,
+            )
+
         return StreamChunk(
             delta="",
             finish_reason="completed",
@@ -147,13 +902,32 @@ class StreamManager:
             validator_uid=validator_uid,
         )
 
-    def generate_error_chunk(self, error: str, miner_uid: int = -1, validator_uid: int = -1) -> StreamError:
-        """Generates an error chunk to be streamed back through the API"""
+    def generate_dropped_chunk(self, miner_uid: int, validator_uid: int = -1) -> StreamChunk:
+        """Generates the chunk telling the client to discard the response of a dropped miner"""
+        return StreamChunk(
+            delta="",
+            finish_reason="dropped",
+            accumulated_chunks=[],
+            accumulated_timings=[],
+            timing=time.perf_counter() - self.start_time if self.request.stream_format == "delta" else None,
+            timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            sequence_number=-1,
+            miner_uid=miner_uid,
+            validator_uid=validator_uid,
+        )
+
+    def generate_error_chunk(
+        self, error: str, miner_uid: int = -1, validator_uid: int = -1, reason: Optional[str] = None
+    ) -> StreamError:
+        """Generates an error chunk to be streamed back through the API, `reason` tells which timeout expired"""
         logger.error(f"Chunk has no data.  Returning error: {error}")
+        self.failed = True
+        metrics.UID_ERRORS.inc(uid=miner_uid if miner_uid != -1 else validator_uid)
         return StreamError(
             error=error,
             timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
             sequence_number=-1,
+            reason=reason,
             miner_uid=miner_uid,
             validator_uid=validator_uid,
         )
@@ -0,0 +1,234 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Optional
+from loguru import logger
+
+from network.utils import metrics
+import settings
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request can't be admitted, `retry_after` is a hint of when it could be (in seconds)"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Rate limit that allows bursts of up to `burst` requests, refilled at `rate` requests per second"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self) -> float:
+        """Takes a token, returns 0 if there was one, otherwise the time in seconds until there will be one"""
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    @property
+    def full(self) -> bool:
+        self.refill()
+        return self.tokens >= self.burst
+
+
+class StreamLimiter:
+    """Caps the number of upstream streams that are open at the same time across all requests.
+
+    Requests reserve the streams they are going to open (e.g. `k` miners) and wait in a bounded FIFO queue while
+    there aren't enough free streams. Requests are shed right away when the queue is full, or when the expected wait
+    (estimated from how long streams are held on average) already exceeds the timeout of the request, rather than
+    letting every request of a burst time out.
+    """
+
+    def __init__(
+        self,
+        max_streams: int = settings.ADMISSION_MAX_UPSTREAM_STREAMS,
+        max_queue: int = settings.ADMISSION_MAX_QUEUE,
+    ):
+        self.max_streams = max_streams
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiters: deque[tuple[int, asyncio.Future]] = deque()
+        # Moving average of how long streams are reserved for, in seconds
+        self.hold_time: Optional[float] = None
+
+    async def acquire(self, streams: int, timeout: float) -> int:
+        """Reserves upstream streams, waiting for them to be released by other requests if needed
+
+        Args:
+            streams (int): the number of upstream streams the request opens
+            timeout (float): the time in seconds the request may wait for
+
+        Raises:
+            AdmissionRejected: the queue is full, or the streams aren't released in time
+
+        Returns:
+            int: the number of streams that were reserved, to be passed to `release`
+        """
+        streams = min(streams, self.max_streams)
+        if not self.waiters and self.active + streams <= self.max_streams:
+            self._reserve(streams)
+            return streams
+
+        if len(self.waiters) >= self.max_queue:
+            raise self._reject("queue_full", self.expected_wait(streams) or 1.0)
+        expected_wait = self.expected_wait(streams)
+        if expected_wait is not None and expected_wait > timeout:
+            raise self._reject("expected_wait_exceeds_timeout", expected_wait)
+
+        waiter = (streams, asyncio.get_running_loop().create_future())
+        self.waiters.append(waiter)
+        metrics.ADMISSION_QUEUE_DEPTH.set(len(self.waiters))
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter[1].done() and not waiter[1].cancelled():
+                # The streams were reserved just as the wait ended
+                self.release(streams)
+            else:
+                self.waiters.remove(waiter)
+                metrics.ADMISSION_QUEUE_DEPTH.set(len(self.waiters))
+                # The requests behind may fit now that this one is out of the queue
+                self._wake_waiters()
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject("wait_timed_out", self.expected_wait(streams) or timeout) from e
+            raise
+        return streams
+
+    def release(self, streams: int, hold_time: Optional[float] = None):
+        """Releases reserved upstream streams
+
+        Args:
+            streams (int): the number of streams returned by `acquire`
+            hold_time (Optional[float]): the time in seconds the streams were reserved for
+        """
+        self.active -= streams
+        metrics.UPSTREAM_STREAMS_ACTIVE.set(self.active)
+        if hold_time is not None:
+            if self.hold_time is None:
+                self.hold_time = hold_time
+            else:
+                self.hold_time += settings.SCOREBOARD_EWMA_ALPHA * (hold_time - self.hold_time)
+        self._wake_waiters()
+
+    def expected_wait(self, streams: int) -> Optional[float]:
+        """Estimates the time in seconds until the streams could be reserved (None until streams were released)"""
+        if self.hold_time is None:
+            return None
+        # Streams that have to be released before it's the turn of this request
+        ahead = self.active + sum(queued for queued, _ in self.waiters) + streams - self.max_streams
+        return max(ahead, 0) * self.hold_time / self.max_streams
+
+    def _reserve(self, streams: int):
+        self.active += streams
+        metrics.UPSTREAM_STREAMS_ACTIVE.set(self.active)
+
+    def _wake_waiters(self):
+        # Requests are admitted in order, so a large request isn't starved by smaller ones behind it
+        while self.waiters and self.active + self.waiters[0][0] <= self.max_streams:
+            streams, future = self.waiters.popleft()
+            if not future.done():
+                self._reserve(streams)
+                future.set_result(None)
+        metrics.ADMISSION_QUEUE_DEPTH.set(len(self.waiters))
+
+    def _reject(self, reason: str, retry_after: float) -> AdmissionRejected:
+        logger.warning(
+            "Rejecting request ({}): {} upstream streams open, {} queued", reason, self.active, len(self.waiters)
+        )
+        metrics.ADMISSION_REJECTIONS.inc(reason=reason)
+        return AdmissionRejected(reason, retry_after)
+
+
+class StreamReservation:
+    """Upstream streams reserved for a request through a `StreamLimiter`. Releasing them is idempotent, so they can be
+    released both when the stream of the request finishes and when its response is closed (the stream may never be
+    iterated, e.g. if the client disconnects before the response starts), whichever happens first.
+    """
+
+    __slots__ = ("limiter", "streams", "reserved_at", "released")
+
+    def __init__(self, limiter: StreamLimiter, streams: int):
+        self.limiter = limiter
+        self.streams = streams
+        self.reserved_at = time.perf_counter()
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.limiter.release(self.streams, time.perf_counter() - self.reserved_at)
+
+
+class KeyLimiter:
+    """Limits the concurrent requests and the request rate of each API key"""
+
+    # Idle keys are forgotten once there are more than this many
+    MAX_IDLE_KEYS = 10_000
+
+    def __init__(
+        self,
+        max_concurrent: int = settings.API_KEY_MAX_CONCURRENT_REQUESTS,
+        rate: float = settings.API_KEY_RATE_LIMIT,
+        burst: float = settings.API_KEY_BURST,
+    ):
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+        self.concurrent: dict[str, int] = {}
+        self.buckets: dict[str, TokenBucket] = {}
+
+    def acquire(self, key: str):
+        """Admits a request of the key, which must be released once it has finished
+
+        Raises:
+            AdmissionRejected: the key has too many requests in flight or has exceeded its rate
+        """
+        if 0 < self.max_concurrent <= self.concurrent.get(key, 0):
+            metrics.ADMISSION_REJECTIONS.inc(reason="key_concurrency")
+            raise AdmissionRejected("key_concurrency", 1.0)
+
+        if self.rate > 0:
+            if (bucket := self.buckets.get(key)) is None:
+                if len(self.buckets) > self.MAX_IDLE_KEYS:
+                    self._forget_idle_keys()
+                bucket = self.buckets[key] = TokenBucket(self.rate, max(self.burst, 1))
+            if (retry_after := bucket.take()) > 0:
+                metrics.ADMISSION_REJECTIONS.inc(reason="key_rate")
+                raise AdmissionRejected("key_rate", retry_after)
+
+        self.concurrent[key] = self.concurrent.get(key, 0) + 1
+
+    def release(self, key: str):
+        if (concurrent := self.concurrent[key] - 1) > 0:
+            self.concurrent[key] = concurrent
+        else:
+            del self.concurrent[key]
+
+    def _forget_idle_keys(self):
+        # Keys with a full bucket and no request in flight are in the same state as keys that were never seen
+        for key in [key for key, bucket in self.buckets.items() if bucket.full and key not in self.concurrent]:
+            del self.buckets[key]
+
+
+def retry_after_header(retry_after: float) -> dict[str, str]:
+    """The Retry-After header of a rejected request (in whole seconds)"""
+    return {"Retry-After": str(max(1, math.ceil(retry_after)))}
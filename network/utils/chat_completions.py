@@ -0,0 +1,161 @@
+import asyncio
+import json
+import time
+import uuid
+from json.encoder import encode_basestring_ascii
+from typing import AsyncIterator, Optional
+
+from network.meta.schemas import StreamChunk, StreamError
+from network.utils.completion_cache import CachedResponse
+from network.utils import metrics
+
+# Server-sent events are framed as "data: <json>" lines followed by a blank line, lines starting with ":" are comments
+# that clients ignore (and keep idle connections alive)
+DONE_EVENT = b"data: [DONE]\n\n"
+HEARTBEAT_EVENT = b": ping\n\n"
+# Queued after the last event forwarded by `with_heartbeats`
+_EVENTS_END = object()
+
+# Asks proxies (e.g. nginx) not to buffer or cache the events
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# The finish reasons of the OpenAI API for the finish reasons of the chunks of the StreamManager, "dropped" is kept
+FINISH_REASONS = {"completed": "stop"}
+
+_FIRST_DELTA_TEMPLATE = '{"role":"assistant","content":%s}'
+_DELTA_TEMPLATE = '{"content":%s}'
+
+
+def encode_event(data: dict) -> bytes:
+    return b"data: " + json.dumps(data, separators=(",", ":")).encode("utf-8") + b"\n\n"
+
+
+class ChatCompletionEncoder:
+    """Encodes the chunks of a StreamManager (in the "delta" stream format) as the chunks of the OpenAI chat completions
+    API. Every selected miner is a choice, numbered in the order the miners were selected: a dropped miner's choice is
+    finished with the "dropped" finish reason and the miner replacing it gets a new choice.
+    """
+
+    def __init__(self, model: str):
+        self.id = f"chatcmpl-{uuid.uuid4().hex}"
+        self.created = int(time.time())
+        self.model = model
+        # The choice index of every miner UID
+        self.choices: dict[int, int] = {}
+        # Only the choices differ between the chunks of a completion
+        self._prefix = 'data: {"id":%s,"object":"chat.completion.chunk","created":%d,"model":%s,"choices":[' % (
+            encode_basestring_ascii(self.id),
+            self.created,
+            encode_basestring_ascii(model),
+        )
+
+    def encode(self, chunk: StreamChunk | StreamError) -> Optional[bytes]:
+        """Encodes a chunk as a server-sent event, None if it has nothing to send"""
+        if isinstance(chunk, StreamError):
+            error = {"message": chunk.error, "type": "upstream_error", "code": chunk.reason}
+            return encode_event({"error": error, "miner_uid": chunk.miner_uid, "validator_uid": chunk.validator_uid})
+
+        if chunk.finish_reason is None:
+            # The first chunk of a choice carries the role of its author
+            template = _DELTA_TEMPLATE if chunk.miner_uid in self.choices else _FIRST_DELTA_TEMPLATE
+            delta = template % encode_basestring_ascii(chunk.delta)
+            finish_reason = "null"
+        elif chunk.miner_uid == -1:
+            # The end of a validator stream through which no miner was selected
+            return None
+        else:
+            delta = "{}"
+            finish_reason = encode_basestring_ascii(FINISH_REASONS.get(chunk.finish_reason, chunk.finish_reason))
+
+        index = self.choices.setdefault(chunk.miner_uid, len(self.choices))
+        event = '%s{"index":%d,"delta":%s,"finish_reason":%s,"miner_uid":%d,"validator_uid":%d}]}\n\n' % (
+            self._prefix,
+            index,
+            delta,
+            finish_reason,
+            chunk.miner_uid,
+            chunk.validator_uid,
+        )
+        return event.encode("utf-8")
+
+    def completion(self, responses: list[CachedResponse], errors: list[StreamError]) -> dict:
+        """The (non streamed) chat completion of the responses of the selected miners, the choices of miners that
+        failed are finished with the "error" finish reason
+        """
+        failed_uids = {error.miner_uid for error in errors}
+        return {
+            "id": self.id,
+            "object": "chat.completion",
+            "created": self.created,
+            "model": self.model,
+            "choices": [
+                {
+                    "index": index,
+                    "message": {"role": "assistant", "content": "".join(response.chunks)},
+                    "finish_reason": "error" if response.miner_uid in failed_uids else "stop",
+                    "miner_uid": response.miner_uid,
+                    "validator_uid": response.validator_uid,
+                }
+                for index, response in enumerate(responses)
+            ],
+        }
+
+
+async def chat_completion_events(
+    chunks: AsyncIterator[StreamChunk | StreamError], encoder: ChatCompletionEncoder
+) -> AsyncIterator[bytes]:
+    """Encodes the chunks as server-sent events, ended by "data: [DONE]" """
+    events = total_bytes = 0
+    try:
+        async for chunk in chunks:
+            if (event := encoder.encode(chunk)) is not None:
+                events += 1
+                total_bytes += len(event)
+                yield event
+        yield DONE_EVENT
+    finally:
+        await chunks.aclose()
+        metrics.CHUNKS_STREAMED.inc(events, stream_format="openai")
+        metrics.BYTES_STREAMED.inc(total_bytes, stream_format="openai")
+
+
+async def with_heartbeats(events: AsyncIterator[bytes], interval: float) -> AsyncIterator[bytes]:
+    """Forwards the events, with a heartbeat comment whenever none was sent for `interval` seconds (0 = never)"""
+    if interval <= 0:
+        try:
+            async for event in events:
+                yield event
+        finally:
+            await events.aclose()
+        return
+
+    # The events are consumed by a single task, as the generators they come from (e.g. the timeout of the
+    # StreamManager) must run in the same task from start to finish. At most one event waits to be sent
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+
+    async def pump():
+        try:
+            async for event in events:
+                await queue.put(event)
+            await queue.put(_EVENTS_END)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await events.aclose()
+
+    pump_task = asyncio.create_task(pump())
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), interval)
+            except asyncio.TimeoutError:
+                yield HEARTBEAT_EVENT
+                continue
+            if event is _EVENTS_END:
+                return
+            if isinstance(event, Exception):
+                raise event
+            yield event
+    finally:
+        pump_task.cancel()
+        await asyncio.gather(pump_task, return_exceptions=True)
@@ -0,0 +1,149 @@
+import time
+from typing import Hashable, Optional
+
+import bittensor as bt
+from loguru import logger
+
+import settings
+
+
+class AllQuarantined(Exception):
+    """Raised when every candidate UID is quarantined, `retry_after` is when one is let through again (in seconds)"""
+
+    def __init__(self, retry_after: float):
+        super().__init__("All candidate uids are quarantined after failing")
+        self.retry_after = retry_after
+
+
+class Circuit:
+    """State of the circuit of a single UID or axon IP"""
+
+    __slots__ = ("failures", "opened_at", "backoff", "probe_started_at")
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.backoff = 0.0
+        self.probe_started_at: Optional[float] = None
+
+
+class CircuitBreaker:
+    """Quarantines UIDs (and axon IPs) whose streams keep failing.
+
+    After `failure_threshold` consecutive failed or timed out streams, the circuit of the UID (and of its axon IP,
+    which is shared by all UIDs served from it) opens and the UID is removed from the candidates of every sampling
+    mode. Once the backoff has passed, the circuit is half-open: a single request is let through as a probe. If the
+    probe succeeds the circuit closes again, otherwise it reopens with twice the backoff (up to `max_backoff`).
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = settings.CIRCUIT_BREAKER_FAILURES,
+        backoff: float = settings.CIRCUIT_BREAKER_BACKOFF,
+        max_backoff: float = settings.CIRCUIT_BREAKER_MAX_BACKOFF,
+    ):
+        self.failure_threshold = failure_threshold
+        self.initial_backoff = backoff
+        self.max_backoff = max_backoff
+        self.circuits: dict[Hashable, Circuit] = {}
+        # The IP each UID was sampled with, so the outcome of its stream is also recorded for the IP
+        self.uid_ips: dict[int, str] = {}
+
+    def allowed_uids(self, uids: list[int], metagraph: "bt.metagraph.Metagraph") -> list[int]:
+        """Removes the quarantined UIDs (or UIDs served from a quarantined IP) from the candidates
+
+        Args:
+            uids (list[int]): candidate UIDs
+            metagraph (bt.metagraph.Metagraph): metagraph the UIDs were sampled from
+
+        Returns:
+            list[int]: candidates that can be queried
+        """
+        if not self.circuits:
+            return list(uids)
+
+        now = time.monotonic()
+        return [
+            uid
+            for uid in uids
+            if self._allows(("uid", uid), now) and self._allows(("ip", self._ip(uid, metagraph)), now)
+        ]
+
+    def start(self, uids: list[int], metagraph: "bt.metagraph.Metagraph"):
+        """Marks the sampled UIDs, so that half-open circuits only let a single probe through"""
+        now = time.monotonic()
+        for uid in uids:
+            for key in (("uid", uid), ("ip", self._ip(uid, metagraph))):
+                if (circuit := self.circuits.get(key)) is not None and circuit.opened_at is not None:
+                    circuit.probe_started_at = now
+
+    def record(self, uid: int, failed: bool):
+        """Records the outcome of a stream of a UID
+
+        Args:
+            uid (int): UID that produced the stream
+            failed (bool): whether the stream failed or timed out
+        """
+        keys = [("uid", uid)]
+        if (ip := self.uid_ips.get(uid)) is not None:
+            keys.append(("ip", ip))
+
+        for key in keys:
+            if not failed:
+                if self.circuits.pop(key, None) is not None:
+                    logger.info(f"Circuit of {key[0]} {key[1]} closed")
+                continue
+
+            circuit = self.circuits.setdefault(key, Circuit())
+            circuit.failures += 1
+            if circuit.opened_at is not None:
+                # The probe failed
+                circuit.backoff = min(circuit.backoff * 2, self.max_backoff)
+            elif circuit.failures >= self.failure_threshold:
+                circuit.backoff = self.initial_backoff
+            else:
+                continue
+            circuit.opened_at = time.monotonic()
+            circuit.probe_started_at = None
+            logger.warning(
+                f"Circuit of {key[0]} {key[1]} opened for {circuit.backoff}s after {circuit.failures} failures"
+            )
+
+    def retry_after(self, uids: list[int], metagraph: "bt.metagraph.Metagraph") -> float:
+        """The time in seconds until one of the quarantined UIDs is let through again (as a probe)"""
+        now = time.monotonic()
+        return min(
+            (
+                max(self._remaining(("uid", uid), now), self._remaining(("ip", self._ip(uid, metagraph)), now))
+                for uid in uids
+            ),
+            default=0.0,
+        )
+
+    def is_open(self, uid: int) -> bool:
+        """Whether the UID is currently quarantined (ignoring its IP)"""
+        circuit = self.circuits.get(("uid", uid))
+        return circuit is not None and circuit.opened_at is not None
+
+    def _ip(self, uid: int, metagraph: "bt.metagraph.Metagraph") -> str:
+        ip = metagraph.axons[uid].ip if 0 <= uid < len(metagraph.axons) else ""
+        self.uid_ips[uid] = ip
+        return ip
+
+    def _allows(self, key: Hashable, now: float) -> bool:
+        circuit = self.circuits.get(key)
+        if circuit is None or circuit.opened_at is None:
+            return True
+        if now - circuit.opened_at < circuit.backoff:
+            return False
+        # Half-open, let a single probe through (or another one if the last probe never reported back)
+        return circuit.probe_started_at is None or now - circuit.probe_started_at >= circuit.backoff
+
+    def _remaining(self, key: Hashable, now: float) -> float:
+        circuit = self.circuits.get(key)
+        if circuit is None or circuit.opened_at is None:
+            return 0.0
+        reopens_at = circuit.opened_at + circuit.backoff
+        if circuit.probe_started_at is not None:
+            reopens_at = max(reopens_at, circuit.probe_started_at + circuit.backoff)
+        return max(reopens_at - now, 0.0)
@@ -0,0 +1,101 @@
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import bittensor as bt
+from loguru import logger
+
+import settings
+
+
+class CachedResponse(NamedTuple):
+    """The response of a single miner (or miner through a validator) to a request"""
+
+    miner_uid: int
+    validator_uid: int
+    chunks: list[str]
+    timings: list[float]
+
+
+class CachedCompletion:
+    """The finished stream of a request, with the hotkeys of the UIDs that produced it"""
+
+    __slots__ = ("responses", "hotkeys", "expires_at", "size")
+
+    def __init__(self, responses: list[CachedResponse], hotkeys: dict[int, str], expires_at: float):
+        self.responses = responses
+        self.hotkeys = hotkeys
+        self.expires_at = expires_at
+        # Approximate memory used by the completion
+        self.size = sum(sum(map(len, response.chunks)) + 8 * len(response.timings) for response in responses)
+
+
+class CompletionCache:
+    """Caches the completions of requests, keyed by `QueryChatRequest.canonical_key` and the API key of the client
+    (see `network.neuron.client_key`), so a completion is only returned to the client that requested it.
+
+    Completions expire after `ttl` seconds and the least recently used completions are evicted once the cache
+    holds more than `max_size` bytes of responses. Completions are invalidated when one of the UIDs that produced
+    them changes hotkey (see `invalidate_changed_hotkeys`).
+    """
+
+    def __init__(self, max_size: int = settings.COMPLETION_CACHE_MAX_BYTES, ttl: float = settings.COMPLETION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self.completions: OrderedDict[str, CachedCompletion] = OrderedDict()
+
+    def get(self, key: str) -> Optional[CachedCompletion]:
+        """Returns the completion of the request (None if it isn't cached or has expired)"""
+        completion = self.completions.get(key)
+        if completion is None:
+            return None
+        if completion.expires_at <= time.monotonic():
+            self.remove(key)
+            return None
+
+        self.completions.move_to_end(key)
+        return completion
+
+    def put(self, key: str, responses: list[CachedResponse], metagraph: "bt.metagraph.Metagraph"):
+        """Caches the completion of a request
+
+        Args:
+            key (str): canonical key of the request
+            responses (list[CachedResponse]): the responses that were streamed for the request
+            metagraph (bt.metagraph.Metagraph): metagraph the UIDs of the responses were sampled from
+        """
+        uids = {uid for response in responses for uid in (response.miner_uid, response.validator_uid) if uid >= 0}
+        hotkeys = {uid: metagraph.hotkeys[uid] for uid in uids if uid < len(metagraph.hotkeys)}
+        completion = CachedCompletion(responses, hotkeys, time.monotonic() + self.ttl)
+        if completion.size > self.max_size:
+            logger.debug(f"Completion of {completion.size} bytes is too large to be cached")
+            return
+
+        self.remove(key)
+        self.completions[key] = completion
+        self.size += completion.size
+        while self.size > self.max_size:
+            self.remove(next(iter(self.completions)))
+
+    def remove(self, key: str):
+        if (completion := self.completions.pop(key, None)) is not None:
+            self.size -= completion.size
+
+    def invalidate_changed_hotkeys(self, metagraph: "bt.metagraph.Metagraph"):
+        """Removes the completions produced by UIDs that have changed hotkey (or expired) in a newly synced metagraph"""
+        now = time.monotonic()
+        hotkeys = metagraph.hotkeys
+        invalidated = [
+            key
+            for key, completion in self.completions.items()
+            if completion.expires_at <= now
+            or any(uid >= len(hotkeys) or hotkeys[uid] != hotkey for uid, hotkey in completion.hotkeys.items())
+        ]
+        for key in invalidated:
+            self.remove(key)
+        if invalidated:
+            logger.info(f"Invalidated {len(invalidated)} cached completions")
+
+    def __len__(self) -> int:
+        return len(self.completions)
@@ -0,0 +1,100 @@
+from typing import Optional
+
+import numpy as np
+
+from network.meta.schemas import AggregatedCompletion
+import settings
+
+# Completions are compared by the estimated Jaccard similarity of their sets of word n-grams, estimated from MinHash
+# signatures: the minimum of `NUM_PERMUTATIONS` random hash functions over the n-grams of a completion. Two
+# completions get the same minimum for a hash function with a probability equal to their Jaccard similarity.
+NGRAM_SIZE = 3
+NUM_PERMUTATIONS = 64
+_rng = np.random.default_rng(0)
+# Multiply-add hash functions (modulo 2^64), the multipliers are odd so they are permutations
+_MULTIPLIERS = _rng.integers(1, 2**63, NUM_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+_INCREMENTS = _rng.integers(0, 2**63, NUM_PERMUTATIONS, dtype=np.uint64)
+
+# Completions of at least `REPETITION_MIN_WORDS` words are degenerate if less than this share of their n-grams are
+# distinct, e.g. a miner stuck repeating the same sentence
+REPETITION_MIN_WORDS = 20
+REPETITION_MIN_DISTINCT = 0.3
+
+
+def ngrams(words: list[str]) -> set[str]:
+    """The word n-grams of a completion (the whole completion if it is shorter than an n-gram)"""
+    if len(words) < NGRAM_SIZE:
+        return {" ".join(words)}
+    return {" ".join(words[i : i + NGRAM_SIZE]) for i in range(len(words) - NGRAM_SIZE + 1)}
+
+
+def is_degenerate(words: list[str], shingles: set[str]) -> bool:
+    """Whether a completion is empty or mostly repeats itself"""
+    if not words:
+        return True
+    n_grams = max(len(words) - NGRAM_SIZE + 1, 1)
+    return len(words) >= REPETITION_MIN_WORDS and len(shingles) < REPETITION_MIN_DISTINCT * n_grams
+
+
+def minhash(shingles: set[str]) -> np.ndarray:
+    """MinHash signature of a set of n-grams"""
+    hashes = np.fromiter((hash(shingle) for shingle in shingles), dtype=np.int64, count=len(shingles))
+    hashes = hashes.view(np.uint64)
+    return (hashes[None, :] * _MULTIPLIERS[:, None] + _INCREMENTS[:, None]).min(axis=1)
+
+
+class Ensemble:
+    """Picks a completion among the completions of several miners, as they arrive.
+
+    Each completion agrees with the completions whose similarity with it is at least `threshold`. The chosen
+    completion is the one that agrees with the most completions (then with the highest mean similarity), so an
+    answer given by most miners wins over outliers. Empty and degenerate completions are left out.
+    """
+
+    def __init__(self, quorum: int, threshold: float = settings.ENSEMBLE_SIMILARITY_THRESHOLD):
+        self.quorum = quorum
+        self.threshold = threshold
+        # The miner and validator UIDs and the text of each completion, and their signatures
+        self.candidates: list[tuple[int, int, str]] = []
+        self.signatures = np.empty((0, NUM_PERMUTATIONS), dtype=np.uint64)
+        self.dropped = 0
+
+    def add(self, completion: str, miner_uid: int, validator_uid: int) -> bool:
+        """Adds a completion, returns whether `quorum` completions now agree with one of them"""
+        words = completion.lower().split()
+        shingles = ngrams(words)
+        if is_degenerate(words, shingles):
+            self.dropped += 1
+            return False
+
+        self.candidates.append((miner_uid, validator_uid, completion))
+        self.signatures = np.vstack([self.signatures, minhash(shingles)])
+        agreement, _ = self.scores()
+        return int(agreement.max()) >= self.quorum
+
+    def scores(self) -> tuple[np.ndarray, np.ndarray]:
+        """The number of completions each completion agrees with (including itself), and its mean similarity
+        to the other completions"""
+        similarity = (self.signatures[:, None, :] == self.signatures[None, :, :]).mean(axis=2)
+        agreement = (similarity >= self.threshold).sum(axis=1)
+        n = len(self.candidates)
+        mean_similarity = (similarity.sum(axis=1) - 1) / (n - 1) if n > 1 else np.ones(n)
+        return agreement, mean_similarity
+
+    def result(self) -> Optional[AggregatedCompletion]:
+        """The chosen completion, None if no usable completion was added"""
+        if not self.candidates:
+            return None
+        agreement, mean_similarity = self.scores()
+        # The most agreed upon completion, ties are broken by the mean similarity then by the first to arrive
+        best = int(np.lexsort((np.arange(len(agreement)), -mean_similarity, -agreement))[0])
+        miner_uid, validator_uid, completion = self.candidates[best]
+        return AggregatedCompletion(
+            completion=completion,
+            miner_uid=miner_uid,
+            validator_uid=validator_uid,
+            agreement=int(agreement[best]),
+            similarity=float(mean_similarity[best]),
+            completions=len(self.candidates),
+            dropped=self.dropped,
+        )
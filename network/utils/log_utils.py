@@ -0,0 +1,43 @@
+import sys
+from loguru import logger
+
+import settings
+
+# Logging on the hot path (every request, every chunk) follows a few rules so that the log volume and CPU don't
+# scale with the length of responses:
+#  - messages are formatted by loguru with arguments (`logger.debug("... {}", value)`), which skips the formatting
+#    when the level is disabled, rather than with f-strings that are always built
+#  - per-chunk messages are sampled with `sample_chunk_log`
+#  - prompts and chunks are truncated or redacted with `format_prompt` and `truncate`
+
+
+def configure_logging():
+    """Replaces the default loguru sink with one at `LOG_LEVEL`, which writes from a background thread if
+    `LOG_ENQUEUE` is set so that requests don't wait for the log writes.
+    """
+    logger.remove()
+    logger.add(sys.stderr, level=settings.LOG_LEVEL, enqueue=settings.LOG_ENQUEUE)
+
+
+def sample_chunk_log(chunk_count: int) -> bool:
+    """Whether the chunk with this (1-based) count in its stream is logged: the first chunk of every stream, then
+    one every `LOG_CHUNK_SAMPLE_EVERY` chunks (no chunks are logged if it is 0)
+    """
+    every = settings.LOG_CHUNK_SAMPLE_EVERY
+    return every > 0 and chunk_count % every == 1 % every
+
+
+def truncate(text: str, max_chars: int = settings.LOG_PROMPT_MAX_CHARS) -> str:
+    """Truncates text (e.g. a chunk) to `max_chars` characters"""
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... ({len(text) - max_chars} more characters)"
+
+
+def format_prompt(messages: list[str]) -> str:
+    """Formats the messages of a prompt according to `LOG_PROMPTS`: `full`, `truncate` or `redact`"""
+    if settings.LOG_PROMPTS == "full":
+        return repr(messages)
+    if settings.LOG_PROMPTS == "redact":
+        return f"<{len(messages)} messages, {sum(map(len, messages))} characters redacted>"
+    return repr([truncate(message) for message in messages])
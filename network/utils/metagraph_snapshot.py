@@ -0,0 +1,149 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+import bittensor as bt
+import numpy as np
+from loguru import logger
+from typing import Optional
+
+from network.utils.log_utils import configure_logging
+from network.utils.uid_utils import EligibilityIndex
+import settings
+
+# With several workers, a single refresher process syncs the metagraph and publishes it as a snapshot file which the
+# workers memory-map, so the subtensor is only queried once per sync and the arrays are shared between the workers
+# rather than copied into each of them. The file starts with `MAGIC` and the offset and length of the header
+# (`PREAMBLE`), then the arrays (aligned to `ALIGNMENT` bytes) and finally the JSON header, which holds the hotkeys,
+# the axons, the dtype, shape and offset of every array, and when the metagraph was synced.
+MAGIC = b"PAPIMG01"
+PREAMBLE = struct.Struct("<8sQQ")
+ALIGNMENT = 64
+
+# Arrays of the metagraph and of its eligibility index that are stored in the snapshot
+METAGRAPH_ARRAYS = ("S", "validator_permit", "active", "I")
+INDEX_ARRAYS = ("serving", "validator", "coldkey_groups", "ip_groups")
+
+
+class SnapshotMetagraph:
+    """Read-only metagraph mapped from a snapshot, with the attributes of `bt.metagraph` that the API uses"""
+
+    def __init__(self, hotkeys: list[str], axons: list, arrays: dict[str, np.ndarray]):
+        self.n = len(axons)
+        self.hotkeys = hotkeys
+        self.axons = axons
+        self.S = arrays["S"]
+        self.validator_permit = arrays["validator_permit"]
+        self.active = arrays["active"]
+        self.I = arrays["I"]
+
+
+def write_snapshot(path: str, index: EligibilityIndex, sync_duration: float):
+    """Writes the snapshot of a metagraph and its eligibility index. The file is replaced atomically, so workers
+    never map a partly written snapshot, and workers that mapped the previous one can keep using it.
+    """
+    metagraph = index.metagraph
+    arrays = {name: np.ascontiguousarray(np.asarray(getattr(metagraph, name))) for name in METAGRAPH_ARRAYS}
+    arrays.update({name: np.ascontiguousarray(getattr(index, name)) for name in INDEX_ARRAYS})
+    header = {
+        "synced_at": time.time(),
+        "sync_duration": sync_duration,
+        "self_uid": index.self_uid,
+        "hotkeys": list(metagraph.hotkeys),
+        "axons": [vars(axon) for axon in metagraph.axons],
+        "arrays": {},
+    }
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=".metagraph-", delete=False) as file:
+        try:
+            file.write(bytes(ALIGNMENT))
+            for name, array in arrays.items():
+                header["arrays"][name] = {"dtype": array.dtype.str, "shape": array.shape, "offset": file.tell()}
+                file.write(array.tobytes())
+                file.write(bytes(-file.tell() % ALIGNMENT))
+            header_offset = file.tell()
+            header_bytes = json.dumps(header).encode("utf-8")
+            file.write(header_bytes)
+            file.seek(0)
+            file.write(PREAMBLE.pack(MAGIC, header_offset, len(header_bytes)))
+        except BaseException:
+            os.unlink(file.name)
+            raise
+    os.chmod(file.name, 0o644)
+    os.replace(file.name, path)
+
+
+class SnapshotReader:
+    """Maps the metagraph snapshots published by the refresher process (in the workers)"""
+
+    def __init__(self, path: str = settings.METAGRAPH_SNAPSHOT_PATH):
+        self.path = path
+        # Identifies the file of the snapshot that was mapped last (its inode and modification time)
+        self.version: Optional[tuple[int, int]] = None
+        self.synced_at: Optional[float] = None
+        self.sync_duration: Optional[float] = None
+
+    def changed(self) -> bool:
+        """Whether a new snapshot was published since the last one was mapped"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns) != self.version
+
+    def load(self) -> EligibilityIndex:
+        """Maps the latest snapshot, waiting for the refresher to publish the first one if needed"""
+        while not os.path.exists(self.path):
+            logger.info(f"Waiting for the metagraph snapshot to be published at {self.path}...")
+            time.sleep(1)
+
+        with open(self.path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_offset, header_length = PREAMBLE.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a metagraph snapshot")
+        header = json.loads(buffer[header_offset : header_offset + header_length])
+
+        # The arrays are read-only views of the mapped file, which stays mapped as long as they are referenced
+        arrays = {}
+        for name, layout in header["arrays"].items():
+            dtype = np.dtype(layout["dtype"])
+            count = int(np.prod(layout["shape"]))
+            array = np.frombuffer(buffer, dtype=dtype, count=count, offset=layout["offset"])
+            arrays[name] = array.reshape(layout["shape"])
+
+        axons = [bt.AxonInfo(**axon) for axon in header["axons"]]
+        metagraph = SnapshotMetagraph(header["hotkeys"], axons, arrays)
+        index = EligibilityIndex.from_masks(metagraph, arrays, header["self_uid"])
+
+        self.version = (stat.st_ino, stat.st_mtime_ns)
+        self.synced_at = header["synced_at"]
+        self.sync_duration = header["sync_duration"]
+        return index
+
+
+def run_refresher(path: str = settings.METAGRAPH_SNAPSHOT_PATH, interval: float = settings.RESYNC_METAGRAPH_INTERVAL):
+    """Syncs the metagraph every `interval` seconds and publishes its snapshot for the workers.
+    Runs in its own process, started by `api.py` when there are several workers.
+    """
+    configure_logging()
+    wallet = bt.wallet(
+        name=settings.COLDKEY_WALLET_NAME,
+        hotkey=settings.HOTKEY_WALLET_NAME,
+        path=settings.WALLET_PATH,
+    )
+    subtensor = bt.subtensor(network=settings.SUBTENSOR_NETWORK)
+    while True:
+        try:
+            start_time = time.perf_counter()
+            index = EligibilityIndex(subtensor.metagraph(settings.NETUID), wallet)
+            write_snapshot(path, index, time.perf_counter() - start_time)
+            logger.info(f"Published the metagraph snapshot to {path}")
+        except Exception as e:
+            # The workers keep using the previous snapshot
+            logger.exception(f"Metagraph sync failed: {e}")
+        time.sleep(interval)
@@ -0,0 +1,197 @@
+import bisect
+import time
+from typing import Callable, Optional
+
+# Metrics are rendered in the Prometheus text exposition format by the `/metrics` endpoint.
+# Recording a value is a dict update keyed by the raw label values (converted to strings only when rendered), and
+# the streaming path records its per-chunk metrics once per stream, so there is no locking or formatting per chunk.
+PREFIX = "prompting_api"
+
+# Buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+
+class Metric:
+    """A metric with a separate value for each combination of label values"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = f"{PREFIX}_{name}"
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: dict[tuple, float] = {} if labelnames else {(): 0.0}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[labelname] for labelname in self.labelnames)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += self.render_samples()
+        return "\n".join(lines) + "\n"
+
+    def render_samples(self) -> list[str]:
+        return [f"{self.name}{_render_labels(self.labelnames, key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """A value that can go up and down, either set directly or computed by `function` when it is rendered"""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        function: Optional[Callable[[], float]] = None,
+        labelnames: tuple[str, ...] = (),
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    @property
+    def value(self) -> float:
+        return self.values[()]
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def render_samples(self) -> list[str]:
+        if self.function is not None:
+            return [f"{self.name} {self.function()}"]
+        return super().render_samples()
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(f"{name}_total", documentation, labelnames)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Histogram(Metric):
+    """Distribution of observed values, counted in cumulative buckets"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        labelnames: tuple[str, ...] = (),
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # Count of each bucket (the last one is +Inf) and the sum of the observed values, for each label values
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: dict[tuple, float] = {}
+        self.values = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        if (counts := self.counts.get(key)) is None:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    def render_samples(self) -> list[str]:
+        lines = []
+        for key, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                labels = _render_labels((*self.labelnames, "le"), (*key, bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _render_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {self.sums[key]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def _render_labels(labelnames: tuple[str, ...], values: tuple) -> str:
+    if not labelnames:
+        return ""
+    labels = ",".join(f'{name}="{_escape_label_value(str(value))}"' for name, value in zip(labelnames, values))
+    return "{" + labels + "}"
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY: list[Metric] = []
+
+
+def render_metrics() -> str:
+    """Renders all metrics in the Prometheus text exposition format"""
+    return "".join(metric.render() for metric in REGISTRY)
+
+
+METAGRAPH_SYNC_DURATION = Gauge("metagraph_sync_duration_seconds", "Duration of the last metagraph sync.")
+METAGRAPH_SYNCS = Histogram("metagraph_sync_seconds", "Duration of the metagraph syncs.")
+METAGRAPH_LAST_SYNC = Gauge("metagraph_last_sync_timestamp_seconds", "Unix time at which the metagraph was synced.")
+METAGRAPH_STALENESS = Gauge(
+    "metagraph_staleness_seconds",
+    "Time since the metagraph that is being queried was synced.",
+    function=lambda: time.time() - METAGRAPH_LAST_SYNC.value,
+)
+ELIGIBLE_UIDS = Gauge(
+    "eligible_uids", "Number of UIDs that could be queried by the last request.", labelnames=("role",)
+)
+
+ADMISSION_QUEUE_DEPTH = Gauge("admission_queue_depth", "Number of requests waiting for upstream streams.")
+UPSTREAM_STREAMS_ACTIVE = Gauge("upstream_streams_active", "Number of upstream streams that are reserved.")
+ADMISSION_REJECTIONS = Counter(
+    "admission_rejections", "Number of requests rejected by the admission control.", labelnames=("reason",)
+)
+
+REQUEST_LATENCY = Histogram(
+    "request_duration_seconds", "Duration of the streams of /chat requests.", labelnames=("sampling_mode",)
+)
+TIME_TO_FIRST_CHUNK = Histogram(
+    "time_to_first_chunk_seconds",
+    "Time until the first chunk of /chat requests was streamed.",
+    labelnames=("sampling_mode",),
+)
+STREAMS_IN_FLIGHT = Gauge("streams_in_flight", "Number of /chat streams in flight.")
+UPSTREAM_STREAMS_OPEN = Gauge("upstream_streams_open", "Number of upstream streams that are being streamed.")
+CHUNKS_STREAMED = Counter("chunks_streamed", "Number of chunks streamed to clients.", labelnames=("stream_format",))
+BYTES_STREAMED = Counter("bytes_streamed", "Number of bytes streamed to clients.", labelnames=("stream_format",))
+
+UID_ERRORS = Counter(
+    "uid_errors",
+    "Number of error chunks by UID (the miner, or the validator; -1 when the error can't be attributed).",
+    labelnames=("uid",),
+)
+UID_TIMEOUTS = Counter("uid_timeouts", "Number of upstream streams that timed out by UID.", labelnames=("uid",))
+UID_SKIPPED_CHUNKS = Counter(
+    "uid_skipped_chunks", "Number of chunks skipped by UID because enough miners were selected.", labelnames=("uid",)
+)
+
+MINERS_DROPPED = Counter(
+    "miners_dropped",
+    "Number of selected miners that gave up their slot by reason (stalled or duplicate).",
+    labelnames=("reason",),
+)
+
+STREAM_CAPTURES = Counter(
+    "stream_captures",
+    "Number of requests whose upstream streams were recorded, or dropped because the writer fell behind.",
+    labelnames=("result",),
+)
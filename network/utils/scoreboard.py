@@ -0,0 +1,124 @@
+import random
+from collections import deque
+from typing import Optional
+
+import numpy as np
+
+import settings
+
+
+class LatencyScoreboard:
+    """Latency telemetry of every UID the API has streamed from, kept across requests.
+
+    `StreamManager` records every upstream stream when it ends, and the scoreboard keeps an exponentially
+    weighted moving average (EWMA) of the time to first chunk, the chunks per second, and the error and timeout
+    rates of each UID. The "fastest" sampling mode then picks the UIDs with the lowest expected latency.
+
+    Attributes:
+        time_to_first_chunk (np.ndarray): EWMA of the seconds until the first chunk, indexed by UID (NaN if unknown).
+        chunks_per_second (np.ndarray): EWMA of the chunks streamed per second after the first one.
+        error_rate (np.ndarray): EWMA of the streams that failed.
+        timeout_rate (np.ndarray): EWMA of the streams that timed out.
+        recent_time_to_first_chunk (deque): The most recent times to first chunk of all UIDs.
+    """
+
+    def __init__(self, alpha: float = settings.SCOREBOARD_EWMA_ALPHA, history: int = settings.SCOREBOARD_HISTORY):
+        self.alpha = alpha
+        self.time_to_first_chunk = np.full(0, np.nan)
+        self.chunks_per_second = np.full(0, np.nan)
+        self.error_rate = np.zeros(0)
+        self.timeout_rate = np.zeros(0)
+        self.recent_time_to_first_chunk: deque[float] = deque(maxlen=history)
+
+    def record(
+        self,
+        uid: int,
+        time_to_first_chunk: Optional[float] = None,
+        chunks_per_second: Optional[float] = None,
+        error: bool = False,
+        timed_out: bool = False,
+    ):
+        """Records a stream of a UID
+
+        Args:
+            uid (int): UID that produced the stream
+            time_to_first_chunk (Optional[float]): seconds until the first chunk (None if nothing was received)
+            chunks_per_second (Optional[float]): chunks per second after the first one (None if unknown)
+            error (bool): whether the stream failed
+            timed_out (bool): whether the stream timed out
+        """
+        if uid < 0:
+            return
+        self._grow(uid + 1)
+
+        if time_to_first_chunk is not None:
+            self._update(self.time_to_first_chunk, uid, time_to_first_chunk)
+            self.recent_time_to_first_chunk.append(time_to_first_chunk)
+        if chunks_per_second is not None:
+            self._update(self.chunks_per_second, uid, chunks_per_second)
+        self.error_rate[uid] += self.alpha * (float(error) - self.error_rate[uid])
+        self.timeout_rate[uid] += self.alpha * (float(timed_out) - self.timeout_rate[uid])
+
+    def expected_latency(self, uids: list[int], timeout: float) -> np.ndarray:
+        """Expected seconds until the first chunk of each UID, where failed streams count as taking `timeout`.
+
+        Args:
+            uids (list[int]): UIDs to look up
+            timeout (float): seconds a failed stream costs
+
+        Returns:
+            np.ndarray: expected latency of each UID (NaN for UIDs that never sent a chunk)
+        """
+        self._grow(max(uids, default=-1) + 1)
+        uids = np.asarray(uids, dtype=np.int64)
+        failure_rate = np.minimum(self.error_rate[uids] + self.timeout_rate[uids], 1.0)
+        return (1.0 - failure_rate) * self.time_to_first_chunk[uids] + failure_rate * timeout
+
+    def fastest(self, candidate_uids: list[int], n: int, timeout: float, exploration: float) -> list[int]:
+        """Returns the `n` candidates with the lowest expected latency.
+
+        UIDs without measurements are ranked as an average UID, ties are broken at random, and each of the returned
+        UIDs is swapped for a random other candidate with probability `exploration` so every UID keeps being measured.
+
+        Args:
+            candidate_uids (list[int]): UIDs to pick from
+            n (int): number of UIDs to return
+            timeout (float): seconds a failed stream costs
+            exploration (float): probability of exploring another candidate for each returned UID
+
+        Returns:
+            list[int]: the fastest candidates, fastest first
+        """
+        candidate_uids = random.sample(candidate_uids, len(candidate_uids))
+        latency = self.expected_latency(candidate_uids, timeout)
+        known = ~np.isnan(latency)
+        latency[~known] = np.median(latency[known]) if known.any() else 0.0
+
+        ranking = [candidate_uids[i] for i in np.argsort(latency, kind="stable")]
+        selected, others = ranking[:n], ranking[n:]
+        for i in range(len(selected)):
+            if others and random.random() < exploration:
+                selected[i] = others.pop(random.randrange(len(others)))
+        return selected
+
+    def percentile_time_to_first_chunk(self, percentile: float) -> Optional[float]:
+        """Percentile of the recent times to first chunk of all UIDs (None if there are none yet)"""
+        if not self.recent_time_to_first_chunk:
+            return None
+        return float(np.percentile(self.recent_time_to_first_chunk, percentile))
+
+    def _update(self, ewma: np.ndarray, uid: int, value: float):
+        if np.isnan(ewma[uid]):
+            ewma[uid] = value
+        else:
+            ewma[uid] += self.alpha * (value - ewma[uid])
+
+    def _grow(self, size: int):
+        """Makes room for UIDs below `size`, e.g. when the subnet grows"""
+        if size <= len(self.error_rate):
+            return
+        pad = size - len(self.error_rate)
+        self.time_to_first_chunk = np.concatenate([self.time_to_first_chunk, np.full(pad, np.nan)])
+        self.chunks_per_second = np.concatenate([self.chunks_per_second, np.full(pad, np.nan)])
+        self.error_rate = np.concatenate([self.error_rate, np.zeros(pad)])
+        self.timeout_rate = np.concatenate([self.timeout_rate, np.zeros(pad)])
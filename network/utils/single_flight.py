@@ -0,0 +1,174 @@
+import asyncio
+import itertools
+from collections import deque
+from typing import AsyncIterator, Callable, Optional
+from loguru import logger
+
+import settings
+
+
+# The subscriber that started the stream, which is never disconnected for falling behind
+FIRST_SUBSCRIBER = 0
+
+
+class SharedStream:
+    """A stream of the API that is fanned out to several subscribers.
+
+    The chunks are pulled from the source by a single task and kept in a history shared by all subscribers, each
+    of which has its own cursor in it. Subscribers that join late first get a replay of the history, then the live
+    tail. The history is bounded by `max_buffer_bytes`: once it is reached, no new subscribers can join and the
+    chunks every subscriber has received are dropped. Beyond it, reading the source is paused until the subscribers
+    catch up: the subscriber that started the stream is never disconnected (it reads the source at its own pace, like
+    a stream that isn't shared), while the subscribers that joined later are disconnected once they hold it back.
+    The source is closed as soon as the last subscriber disconnects.
+    """
+
+    def __init__(
+        self,
+        source: AsyncIterator[bytes],
+        max_buffer_bytes: int,
+        overflow_chunk: Optional[Callable[[], bytes]] = None,
+    ):
+        self.max_buffer_bytes = max_buffer_bytes
+        # Generates the chunk sent to the subscribers that are disconnected for falling behind
+        self.overflow_chunk = overflow_chunk
+        self.chunks: deque[bytes] = deque()
+        # Position of `chunks[0]` in the stream, chunks before it were dropped from the history
+        self.offset = 0
+        self.buffered_bytes = 0
+        self.joinable = True
+        self.done = False
+        self.cursors: dict[int, int] = {}
+        self.subscriber_ids = itertools.count(FIRST_SUBSCRIBER)
+        self.new_chunk = asyncio.Event()
+        # Set when a subscriber received a chunk (or disconnected), so the paused source can be read again
+        self.chunk_received = asyncio.Event()
+        self.task = asyncio.create_task(self.produce(source))
+
+    async def produce(self, source: AsyncIterator[bytes]):
+        """Pulls the chunks of the source into the shared history"""
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self.buffered_bytes += len(chunk)
+                if self.buffered_bytes > self.max_buffer_bytes:
+                    self.joinable = False
+                    self.trim()
+                self.notify()
+                # Backpressure: the source isn't read further until the history fits in memory again
+                while self.buffered_bytes > self.max_buffer_bytes and self.cursors:
+                    if self.cursors.get(FIRST_SUBSCRIBER) == self.offset + len(self.chunks):
+                        # The first subscriber is only waiting for the subscribers that joined later
+                        self.trim(shed=True)
+                        continue
+                    self.chunk_received.clear()
+                    await self.chunk_received.wait()
+                    self.trim()
+        except Exception as e:
+            logger.error(f"Shared stream failed: {e}")
+        finally:
+            self.done = True
+            self.joinable = False
+            self.notify()
+            # Closing the source runs its `finally` blocks right away, e.g. to cancel the upstreams
+            await source.aclose()
+
+    def notify(self):
+        self.new_chunk.set()
+        self.new_chunk = asyncio.Event()
+
+    def subscribe(self) -> AsyncIterator[bytes]:
+        """Streams the chunks received so far, then the live tail of the stream"""
+        # The cursor is registered right away so the history isn't dropped before the stream is iterated
+        subscriber_id = next(self.subscriber_ids)
+        self.cursors[subscriber_id] = self.offset
+        return self.stream(subscriber_id)
+
+    async def stream(self, subscriber_id: int) -> AsyncIterator[bytes]:
+        try:
+            while True:
+                cursor = self.cursors[subscriber_id]
+                if cursor < self.offset:
+                    logger.warning("Subscriber of a shared stream fell too far behind, disconnecting it")
+                    if self.overflow_chunk is not None:
+                        yield self.overflow_chunk()
+                    return
+
+                if cursor < self.offset + len(self.chunks):
+                    self.cursors[subscriber_id] = cursor + 1
+                    chunk = self.chunks[cursor - self.offset]
+                    if not self.joinable and cursor == self.offset:
+                        self.trim()
+                    self.chunk_received.set()
+                    yield chunk
+                elif self.done:
+                    return
+                else:
+                    await self.new_chunk.wait()
+        finally:
+            del self.cursors[subscriber_id]
+            self.chunk_received.set()
+            if not self.cursors and not self.done:
+                logger.debug("Every subscriber of the shared stream disconnected, closing it")
+                self.task.cancel()
+
+    def trim(self, shed: bool = False):
+        """Drops the chunks that every subscriber has received. With `shed`, the chunks the first subscriber has
+        received are also dropped until the history fits in memory, which disconnects the subscribers that haven't
+        received them.
+        """
+        slowest = min(self.cursors.values(), default=self.offset + len(self.chunks))
+        first = self.cursors.get(FIRST_SUBSCRIBER, slowest) if shed else slowest
+        while self.offset < slowest or (self.offset < first and self.buffered_bytes > self.max_buffer_bytes):
+            self.buffered_bytes -= len(self.chunks.popleft())
+            self.offset += 1
+
+
+class SingleFlight:
+    """Coalesces identical requests that are in flight at the same time into a single upstream stream.
+
+    Requests are keyed by `QueryChatRequest.canonical_key` and their API key, so only the requests of the same
+    client are coalesced. The first request of a key starts a `SharedStream` which the identical requests that
+    arrive while it is streaming subscribe to.
+    """
+
+    def __init__(self, max_buffer_bytes: int = settings.SINGLE_FLIGHT_MAX_BUFFER_BYTES):
+        self.max_buffer_bytes = max_buffer_bytes
+        self.flights: dict[str, SharedStream] = {}
+
+    def join(self, key: str) -> Optional[AsyncIterator[bytes]]:
+        """Subscribes to the stream of an identical request in flight (None if there is none that can be joined)"""
+        flight = self.flights.get(key)
+        if flight is None or not flight.joinable:
+            return None
+        return flight.subscribe()
+
+    def start(
+        self,
+        key: str,
+        source: AsyncIterator[bytes],
+        overflow_chunk: Optional[Callable[[], bytes]] = None,
+    ) -> AsyncIterator[bytes]:
+        """Starts streaming the source for the key and subscribes to it
+
+        Args:
+            key (str): key of the request (see `Neuron.query_network`)
+            source (AsyncIterator[bytes]): the stream of the request
+            overflow_chunk (Optional[Callable[[], bytes]]): generates the chunk sent to the subscribers that fall
+                too far behind
+
+        Returns:
+            AsyncIterator[bytes]: the stream of the first subscriber
+        """
+        flight = SharedStream(source, self.max_buffer_bytes, overflow_chunk)
+        self.flights[key] = flight
+
+        def remove_flight(_):
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+        flight.task.add_done_callback(remove_flight)
+        return flight.subscribe()
+
+    def __len__(self) -> int:
+        return len(self.flights)
@@ -0,0 +1,237 @@
+import asyncio
+import json
+import os
+import queue
+import random
+import struct
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import AsyncIterator, Iterator, Optional
+from loguru import logger
+
+from network.meta.protocol import StreamPromptingSynapse
+from network.meta.schemas import QueryChatRequest
+from network.utils import metrics
+import settings
+
+# Captures are written to an append-only file which starts with `MAGIC`, followed by length-prefixed binary frames:
+# a `FRAME_HEADER` (the length of the data, the frame type, the capture ID, the UID and the time of arrival in
+# seconds since the capture started) then the data of the frame.
+MAGIC = b"PAPICAP1"
+FRAME_HEADER = struct.Struct("<IBQid")
+
+# The request (JSON of the request parameters without the prompt, and the queried UIDs)
+FRAME_REQUEST = 0
+# Raw text received from an upstream
+FRAME_CHUNK = 1
+# End of an upstream, the data is the JSON of the status code of its synapse
+FRAME_END = 2
+# An upstream failed, the data is the error
+FRAME_ERROR = 3
+
+
+class StreamCapture:
+    """Frames of the upstream streams of a single request. They are buffered in memory and handed to the writer
+    thread in one piece once the request is done, so recording a chunk is only a struct pack.
+    """
+
+    __slots__ = ("recorder", "capture_id", "start_time", "frames")
+
+    def __init__(self, recorder: "StreamRecorder", params: QueryChatRequest, uids: list[int]):
+        self.recorder = recorder
+        self.capture_id = random.getrandbits(64)
+        self.start_time = time.perf_counter()
+        self.frames: list[bytes] = []
+        request = {"request": params.model_dump(exclude={"messages"}), "uids": uids, "timestamp": time.time()}
+        self.add(FRAME_REQUEST, -1, json.dumps(request).encode("utf-8"))
+
+    def add(self, frame_type: int, uid: int, data: bytes):
+        timing = time.perf_counter() - self.start_time
+        self.frames.append(FRAME_HEADER.pack(len(data), frame_type, self.capture_id, uid, timing))
+        self.frames.append(data)
+
+    def chunk(self, uid: int, chunk: str):
+        self.add(FRAME_CHUNK, uid, chunk.encode("utf-8"))
+
+    def end(self, uid: int, synapse: StreamPromptingSynapse):
+        status_code = getattr(getattr(synapse, "dendrite", None), "status_code", None)
+        self.add(FRAME_END, uid, json.dumps({"status_code": status_code}).encode("utf-8"))
+
+    def error(self, uid: int, error: Exception):
+        self.add(FRAME_ERROR, uid, str(error).encode("utf-8"))
+
+    def close(self):
+        """Hands the capture to the writer thread"""
+        self.recorder.write(b"".join(self.frames))
+        self.frames = []
+
+
+class StreamRecorder:
+    """Records the upstream streams of a sampled fraction of the requests to `path` (see `StreamCapture`).
+
+    The file is written by a background thread, so the event loop never waits on disk. Captures are dropped
+    (and counted in the metrics) rather than queued without bound if the writer falls behind. Every worker appends
+    to the same file: each capture is written by a single unbuffered write to the end of the file, so the captures
+    of the workers are never interleaved.
+    """
+
+    # Captures waiting to be written
+    MAX_PENDING = 1024
+
+    def __init__(self, path: str = settings.CAPTURE_PATH, sample_rate: float = settings.CAPTURE_SAMPLE_RATE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.pending: queue.Queue[bytes] = queue.Queue(self.MAX_PENDING)
+        self.writer = threading.Thread(target=self._write, name="stream-recorder", daemon=True)
+        self.writer.start()
+
+    def start(self, params: QueryChatRequest, uids: list[int]) -> Optional[StreamCapture]:
+        """Starts capturing the upstream streams of a request, returns None if the request isn't sampled"""
+        if random.random() >= self.sample_rate:
+            return None
+        return StreamCapture(self, params, uids)
+
+    def write(self, data: bytes):
+        try:
+            self.pending.put_nowait(data)
+        except queue.Full:
+            metrics.STREAM_CAPTURES.inc(result="dropped")
+            return
+        metrics.STREAM_CAPTURES.inc(result="recorded")
+
+    def _write(self):
+        try:
+            fd = self._open()
+            try:
+                while True:
+                    data = memoryview(self.pending.get())
+                    while data:
+                        data = data[os.write(fd, data) :]
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.exception(f"Recording the streams to {self.path} failed: {e}")
+
+    def _open(self) -> int:
+        """Opens the file to append to it, creating it with its `MAGIC` if it doesn't exist. The file is written
+        in a temporary file and linked in place, so the workers never see it (or append to it) without `MAGIC`
+        """
+        fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(MAGIC)
+            try:
+                os.link(temporary_path, self.path)
+            except FileExistsError:
+                pass
+        finally:
+            os.unlink(temporary_path)
+        return os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+
+class CapturedFrame:
+    __slots__ = ("frame_type", "uid", "timing", "data")
+
+    def __init__(self, frame_type: int, uid: int, timing: float, data: bytes):
+        self.frame_type = frame_type
+        self.uid = uid
+        self.timing = timing
+        self.data = data
+
+
+class Capture:
+    """The upstream streams of a request, read back from a capture file"""
+
+    def __init__(self, capture_id: int, request: dict):
+        self.capture_id = capture_id
+        self.request = QueryChatRequest(messages=[], **request["request"])
+        self.uids: list[int] = request["uids"]
+        self.timestamp: float = request["timestamp"]
+        self.frames: dict[int, list[CapturedFrame]] = defaultdict(list)
+
+    @property
+    def stream_uids(self) -> list[int]:
+        """The UIDs of every upstream, including the backup validator of a hedged request if it was queried"""
+        return self.uids + [uid for uid in self.frames if uid not in self.uids]
+
+
+def read_captures(path: str) -> Iterator[Capture]:
+    """Reads the captures of a file written by `StreamRecorder`, in the order they were written"""
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a stream capture file")
+
+        captures: dict[int, Capture] = {}
+        while header := file.read(FRAME_HEADER.size):
+            if len(header) < FRAME_HEADER.size:
+                # The last capture was only partly written
+                break
+            length, frame_type, capture_id, uid, timing = FRAME_HEADER.unpack(header)
+            data = file.read(length)
+            if frame_type == FRAME_REQUEST:
+                captures[capture_id] = Capture(capture_id, json.loads(data))
+            elif capture_id in captures:
+                captures[capture_id].frames[uid].append(CapturedFrame(frame_type, uid, timing, data))
+        yield from captures.values()
+
+
+def replay_streams(capture: Capture, speed: float = 1.0) -> list[AsyncIterator]:
+    """Recreates the upstream streams of a capture, which can be passed to `StreamManager.stream_generator` along
+    with `capture.stream_uids`. Whatever the speed, the frames of all streams are replayed in the order they
+    arrived in, e.g. the same miners are selected as when the capture was recorded.
+
+    Args:
+        capture (Capture): a capture returned by `read_captures`
+        speed (float): how much faster than real time the chunks are replayed (0 = as fast as possible)
+
+    Returns:
+        list[AsyncIterator]: the stream of every UID of `capture.stream_uids`
+    """
+    start_time = time.perf_counter()
+    frames = sorted((frame for frames in capture.frames.values() for frame in frames), key=lambda frame: frame.timing)
+    positions: dict[int, list[int]] = defaultdict(list)
+    for position, frame in enumerate(frames):
+        positions[frame.uid].append(position)
+
+    # Each frame waits for its turn, which passes to the next frame once the previous one was consumed or its
+    # stream was closed (e.g. an upstream cancelled by the `StreamManager`)
+    turns = [asyncio.Event() for _ in frames]
+    replayed = [False] * len(frames)
+    closed: set[int] = set()
+    cursor = 0
+
+    def next_turn():
+        nonlocal cursor
+        while cursor < len(frames) and (replayed[cursor] or frames[cursor].uid in closed):
+            cursor += 1
+        if cursor < len(frames):
+            turns[cursor].set()
+
+    async def replay(uid: int) -> AsyncIterator:
+        try:
+            for position in positions[uid]:
+                await turns[position].wait()
+                frame = frames[position]
+                if speed > 0 and (delay := start_time + frame.timing / speed - time.perf_counter()) > 0:
+                    await asyncio.sleep(delay)
+                replayed[position] = True
+                try:
+                    if frame.frame_type == FRAME_CHUNK:
+                        yield frame.data.decode("utf-8")
+                    elif frame.frame_type == FRAME_END:
+                        synapse = StreamPromptingSynapse(roles=capture.request.roles, messages=[])
+                        if (terminal := getattr(synapse, "dendrite", None)) is not None:
+                            terminal.status_code = json.loads(frame.data)["status_code"]
+                        yield synapse
+                    elif frame.frame_type == FRAME_ERROR:
+                        raise ConnectionError(frame.data.decode("utf-8"))
+                finally:
+                    next_turn()
+        finally:
+            closed.add(uid)
+            next_turn()
+
+    next_turn()
+    return [replay(uid) for uid in capture.stream_uids]
@@ -0,0 +1,42 @@
+from typing import Optional
+
+# The prefixes of the miners' responses are compared through a polynomial rolling hash (modulo the Mersenne prime
+# 2^61 - 1) of their normalized text, which is updated with every chunk so the text itself is never kept. The text
+# is normalized to its lowercase letters and digits, so responses that only differ in whitespace, punctuation or
+# case (e.g. the same model served behind different prompts) are near-duplicates with the same hash.
+HASH_MODULUS = (1 << 61) - 1
+HASH_BASE = 1_000_003
+
+
+def normalize(text: str) -> str:
+    """The characters of a chunk that are compared between miners"""
+    return "".join(character for character in text.lower() if character.isalnum())
+
+
+class PrefixHash:
+    """Rolling hash of the first `length` normalized characters of a stream"""
+
+    __slots__ = ("length", "value", "count")
+
+    def __init__(self, length: int):
+        self.length = length
+        self.value = 0
+        self.count = 0
+
+    def update(self, chunk: str) -> bool:
+        """Hashes the characters of a chunk, returns whether the prefix is complete"""
+        value = self.value
+        for character in normalize(chunk)[: self.length - self.count]:
+            value = (value * HASH_BASE + ord(character)) % HASH_MODULUS
+            self.count += 1
+        self.value = value
+        return self.complete
+
+    @property
+    def complete(self) -> bool:
+        return self.count >= self.length
+
+    @property
+    def key(self) -> Optional[int]:
+        """Identifies the prefix, None until it is complete (shorter streams are never compared)"""
+        return self.value if self.complete else None
@@ -1,12 +1,14 @@
 from fastapi import HTTPException
-import bittensor as bt
 from http import HTTPStatus
+from typing import Optional
+import json
+import re
 
 from network.meta.schemas import QueryChatRequest
-from network.utils.uid_utils import is_uid_validator
+from network.utils.uid_utils import EligibilityIndex
 
 
-def validate_request(request: QueryChatRequest, metagraph: "bt.metagraph.Metagraph"):
+def validate_request(request: QueryChatRequest, index: EligibilityIndex):
     """Validates the request object by doing checking of the parameters"""
 
     if request.k <= 0:
@@ -23,6 +25,38 @@ def validate_request(request: QueryChatRequest, metagraph: "bt.metagraph.Metagra
             detail="Request timed out because timeout must be greater than 0",
         )
 
+    if request.hedge and not request.query_validators:
+        # Miners are already raced against each other through k
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="hedge only applies when querying validators",
+        )
+
+    if request.hedge_delay is not None and request.hedge_delay < 0:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="hedge_delay must be greater than or equal to 0",
+        )
+
+    if request.aggregate and request.cache:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="cache doesn't apply to aggregated requests",
+        )
+
+    if request.quorum is not None and not 0 < request.quorum <= request.k:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="quorum must be between 1 and k",
+        )
+
+    for name in ("first_chunk_timeout", "idle_timeout", "total_timeout"):
+        if (value := getattr(request, name)) is not None and value <= 0:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail=f"{name} must be greater than 0",
+            )
+
     if request.sampling_mode == "list" and not request.uid_list:
         # Make sure the uid_list is provided
         raise HTTPException(
@@ -32,9 +66,16 @@ def validate_request(request: QueryChatRequest, metagraph: "bt.metagraph.Metagra
 
     if request.query_validators:
         # Querying validators
-        if request.sampling_mode == "list":
+        if request.sampling_mode == "fastest" and not request.uid_list:
+            # The fastest validator is picked from the uid_list
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail="uid_list must be provided when sampling_mode is 'fastest' and querying validators",
+            )
+
+        if request.sampling_mode in ("list", "fastest"):
             for uid in request.uid_list:
-                if not is_uid_validator(metagraph, uid):
+                if not index.is_validator(uid):
                     # Raise error if the UID is not a validator
                     raise HTTPException(
                         status_code=HTTPStatus.NOT_FOUND,
@@ -57,9 +98,124 @@ def validate_request(request: QueryChatRequest, metagraph: "bt.metagraph.Metagra
                 )
 
             for uid in request.uid_list:
-                if is_uid_validator(metagraph, uid):
+                if index.is_validator(uid):
                     # Raise error if the UID is not a miner
                     raise HTTPException(
                         status_code=HTTPStatus.NOT_FOUND,
                         detail=f"miner UID {uid} in uid_list is not found.",
                     )
+
+
+# A frame is the text that was received and, if it is a JSON object, its decoded value (otherwise empty)
+Frame = tuple[str, dict]
+
+
+class JSONFrameDecoder:
+    """Incrementally splits the text of an upstream stream into frames.
+
+    Validators stream concatenated JSON objects (`{...}{...}`), which may be split at any point across reads,
+    while miners (and validators that haven't upgraded) stream raw text. The decoder keeps track of the object
+    depth and strings across reads so every character is scanned only once, and partial objects are held back
+    until they are complete. Objects that turn out not to be valid JSON are returned as raw text.
+
+    Raw text streams (`framed=False`) are passed through as they are read, so the text of a miner is never held
+    back or decoded, even if it starts with a JSON object.
+    """
+
+    # Characters that change the state of the scanner, outside and inside of strings
+    _OBJECT_TOKENS = re.compile(r'[{}"]')
+    _STRING_TOKENS = re.compile(r'["\\]')
+
+    def __init__(self, framed: Optional[bool] = None):
+        # When None, the first non whitespace character tells us if the stream is made of JSON objects
+        self.framed = framed
+        self.pending: list[str] = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> list[Frame]:
+        """Decodes the next piece of text of the stream
+
+        Args:
+            text (str): text received from the stream
+
+        Returns:
+            list[Frame]: all frames that were completed by this piece of text
+        """
+        if self.framed is None and (stripped := text.lstrip()):
+            self.framed = stripped[0] == "{"
+        if not self.framed:
+            # Raw text, including whitespace only text, is passed through as it is
+            return [(text, {})] if text else []
+
+        frames = []
+        start, position, end = 0, 0, len(text)
+        if self.escaped and end:
+            # The previous piece ended with a backslash within a string, so this character is escaped
+            self.escaped = False
+            position = 1
+
+        while position < end:
+            if self.depth == 0:
+                # Between objects, so everything up to the next object is raw text
+                position = text.find("{", position)
+                if position == -1:
+                    position = end
+                    break
+                self._add_text(frames, text[start:position])
+                start = position
+                position += 1
+                self.depth = 1
+            elif self.in_string:
+                if (match := self._STRING_TOKENS.search(text, position)) is None:
+                    position = end
+                elif match.group() == "\\":
+                    position = match.end() + 1
+                    self.escaped = position > end
+                else:
+                    self.in_string = False
+                    position = match.end()
+            else:
+                if (match := self._OBJECT_TOKENS.search(text, position)) is None:
+                    position = end
+                    break
+                token, position = match.group(), match.end()
+                if token == '"':
+                    self.in_string = True
+                elif token == "{":
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        self.pending.append(text[start:position])
+                        frames.append(self._decode_frame("".join(self.pending)))
+                        self.pending = []
+                        start = position
+
+        if self.depth > 0:
+            self.pending.append(text[start:])
+        else:
+            self._add_text(frames, text[start:])
+        return frames
+
+    def flush(self) -> list[Frame]:
+        """Returns the incomplete object the stream ended with (as raw text), if any"""
+        text = "".join(self.pending)
+        self.pending = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        return [(text, {})] if text else []
+
+    def _add_text(self, frames: list[Frame], text: str):
+        # Whitespace between the objects of a framed stream is only formatting
+        if text and not text.isspace():
+            frames.append((text, {}))
+
+    @staticmethod
+    def _decode_frame(text: str) -> Frame:
+        try:
+            return text, json.loads(text)
+        except json.decoder.JSONDecodeError:
+            return text, {}
@@ -1,21 +1,144 @@
 import bittensor as bt
+import numpy as np
 import settings
 from loguru import logger
 import random
+from typing import Optional
 
 from network.meta.schemas import QueryChatRequest
+from network.utils import metrics
+from network.utils.circuit_breaker import AllQuarantined, CircuitBreaker
+from network.utils.scoreboard import LatencyScoreboard
+
+
+class EligibilityIndex:
+    """Precomputed eligibility of all UIDs in the metagraph.
+
+    Everything that decides whether a UID can be queried only changes when the metagraph is synced, so it is
+    computed once per sync (see `Neuron.resync_metagraph`) as boolean masks indexed by UID. Sampling UIDs for a
+    request then only takes a few array operations.
+
+    Attributes:
+        metagraph (bt.metagraph.Metagraph): The metagraph the index was built from.
+        serving (np.ndarray): UIDs that are serving an axon.
+        validator (np.ndarray): UIDs that are validators, the other UIDs are considered to be miners.
+        incentive (np.ndarray): Incentive of each UID.
+        coldkey_groups (np.ndarray): UIDs sharing a coldkey have the same group.
+        ip_groups (np.ndarray): UIDs sharing an IP have the same group.
+        self_uid (Optional[int]): UID of the API's wallet (None if it isn't registered).
+    """
 
+    def __init__(self, metagraph: "bt.metagraph.Metagraph", wallet: "bt.wallet"):
+        self.metagraph = metagraph
+        axons = metagraph.axons
+        self.n = len(axons)
 
-# TODO: consider using an LRU (or similiar) to cache the UIDs
-
+        self.serving = np.array([axon.is_serving for axon in axons], dtype=bool)
 
-def sample_uids(metagraph: "bt.metagraph.Metagraph", wallet: "bt.wallet", params: QueryChatRequest) -> list[int]:
+        # There is no really good way to tell validators and miners apart but we should make validators most
+        # restrictive and, otherwise, assume the UID is a miner. Validators should have a permit and enough stake
+        # as well as be active (updated extrinsics in the last ~1k blocks)
+        self.validator = (
+            (settings.VALIDATOR_MIN_STAKE <= np.asarray(metagraph.S, dtype=np.float64))
+            & np.asarray(metagraph.validator_permit, dtype=bool)
+            & np.asarray(metagraph.active, dtype=bool)
+        )
+        self.incentive = np.asarray(metagraph.I, dtype=np.float64)
+
+        _, self.coldkey_groups = np.unique([axon.coldkey for axon in axons], return_inverse=True)
+        _, self.ip_groups = np.unique([axon.ip for axon in axons], return_inverse=True)
+
+        hotkey = wallet.hotkey.ss58_address
+        self.self_uid = metagraph.hotkeys.index(hotkey) if hotkey in metagraph.hotkeys else None
+        self._cache_valid_uids()
+
+    @classmethod
+    def from_masks(
+        cls, metagraph: "bt.metagraph.Metagraph", masks: dict[str, np.ndarray], self_uid: Optional[int]
+    ) -> "EligibilityIndex":
+        """Restores an index from the masks of an index that was already built, e.g. mapped from a metagraph snapshot
+
+        Args:
+            metagraph (bt.metagraph.Metagraph): The metagraph the index was built from.
+            masks (dict[str, np.ndarray]): The `serving`, `validator`, `coldkey_groups` and `ip_groups` of the index.
+            self_uid (Optional[int]): UID of the API's wallet (None if it isn't registered).
+        """
+        index = cls.__new__(cls)
+        index.metagraph = metagraph
+        index.n = len(metagraph.axons)
+        index.serving = masks["serving"]
+        index.validator = masks["validator"]
+        index.incentive = np.asarray(metagraph.I, dtype=np.float64)
+        index.coldkey_groups = masks["coldkey_groups"]
+        index.ip_groups = masks["ip_groups"]
+        index.self_uid = self_uid
+        index._cache_valid_uids()
+        return index
+
+    def _cache_valid_uids(self):
+        # Requests without excluded UIDs all have the same candidates
+        self.valid_uids_cache = {
+            query_validators: self._compute_valid_uids(query_validators, None) for query_validators in (True, False)
+        }
+
+    def is_validator(self, uid: int) -> bool:
+        """Whether the UID is a validator (UIDs outside of the metagraph are not)"""
+        return 0 <= uid < self.n and bool(self.validator[uid])
+
+    def valid_uids(self, query_validators: bool, excluded_uids: Optional[list[int]] = None) -> list[int]:
+        """Returns all UIDs that are valid for querying
+
+        Args:
+            query_validators (bool): Whether validators (or miners) are queried
+            excluded_uids (Optional[list[int]]): UIDs that may not be queried
+
+        Returns:
+            list[int]: All UIDs that are valid for querying
+        """
+        if not excluded_uids:
+            return list(self.valid_uids_cache[query_validators])
+        return self._compute_valid_uids(query_validators, excluded_uids)
+
+    def _compute_valid_uids(self, query_validators: bool, excluded_uids: Optional[list[int]]) -> list[int]:
+        available = np.ones(self.n, dtype=bool)
+        if self.self_uid is not None:
+            available[self.self_uid] = False
+        if excluded_uids:
+            excluded = np.asarray(excluded_uids, dtype=np.int64)
+            available[excluded[(0 <= excluded) & (excluded < self.n)]] = False
+
+        # Only the first UID of each coldkey (then IP) is kept, before checking if it can be queried
+        if settings.QUERY_UNIQUE_COLDKEYS:
+            available = self._first_of_each_group(available, self.coldkey_groups)
+        if settings.QUERY_UNIQUE_IPS:
+            available = self._first_of_each_group(available, self.ip_groups)
+
+        # Filter non serving axons, and validators when querying miners (or miners when querying validators)
+        valid = available & self.serving & (self.validator if query_validators else ~self.validator)
+        return np.flatnonzero(valid).tolist()
+
+    @staticmethod
+    def _first_of_each_group(mask: np.ndarray, groups: np.ndarray) -> np.ndarray:
+        uids = np.flatnonzero(mask)
+        _, first = np.unique(groups[uids], return_index=True)
+        first_of_each_group = np.zeros_like(mask)
+        first_of_each_group[uids[first]] = True
+        return first_of_each_group
+
+
+def sample_uids(
+    index: EligibilityIndex,
+    params: QueryChatRequest,
+    scoreboard: Optional[LatencyScoreboard] = None,
+    breaker: Optional[CircuitBreaker] = None,
+) -> list[int]:
     """Samples UIDs based on the sampling mode.  If querying validators, we will only ever return one.
 
     Args:
-        metagraph (bt.metagraph.Metagraph): Metagraph object.
-        wallet (bt.wallet): The wallet the API is using.
+        index (EligibilityIndex): Eligibility of the UIDs in the metagraph.
         params (QueryChatRequest): Request parameters
+        scoreboard (Optional[LatencyScoreboard]): Latency of the UIDs in past requests (for the "fastest" mode)
+        breaker (Optional[CircuitBreaker]): Quarantined UIDs are never sampled, whatever the sampling mode
 
     Raises:
         ValueError: Invalid sampling mode
@@ -24,40 +147,67 @@ def sample_uids(metagraph: "bt.metagraph.Metagraph", wallet: "bt.wallet", params
         list[int]: list of sampled UIDs
     """
     if params.sampling_mode == "list":
-        if params.query_validators:
-            # Return only 1 random validator from the list
-            return random.sample(params.uid_list, 1)
-        else:
-            # Return k random miners from the list
-            return random.sample(params.uid_list, params.k)
-    if params.sampling_mode == "random":
-        return get_random_uids(
-            metagraph=metagraph,
-            wallet=wallet,
-            params=params,
-        )
-    if params.sampling_mode == "top_incentive":
-        return get_top_incentive_uids(
-            metagraph=metagraph,
-            wallet=wallet,
-            params=params,
+        uids = get_list_uids(index=index, params=params, breaker=breaker)
+    elif params.sampling_mode == "random":
+        uids = get_random_uids(index=index, params=params, breaker=breaker)
+    elif params.sampling_mode == "top_incentive":
+        uids = get_top_incentive_uids(index=index, params=params, breaker=breaker)
+    elif params.sampling_mode == "fastest":
+        uids = get_fastest_uids(
+            index=index, params=params, scoreboard=scoreboard or LatencyScoreboard(), breaker=breaker
         )
+    else:
+        raise ValueError(f"Invalid sampling mode: {params.sampling_mode}")
+
+    if breaker is not None:
+        breaker.start(uids, index.metagraph)
+    return uids
+
+
+def get_list_uids(
+    index: EligibilityIndex, params: QueryChatRequest, breaker: Optional[CircuitBreaker] = None
+) -> list[int]:
+    """Returns random uids from the `uid_list` of the request.
+
+    Args:
+        index (EligibilityIndex): Eligibility of the UIDs in the metagraph.
+        params (QueryChatRequest): Request parameters
+        breaker (Optional[CircuitBreaker]): Quarantined UIDs are removed from the list
 
-    raise ValueError(f"Invalid sampling mode: {params.sampling_mode}")
+    Raises:
+        AllQuarantined: Every UID of the list is quarantined
 
+    Returns:
+        list[int]: 1 validator, or k miners, from the list
+    """
+    uid_list = get_allowed_uids(params.uid_list, index, breaker, required=True)
 
-def get_random_uids(metagraph: "bt.metagraph.Metagraph", wallet: "bt.wallet", params: QueryChatRequest) -> list[int]:
+    if params.query_validators:
+        # Return only 1 random validator from the list
+        return random.sample(uid_list, 1)
+
+    if len(uid_list) < params.k:
+        logger.warning(f"Requested {params.k} uids but only {len(uid_list)} of uid_list are not quarantined")
+        return uid_list
+
+    # Return k random miners from the list
+    return random.sample(uid_list, params.k)
+
+
+def get_random_uids(
+    index: EligibilityIndex, params: QueryChatRequest, breaker: Optional[CircuitBreaker] = None
+) -> list[int]:
     """Returns k available random uids from the metagraph.
     Args:
-        metagraph (bt.metagraph.Metagraph): Metagraph object.
-        wallet (bt.wallet): The wallet the API is using.
+        index (EligibilityIndex): Eligibility of the UIDs in the metagraph.
         params (QueryChatRequest): Request parameters
+        breaker (Optional[CircuitBreaker]): Quarantined UIDs are not available
     Returns:
         uids (list[int]): Randomly sampled available uids.
     Notes:
         If `k` is larger than the number of available `uids`, set `k` to the number of available `uids`.
     """
-    candidate_uids = get_all_valid_uids(metagraph, wallet, params)
+    candidate_uids = get_all_valid_uids(index, params, breaker, required=True)
 
     # Check if candidate_uids contain enough for querying, if not grab all avaliable uids
     if len(candidate_uids) == 0:
@@ -77,118 +227,118 @@ def get_random_uids(metagraph: "bt.metagraph.Metagraph", wallet: "bt.wallet", pa
 
 
 def get_top_incentive_uids(
-    metagraph: "bt.metagraph.Metagraph", wallet: "bt.wallet", params: QueryChatRequest
+    index: EligibilityIndex, params: QueryChatRequest, breaker: Optional[CircuitBreaker] = None
 ) -> list[int]:
     """Returns the top k uids with the highest incentives.
 
     Args:
-        metagraph (bt.metagraph.Metagraph): Metagraph object
-        wallet (bt.wallet): The wallet the API is using.
+        index (EligibilityIndex): Eligibility of the UIDs in the metagraph.
         params (QueryChatRequest): Request parameters
+        breaker (Optional[CircuitBreaker]): Quarantined UIDs are skipped
 
     Returns:
         list[int]: the top k uids (miners) with the highest incentives.
     """
-    candidate_uids = get_all_valid_uids(metagraph, wallet, params)
+    candidate_uids = np.asarray(get_all_valid_uids(index, params, breaker, required=True), dtype=np.int64)
 
-    # Builds a dictionary of uids and their corresponding incentives
-    all_miners_incentives = {
-        "miners_uids": candidate_uids,
-        "incentives": list(map(lambda uid: metagraph.I[uid], candidate_uids)),
-    }
-
-    # Zip the uids and their corresponding incentives into a list of tuples
-    uid_incentive_pairs = list(zip(all_miners_incentives["miners_uids"], all_miners_incentives["incentives"]))
-
-    # Sort the list of tuples by the incentive value in descending order
-    uid_incentive_pairs_sorted = sorted(uid_incentive_pairs, key=lambda x: x[1], reverse=True)
-    logger.debug(f"Top uids by incentive: {uid_incentive_pairs_sorted[:params.k]}")
+    # Sort the uids by their incentive in descending order (ties keep their uid order)
+    top_uids = candidate_uids[np.argsort(-index.incentive[candidate_uids], kind="stable")]
+    logger.debug("Top uids by incentive: {}", top_uids[: params.k])
 
     if params.query_validators:
         # Always return just one validator (k = number of miners)
-        return [uid_incentive_pairs_sorted[0][0]]
+        return top_uids[:1].tolist()
 
     # Extract the top k uids
-    top_k_uids = [uid for uid, _ in uid_incentive_pairs_sorted[: params.k]]
-    return top_k_uids
+    return top_uids[: params.k].tolist()
 
 
-def get_all_valid_uids(metagraph: "bt.metagraph.Metagraph", wallet: "bt.wallet", params: QueryChatRequest) -> list[int]:
-    """_summary_
+def get_fastest_uids(
+    index: EligibilityIndex,
+    params: QueryChatRequest,
+    scoreboard: LatencyScoreboard,
+    breaker: Optional[CircuitBreaker] = None,
+) -> list[int]:
+    """Returns the k uids that answered the fastest in past requests, see `LatencyScoreboard.fastest`.
 
     Args:
-        metagraph (bt.metagraph.Metagraph): Metagraph object
-        wallet (bt.wallet): The wallet the API is using.
+        index (EligibilityIndex): Eligibility of the UIDs in the metagraph.
         params (QueryChatRequest): Request parameters
+        scoreboard (LatencyScoreboard): Latency of the UIDs in past requests
+        breaker (Optional[CircuitBreaker]): Quarantined UIDs are skipped
 
     Returns:
-        list[int]: All UIDs that are valid for querying
+        list[int]: the fastest uids (a single validator from `uid_list` if querying validators)
     """
-    candidate_uids = []
-    unique_coldkeys = set()
-    unique_ips = set()
-    self_uid = metagraph.hotkeys.index(wallet.hotkey.ss58_address)
+    if params.query_validators:
+        # Pick the fastest validator of the list
+        candidate_uids = get_allowed_uids(params.uid_list, index, breaker, required=True)
+        k = 1
+    else:
+        candidate_uids = get_all_valid_uids(index, params, breaker, required=True)
+        k = params.k
 
-    for uid in metagraph.uids:
-        if uid == self_uid:
-            continue
+    if len(candidate_uids) == 0:
+        raise ValueError("No eligible uids were found. Cannot return any uids")
 
-        if params.excluded_uids and uid in params.excluded_uids:
-            continue
+    return scoreboard.fastest(
+        candidate_uids, k, timeout=params.timeout, exploration=settings.FASTEST_SAMPLING_EXPLORATION
+    )
 
-        if (coldkey := metagraph.axons[uid].coldkey) in unique_coldkeys:
-            continue
-        elif settings.QUERY_UNIQUE_COLDKEYS:
-            unique_coldkeys.add(coldkey)
 
-        if (ip := metagraph.axons[uid].ip) in unique_ips:
-            continue
-        elif settings.QUERY_UNIQUE_IPS:
-            unique_ips.add(ip)
+def get_all_valid_uids(
+    index: EligibilityIndex, params: QueryChatRequest, breaker: Optional[CircuitBreaker] = None, required: bool = False
+) -> list[int]:
+    """Returns all UIDs that can be queried for the request
 
-        if not is_uid_valid(uid, metagraph, params):
-            continue
+    Args:
+        index (EligibilityIndex): Eligibility of the UIDs in the metagraph.
+        params (QueryChatRequest): Request parameters
+        breaker (Optional[CircuitBreaker]): Quarantined UIDs can't be queried
+        required (bool): Whether to raise `AllQuarantined` if every valid UID is quarantined
 
-        candidate_uids.append(uid)
-    return candidate_uids
+    Returns:
+        list[int]: All UIDs that are valid for querying
+    """
+    uids = get_allowed_uids(index.valid_uids(params.query_validators, params.excluded_uids), index, breaker, required)
+    metrics.ELIGIBLE_UIDS.set(len(uids), role="validator" if params.query_validators else "miner")
+    return uids
 
 
-def is_uid_valid(
-    uid: int,
-    metagraph: "bt.metagraph.Metagraph",
+def get_hedge_uid(
+    index: EligibilityIndex,
     params: QueryChatRequest,
-) -> bool:
-    """Check if uid is valid. The UID is valid if it is serving and matches the params
+    primary_uid: int,
+    breaker: Optional[CircuitBreaker] = None,
+) -> Optional[int]:
+    """Returns a backup validator for a hedged request, preferably from `uid_list`, otherwise from all validators
 
     Args:
-        metagraph (bt.metagraph.Metagraph): Metagraph object
-        uid (int): uid to be checked
-        vpermit_tao_limit (int): Validator permit tao limit
+        index (EligibilityIndex): Eligibility of the UIDs in the metagraph.
+        params (QueryChatRequest): Request parameters
+        primary_uid (int): the validator that was sampled for the request
+        breaker (Optional[CircuitBreaker]): Quarantined UIDs are skipped
 
     Returns:
-        bool: True if uid is available for querying, False otherwise
+        Optional[int]: the backup validator (None if there is no other validator to query)
     """
-    # Filter non serving axons.
-    if not metagraph.axons[uid].is_serving:
-        logger.trace(f"uid: {uid} is not serving")
-        return False
-
-    if params.query_validators != is_uid_validator(metagraph, uid):
-        # if querying validators (query_validators==True), validator check must pass
-        # if querying miners (query_validators==False), validator check must fail
-        return False
-
-    # Available otherwise.
-    return True
-
-
-def is_uid_validator(metagraph: "bt.metagraph.Metagraph", uid: int) -> bool:
-    """Is the UID a validator or a miner -
-    there is no really good way to do this but we should make validators most restictive
-    and, otherwise, assume the UID is a miner.  Validators should have a permit and enough stake
-    as well as be active (updated extrinsics in the last ~1k blocks)"""
-    return (
-        (settings.VALIDATOR_MIN_STAKE <= metagraph.S[uid])
-        and bool(metagraph.validator_permit[uid])
-        and bool(metagraph.active[uid])
-    )
+    listed_uids = get_allowed_uids([uid for uid in params.uid_list or [] if index.is_validator(uid)], index, breaker)
+    for candidate_uids in (listed_uids, get_all_valid_uids(index, params, breaker)):
+        candidate_uids = [uid for uid in candidate_uids if uid != primary_uid]
+        if candidate_uids:
+            return random.choice(candidate_uids)
+    return None
+
+
+def get_allowed_uids(
+    uids: list[int], index: EligibilityIndex, breaker: Optional[CircuitBreaker] = None, required: bool = False
+) -> list[int]:
+    """Removes the UIDs that are quarantined by the circuit breaker, if `required` at least one UID must be left
+    (`AllQuarantined` is raised otherwise)
+    """
+    if breaker is None:
+        return list(uids)
+    allowed_uids = breaker.allowed_uids(uids, index.metagraph)
+    if required and uids and not allowed_uids:
+        raise AllQuarantined(breaker.retry_after(uids, index.metagraph))
+    return allowed_uids
@@ -1,6 +1,7 @@
 from dotenv import load_dotenv
 from loguru import logger
 import os
+import tempfile
 
 # We clear the environment to avoid any conflicts with changes in the .env file.
 os.environ.clear()
@@ -8,8 +9,9 @@ os.environ.clear()
 if not load_dotenv():
     logger.warning("No .env file found, test endpoint will not be functional...")
 
-# The API key others will use to access this service
+# The API key others will use to access this service (several keys can be separated by commas)
 EXPECTED_ACCESS_KEY = os.getenv("EXPECTED_ACCESS_KEY")
+EXPECTED_ACCESS_KEYS = [key.strip() for key in (EXPECTED_ACCESS_KEY or "").split(",") if key.strip()]
 
 ############################
 # API's wallet information #
@@ -56,3 +58,112 @@ VALIDATOR_MIN_STAKE = int(os.environ.get("VALIDATOR_MIN_STAKE", 4096))
 
 # The interval to resync the metagraph
 RESYNC_METAGRAPH_INTERVAL = int(os.environ.get("RESYNC_METAGRAPH_INTERVAL", 60))
+
+# The number of worker processes serving the API. With more than one, a single refresher process syncs the metagraph
+# and shares it with the workers through a snapshot file at METAGRAPH_SNAPSHOT_PATH
+WORKERS = int(os.environ.get("WORKERS", 1))
+
+# The metagraph snapshot shared with the workers, in shared memory (/dev/shm) where available
+METAGRAPH_SNAPSHOT_PATH = os.environ.get(
+    "METAGRAPH_SNAPSHOT_PATH",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "prompting-api-metagraph"),
+)
+
+# The maximum number of requests in a /chat/batch request
+BATCH_MAX_REQUESTS = int(os.environ.get("BATCH_MAX_REQUESTS", 1000))
+
+# The maximum number of requests of a batch that query the network at the same time
+BATCH_MAX_PARALLELISM = int(os.environ.get("BATCH_MAX_PARALLELISM", 16))
+
+# The time in seconds without events after which a heartbeat comment is sent on /v1/chat/completions streams, so
+# proxies don't close idle connections (0 = no heartbeats)
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get("SSE_HEARTBEAT_INTERVAL", 15))
+
+# The weight of the newest stream in the moving averages of the latency scoreboard (used by the "fastest" sampling mode)
+SCOREBOARD_EWMA_ALPHA = float(os.environ.get("SCOREBOARD_EWMA_ALPHA", 0.2))
+
+# The number of recent times to first chunk (of all UIDs) the latency scoreboard keeps
+SCOREBOARD_HISTORY = int(os.environ.get("SCOREBOARD_HISTORY", 1000))
+
+# The probability of the "fastest" sampling mode exploring a random UID instead of one of the fastest ones
+FASTEST_SAMPLING_EXPLORATION = float(os.environ.get("FASTEST_SAMPLING_EXPLORATION", 0.1))
+
+# The number of consecutive failed (or timed out) streams after which a UID (or axon IP) is quarantined
+CIRCUIT_BREAKER_FAILURES = int(os.environ.get("CIRCUIT_BREAKER_FAILURES", 3))
+
+# The time in seconds a UID is quarantined for before a single probe request is let through
+CIRCUIT_BREAKER_BACKOFF = float(os.environ.get("CIRCUIT_BREAKER_BACKOFF", 30))
+
+# The maximum quarantine time in seconds (the quarantine time doubles every time a probe fails)
+CIRCUIT_BREAKER_MAX_BACKOFF = float(os.environ.get("CIRCUIT_BREAKER_MAX_BACKOFF", 600))
+
+# The percentile of the recent times to first chunk after which hedged requests are sent to a backup validator
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", 95))
+
+# The time in seconds after which hedged requests are sent to a backup validator, until times to first chunk are known
+HEDGE_DELAY = float(os.environ.get("HEDGE_DELAY", 1.0))
+
+# Coalesce identical requests that are in flight at the same time into a single query to the network
+SINGLE_FLIGHT_ENABLED = bool(os.environ.get("SINGLE_FLIGHT_ENABLED", "true") == "true")
+
+# The maximum size in bytes of the chunks kept to replay a coalesced stream to the requests joining it
+SINGLE_FLIGHT_MAX_BUFFER_BYTES = int(os.environ.get("SINGLE_FLIGHT_MAX_BUFFER_BYTES", 8 * 1024 * 1024))
+
+# The maximum size in bytes of the completions kept in the completion cache (for requests with "cache": true)
+COMPLETION_CACHE_MAX_BYTES = int(os.environ.get("COMPLETION_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# The time in seconds completions are kept in the completion cache
+COMPLETION_CACHE_TTL = float(os.environ.get("COMPLETION_CACHE_TTL", 3600))
+
+# The maximum number of upstream streams (to miners or validators) open at the same time, across all requests
+ADMISSION_MAX_UPSTREAM_STREAMS = int(os.environ.get("ADMISSION_MAX_UPSTREAM_STREAMS", 512))
+
+# The maximum number of requests waiting for upstream streams, requests are rejected with a 503 beyond it
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", 128))
+
+# The maximum number of requests in flight per API key (0 = unlimited), requests are rejected with a 429 beyond it
+API_KEY_MAX_CONCURRENT_REQUESTS = int(os.environ.get("API_KEY_MAX_CONCURRENT_REQUESTS", 64))
+
+# The sustained number of requests per second allowed per API key (0 = unlimited)
+API_KEY_RATE_LIMIT = float(os.environ.get("API_KEY_RATE_LIMIT", 0))
+
+# The number of requests an API key can send in a burst above API_KEY_RATE_LIMIT
+API_KEY_BURST = float(os.environ.get("API_KEY_BURST", 20))
+
+# The minimum level of the logs (TRACE, DEBUG, INFO, WARNING, ERROR)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+
+# Write the logs from a background thread, so requests don't wait for the log writes
+LOG_ENQUEUE = bool(os.environ.get("LOG_ENQUEUE", "true") == "true")
+
+# Log the first chunk of every stream, then one every LOG_CHUNK_SAMPLE_EVERY chunks (0 = no chunks are logged)
+LOG_CHUNK_SAMPLE_EVERY = int(os.environ.get("LOG_CHUNK_SAMPLE_EVERY", 100))
+
+# How prompts are logged: full, truncate (to LOG_PROMPT_MAX_CHARS characters per message) or redact
+LOG_PROMPTS = os.environ.get("LOG_PROMPTS", "truncate")
+
+# The maximum number of characters of each prompt message (and chunk) that are logged
+LOG_PROMPT_MAX_CHARS = int(os.environ.get("LOG_PROMPT_MAX_CHARS", 100))
+
+# Records the upstream streams of a sampled fraction of the requests to this file (not recorded if unset)
+CAPTURE_PATH = os.environ.get("CAPTURE_PATH")
+
+# The fraction of the requests whose upstream streams are recorded to CAPTURE_PATH
+CAPTURE_SAMPLE_RATE = float(os.environ.get("CAPTURE_SAMPLE_RATE", 0.01))
+
+# The similarity (estimated Jaccard similarity of their word n-grams) above which the completions of aggregated
+# requests agree with each other
+ENSEMBLE_SIMILARITY_THRESHOLD = float(os.environ.get("ENSEMBLE_SIMILARITY_THRESHOLD", 0.5))
+
+# Selected miners stay on probation until they streamed this many characters (letters and digits): until then, the
+# other miners keep streaming so one can take the slot of a miner that stalls or duplicates another one (0 = none).
+# Clients then get "dropped" chunks and have to discard the text of the dropped miners, so it is opt-in
+STREAM_PROBATION_CHARS = int(os.environ.get("STREAM_PROBATION_CHARS", 0))
+
+# Drop a miner on probation that streamed no text for this many seconds when another miner can take its slot
+# (0 = stalled miners are never dropped)
+STREAM_STALL_TIMEOUT = float(os.environ.get("STREAM_STALL_TIMEOUT", 3.0))
+
+# Drop a miner whose first STREAM_PROBATION_CHARS characters are the same as a selected miner's (ignoring whitespace,
+# punctuation and case) when another miner can take its slot. Shorter responses are never dropped
+STREAM_DEDUP = bool(os.environ.get("STREAM_DEDUP", "true") == "true")
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from network.meta.schemas import QueryChatRequest
+from network.stream_manager import StreamManager
+from network.utils.chat_completions import (
+    DONE_EVENT,
+    HEARTBEAT_EVENT,
+    ChatCompletionEncoder,
+    chat_completion_events,
+    with_heartbeats,
+)
+
+
+async def collect(events):
+    return [event async for event in events]
+
+
+async def slow_events(*events, delay: float):
+    for event in events:
+        await asyncio.sleep(delay)
+        yield event
+
+
+async def stalled_miner():
+    yield "Hello "
+    await asyncio.sleep(30)
+
+
+def test_heartbeats_are_sent_between_slow_events():
+    events = asyncio.run(collect(with_heartbeats(slow_events(b"a", b"b", delay=0.3), 0.1)))
+
+    assert [event for event in events if event != HEARTBEAT_EVENT] == [b"a", b"b"]
+    assert events.count(HEARTBEAT_EVENT) >= 2
+
+
+def test_heartbeats_forward_errors():
+    async def failing_events():
+        yield b"a"
+        raise ValueError("upstream failed")
+
+    with pytest.raises(ValueError, match="upstream failed"):
+        asyncio.run(collect(with_heartbeats(failing_events(), 0.1)))
+
+
+def test_request_timeout_with_heartbeats():
+    request = QueryChatRequest(
+        roles=["user"],
+        messages=["Hi"],
+        k=1,
+        timeout=1,
+        query_validators=False,
+        sampling_mode="random",
+        stream_format="delta",
+    )
+    chunks = StreamManager(request).chunk_generator([stalled_miner()], [1])
+    events = with_heartbeats(chat_completion_events(chunks, ChatCompletionEncoder("test")), 15)
+
+    start_time = time.perf_counter()
+    sent = asyncio.run(asyncio.wait_for(collect(events), 5))
+
+    assert time.perf_counter() - start_time < 3
+    assert sent[-1] == DONE_EVENT
+    error = json.loads(sent[-2].removeprefix(b"data: "))["error"]
+    assert error["message"] == "timed out" and error["code"] == "timeout"
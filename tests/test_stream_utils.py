@@ -0,0 +1,101 @@
+import asyncio
+
+from network.meta.protocol import StreamPromptingSynapse
+from network.meta.schemas import QueryChatRequest, StreamChunk
+from network.stream_manager import StreamManager
+from network.utils.stream_utils import JSONFrameDecoder
+
+
+def feed_all(decoder: JSONFrameDecoder, *pieces: str) -> list:
+    frames = []
+    for piece in pieces:
+        frames.extend(decoder.feed(piece))
+    return frames + decoder.flush()
+
+
+def test_frames_split_across_reads():
+    frames = feed_all(JSONFrameDecoder(), '{"uid": 1, "chu', 'nk": "Hel', 'lo"}{"uid": 2,', ' "chunk": "Hi"}')
+
+    assert [json_object for _, json_object in frames] == [{"uid": 1, "chunk": "Hello"}, {"uid": 2, "chunk": "Hi"}]
+    assert [text for text, _ in frames] == ['{"uid": 1, "chunk": "Hello"}', '{"uid": 2, "chunk": "Hi"}']
+
+
+def test_braces_and_escapes_within_strings():
+    frames = feed_all(JSONFrameDecoder(), '{"uid": 1, "chunk": "}{ \\"', '}{\\\\"}{"uid": 2, "chunk": "{"}')
+
+    assert [json_object["chunk"] for _, json_object in frames] == ['}{ "}{\\', "{"]
+
+
+def test_incomplete_object_is_flushed_as_text():
+    decoder = JSONFrameDecoder()
+
+    assert decoder.feed('{"uid": 1}{"uid": 2, "chunk"') == [('{"uid": 1}', {"uid": 1})]
+    assert decoder.flush() == [('{"uid": 2, "chunk"', {})]
+
+
+def test_raw_text_is_passed_through():
+    decoder = JSONFrameDecoder(framed=False)
+
+    assert decoder.feed('{"uid": 7, "message": "not an error"}') == [('{"uid": 7, "message": "not an error"}', {})]
+    assert decoder.feed("}{ brace") == [("}{ brace", {})]
+    assert decoder.feed("\n\n") == [("\n\n", {})]
+    assert decoder.flush() == []
+
+
+def test_multibyte_characters_split_across_reads():
+    class Content:
+        async def iter_any(self):
+            encoded = "héllo 👋".encode("utf-8")
+            for position in range(len(encoded)):
+                yield encoded[position : position + 1]
+
+    class Response:
+        content = Content()
+
+    async def read():
+        synapse = StreamPromptingSynapse(roles=["user"], messages=["Hi"])
+        return [tokens async for tokens in synapse.process_streaming_response(Response())]
+
+    assert "".join(asyncio.run(read())) == "héllo 👋"
+
+
+def miner_deltas(*pieces: str) -> tuple[list[str], list[int]]:
+    """Streams the pieces from a single miner and returns the deltas and miner UIDs of the chunks sent back"""
+
+    async def miner():
+        for piece in pieces:
+            yield piece
+        yield StreamPromptingSynapse(roles=["user"], messages=["Hi"])
+
+    async def stream():
+        request = QueryChatRequest(
+            roles=["user"], messages=["Hi"], k=1, query_validators=False, sampling_mode="random", stream_format="delta"
+        )
+        return [chunk async for chunk in StreamManager(request).chunk_generator([miner()], [3])]
+
+    chunks = [
+        chunk for chunk in asyncio.run(stream()) if isinstance(chunk, StreamChunk) and chunk.finish_reason is None
+    ]
+    return [chunk.delta for chunk in chunks], [chunk.miner_uid for chunk in chunks]
+
+
+def test_miner_answer_starting_with_a_brace():
+    pieces = ['{"uid": 5, "message": "hi"', "} and more", " text"]
+    deltas, miner_uids = miner_deltas(*pieces)
+
+    assert "".join(deltas) == "".join(pieces)
+    assert set(miner_uids) == {3}
+
+
+def test_miner_answer_with_adjacent_objects():
+    pieces = ['{"a": 1}{"uid": 9', ', "chunk": "b"}', " done"]
+    deltas, miner_uids = miner_deltas(*pieces)
+
+    assert "".join(deltas) == "".join(pieces)
+    assert set(miner_uids) == {3}
+
+
+def test_miner_whitespace_delta_is_kept():
+    deltas, _ = miner_deltas("{", "\n\n", "}")
+
+    assert deltas == ["{", "\n\n", "}"]